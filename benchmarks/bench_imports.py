@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Import time budget of the probes. Nagios starts a new interpreter for every check, so the time spent importing is
+paid on every run. Each entry module is imported in a fresh process, the median over the runs is compared with its
+budget, and the modules that the cheap paths(checkcert, checklogin --inlocation) must never load are checked too.
+
+usage: bench_imports.py [-n RUNS] [--budget MODULE=MS] [-o OUTPUT]
+
+Exits with 1 if a module is over its budget or loads a module it should not.
+"""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+"""Entry modules of the probes and their import time budget in milliseconds"""
+BUDGETS = {
+    'rciam_probes.probes.checkmetadata.checkmetadata': 200,
+    'rciam_probes.probes.checkhealth.checkhealth': 200,
+}
+
+"""Modules that only the expensive paths need, e.g. the browser engine or the metadata parsing"""
+DEFERRED_MODULES = ['seleniumwire', 'selenium.webdriver', 'pkg_resources', 'xmltodict', 'OpenSSL', 'bs4',
+                    'lxml.etree']
+
+"""Runs in the child process. Prints the import time in seconds and the deferred modules that got loaded"""
+IMPORT_PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'loaded': [name for name in {deferred!r} if name in sys.modules]}}))
+"""
+
+
+def measure(module):
+    """
+    Import the module in a fresh interpreter
+    :return: the import time in milliseconds and the deferred modules it loaded
+    :rtype: tuple
+    """
+    script = IMPORT_PROBE.format(module=module, deferred=DEFERRED_MODULES)
+    output = subprocess.run([sys.executable, '-c', script], cwd=str(ROOT), check=True,
+                            stdout=subprocess.PIPE).stdout
+    record = json.loads(output.decode().strip().splitlines()[-1])
+    return record['seconds'] * 1000, record['loaded']
+
+
+def main(args):
+    options = parse_arguments(args)
+    results = {}
+    failed = False
+    for module, budget in options.budgets.items():
+        timings = []
+        loaded = []
+        for _ in range(options.runs):
+            milliseconds, loaded = measure(module)
+            timings.append(milliseconds)
+        median = statistics.median(timings)
+        over = median > budget
+        failed = failed or over or bool(loaded)
+        results[module] = {
+            'budget_ms': budget,
+            'median_ms': round(median, 1),
+            'min_ms': round(min(timings), 1),
+            'max_ms': round(max(timings), 1),
+            'deferred_loaded': loaded,
+            'ok': not over and not loaded,
+        }
+        print(module + ': ' + str(round(median, 1)) + 'ms(budget ' + str(budget) + 'ms)'
+              + (' loaded ' + ', '.join(loaded) if loaded else '') + (' FAILED' if over or loaded else ''),
+              file=sys.stderr)
+
+    text = json.dumps({
+        'meta': {
+            'date': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'runs': options.runs,
+        },
+        'modules': results,
+    }, indent=2)
+    if options.output == '-':
+        print(text)
+    else:
+        Path(options.output).write_text(text + '\n')
+    return 1 if failed else 0
+
+
+def parse_budget(value):
+    """
+    :param value: MODULE=MS
+    :type value: str
+    :rtype: tuple
+    """
+    module, separator, milliseconds = value.partition('=')
+    if not separator:
+        raise argparse.ArgumentTypeError('expected MODULE=MS, got ' + value)
+    return module, float(milliseconds)
+
+
+def parse_arguments(args):
+    """
+    Parse the arguments provided in the command line
+    :param args: list of arguments
+    :type args: list
+    :return: argument object
+    :rtype: ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description="Import time budget of the probes")
+    parser.add_argument('--runs', '-n', dest="runs", type=int, default=10, help='Imports per module. Defaults to 10')
+    parser.add_argument('--budget', dest="budget", action='append', type=parse_budget, default=[],
+                        help='Override or add a budget, e.g. rciam_probes.shared.utils=100. Repeat for more')
+    parser.add_argument('--output', '-o', dest="output", default='-',
+                        help='json results file, - for stdout. Defaults to stdout')
+    options = parser.parse_args(args)
+    options.budgets = dict(BUDGETS, **dict(options.budget))
+    return options
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the login check. The check runs against the local SP, proxy and IdP stand-ins, so the numbers
+are the probe's own overhead: interpreter start, imports, browser start, waits and parsing. Every run is a separate
+process, so that its CPU time and peak RSS, browser and geckodriver included, can be read from its rusage.
+
+usage: bench_login.py [-n RUNS] [--engine {browser,http}] [--disco {ssp,thiss,thiss-api,keycloak}] [-o OUTPUT]
+
+The results, one record per run plus a summary per scenario, are written as json to OUTPUT.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+# Benchmark the working tree, not an installed release
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from rciam_probes.shared.enums import ParamDefaults
+
+ENGINES = ['browser', 'http']
+DISCO_TYPES = ['ssp', 'thiss', 'thiss-api', 'keycloak']
+"""thiss-api runs the thiss.io stand-in with --thiss-api, i.e. without its search page"""
+STANDIN_DISCO = {'thiss-api': 'thiss'}
+"""The http engine does not run JavaScript"""
+UNSUPPORTED = {('http', 'thiss')}
+
+
+def run_once(engine, disco, sp, rs, idp, username, password, options):
+    """
+    Run one login check in this process and print its record as a json line
+    """
+    # Import here, so that the import time is part of the run
+    start = time.perf_counter()
+    from rciam_probes.probes.checkhealth.checkhealth import RciamHealthCheck
+    imported = time.perf_counter()
+    from rciam_probes.shared.authentication import has_selenium
+    if engine == 'browser' and not has_selenium:
+        print(json.dumps({'engine': engine, 'disco': disco, 'code': None, 'error': 'selenium is not installed'}))
+        return
+
+    logger = logging.getLogger('bench_login')
+    logger.addHandler(logging.NullHandler())
+    check_args = ['-u', username, '-a', password, '-s', sp, '-r', rs, '-i', idp, '-H', '127.0.0.1',
+                  '--engine', engine, '-t', str(options.timeout), '-f', options.firefox, '-g', options.geckodriver]
+    if disco == 'thiss-api':
+        check_args += ['--thiss-api', options.mdq]
+    check = RciamHealthCheck(check_args, logger=logger)
+    value, vtype, code = check.evaluate_login()
+    end = time.perf_counter()
+    print(json.dumps({
+        'engine': engine,
+        'disco': disco,
+        'code': code,
+        'value': value,
+        'vtype': vtype,
+        'import': round(imported - start, 4),
+        'wall': round(end - start, 4),
+        'stages': check.stage_timings(),
+    }))
+
+
+def measure(engine, disco, services, options):
+    """
+    Run one login check in a child process
+    :return: the record of the run, with the CPU time and peak RSS of the child and of the processes it waited for,
+             e.g. geckodriver and Firefox
+    :rtype: dict
+    """
+    command = [sys.executable, __file__, '--run-once', '--engine', engine, '--disco', disco,
+               '--sp', services.login_url(STANDIN_DISCO.get(disco, disco)), '--rs', services.landing_url(),
+               '--idp', services.idp_entity_id, '--mdq', services.mdq_url(),
+               '--username', services.username, '--password', services.password,
+               '-t', str(options.timeout), '-f', options.firefox, '-g', options.geckodriver]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = process.stdout.read().decode(errors='replace')
+    process.stdout.close()
+    # Reap the child ourselves, wait4 reports its resource usage
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    process_wall = time.perf_counter() - start
+
+    lines = output.strip().splitlines()
+    try:
+        record = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        record = {'engine': engine, 'disco': disco, 'code': None,
+                  'error': lines[-1] if lines else 'exit ' + str(process.returncode)}
+    record['process_wall'] = round(process_wall, 4)
+    record['cpu_user'] = round(usage.ru_utime, 4)
+    record['cpu_system'] = round(usage.ru_stime, 4)
+    # Peak RSS of the largest process of the run
+    record['peak_rss_kib'] = usage.ru_maxrss
+    return record
+
+
+def summarize(records):
+    """
+    :return: per scenario distribution of the wall, CPU and stage times of the successful runs
+    :rtype: dict
+    """
+    summary = {}
+    for record in records:
+        key = record['engine'] + '/' + record['disco']
+        scenario = summary.setdefault(key, {'runs': 0, 'failures': 0, 'wall': [], 'process_wall': [], 'cpu': [],
+                                            'peak_rss_kib': [], 'stages': {}})
+        scenario['runs'] += 1
+        if record.get('code') != 0:
+            scenario['failures'] += 1
+            continue
+        scenario['wall'].append(record['wall'])
+        scenario['process_wall'].append(record['process_wall'])
+        scenario['cpu'].append(record['cpu_user'] + record['cpu_system'])
+        scenario['peak_rss_kib'].append(record['peak_rss_kib'])
+        for stage, seconds in record['stages'].items():
+            scenario['stages'].setdefault(stage, []).append(seconds)
+
+    for scenario in summary.values():
+        for name in ['wall', 'process_wall', 'cpu']:
+            scenario[name] = distribution(scenario[name])
+        scenario['peak_rss_kib'] = max(scenario['peak_rss_kib'], default=None)
+        scenario['stages'] = {stage: distribution(values) for stage, values in scenario['stages'].items()}
+    return summary
+
+
+def distribution(values):
+    """
+    :return: min, median, p95 and max of the values, None if there are none
+    :rtype: dict
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        'min': round(ordered[0], 4),
+        'median': round(statistics.median(ordered), 4),
+        'p95': round(ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))], 4),
+        'max': round(ordered[-1], 4),
+    }
+
+
+def main(args):
+    options = parse_arguments(args)
+    if options.run_once:
+        run_once(options.engine[0], options.disco[0], options.sp, options.rs, options.idp, options.username,
+                 options.password, options)
+        return 0
+
+    from standins import StandInServices
+
+    scenarios = [(engine, disco) for engine in options.engine for disco in options.disco
+                 if (engine, disco) not in UNSUPPORTED]
+    records = []
+    with StandInServices(ssp_modules=options.modules) as services:
+        for engine, disco in scenarios:
+            for run in range(options.runs):
+                record = measure(engine, disco, services, options)
+                records.append(record)
+                print(engine + '/' + disco + ' run ' + str(run + 1) + ': '
+                      + (str(record['wall']) + 's' if record.get('code') == 0
+                         else 'failed ' + str(record.get('error', record.get('value')))), file=sys.stderr)
+
+    results = {
+        'meta': {
+            'date': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'version': probe_version(),
+            'runs': options.runs,
+            'ssp_modules': options.modules,
+        },
+        'summary': summarize(records),
+        'runs': records,
+    }
+    text = json.dumps(results, indent=2)
+    if options.output == '-':
+        print(text)
+    else:
+        Path(options.output).write_text(text + '\n')
+    return 0 if all(record.get('code') == 0 for record in records) else 1
+
+
+def probe_version():
+    """:return: the version in setup.py of the working tree"""
+    setup = Path(__file__).resolve().parent.parent.joinpath('setup.py')
+    for line in setup.read_text().splitlines():
+        if line.startswith('__version__'):
+            return line.split('=', 1)[1].strip().strip('\'"')
+    return None
+
+
+def parse_arguments(args):
+    """
+    Parse the arguments provided in the command line
+    :param args: list of arguments
+    :type args: list
+    :return: argument object
+    :rtype: ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description="Offline login check benchmark")
+    parser.add_argument('--runs', '-n', dest="runs", type=int, default=10, help='Runs per scenario. Defaults to 10')
+    parser.add_argument('--engine', dest="engine", action='append', choices=ENGINES,
+                        help='Login engine to benchmark. Repeat for more. Defaults to all')
+    parser.add_argument('--disco', dest="disco", action='append', choices=DISCO_TYPES,
+                        help='Discovery service to benchmark. Repeat for more. Defaults to all')
+    parser.add_argument('--modules', dest="modules", type=int, default=3,
+                        help='Number of simpleSAMLphp module pages. Defaults to 3')
+    parser.add_argument('--output', '-o', dest="output", default='bench_login.json',
+                        help='json results file, - for stdout. Defaults to bench_login.json')
+    parser.add_argument('--timeout', '-t', dest="timeout", type=int, default=10,
+                        help='Probe timeout in seconds. Defaults to 10')
+    parser.add_argument('--firefox', '-f', dest="firefox", default=ParamDefaults.FIREFOX_PATH.value,
+                        help='Firefox binary full path')
+    parser.add_argument('--geckodriver', '-g', dest="geckodriver", default=ParamDefaults.GECKODRIVER_PATH.value,
+                        help='geckodriver binary full path')
+    # Used by the child processes
+    parser.add_argument('--run-once', dest="run_once", action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--sp', dest="sp", help=argparse.SUPPRESS)
+    parser.add_argument('--rs', dest="rs", help=argparse.SUPPRESS)
+    parser.add_argument('--idp', dest="idp", help=argparse.SUPPRESS)
+    parser.add_argument('--username', dest="username", help=argparse.SUPPRESS)
+    parser.add_argument('--password', dest="password", help=argparse.SUPPRESS)
+    parser.add_argument('--mdq', dest="mdq", help=argparse.SUPPRESS)
+    options = parser.parse_args(args)
+    options.engine = options.engine or ENGINES
+    options.disco = options.disco or DISCO_TYPES
+    return options
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
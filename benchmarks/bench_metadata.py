@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the metadata pipeline. Generated SAML metadata, from one entity up to tens of thousands, are
+served by a local file server and pushed through every stage the metadata probe uses:
+
+get_xml                      download and parse to a dict
+stream_key_descriptors       download and stream the KeyDescriptors
+gen_dict_extract             find the KeyDescriptors in the parsed dict
+fetch_cert_from_type         pick the certificates of the first KeyDescriptors in the parsed dict
+evaluate_single_certificate  parse a certificate and compute the days to expiration, per certificate
+
+The documents mix the use attributes(signing, encryption, both, unset) and the namespace styles(md:/ds: prefixed,
+unprefixed default namespaces and Keycloak style entities). Every stage and size runs in a fresh process, so that
+its peak RSS is its own.
+
+usage: bench_metadata.py [--sizes 1,100,1000,20000] [--stages STAGES] [-n REPEAT] [-o OUTPUT]
+"""
+import argparse
+import functools
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from string import Template
+
+# Benchmark the working tree, not an installed release
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+STAGES = ['get_xml', 'stream_key_descriptors', 'gen_dict_extract', 'fetch_cert_from_type',
+          'evaluate_single_certificate']
+SIZES = [1, 10, 100, 1000, 5000, 20000]
+STYLES = ['prefixed', 'unprefixed', 'keycloak']
+USES = [('signing', 'encryption'), ('signing',), (None,), ('encryption',)]
+
+"""Document with many entities"""
+ENTITIES_TMPL = Template("""<?xml version="1.0" encoding="UTF-8"?>
+<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" xmlns:ds="http://www.w3.org/2000/09/xmldsig#" Name="urn:bench:federation">
+${entities}
+</md:EntitiesDescriptor>
+""")
+
+"""Entity with md: and ds: prefixes"""
+PREFIXED_ENTITY_TMPL = Template("""<md:EntityDescriptor entityID="https://sp${index}.bench.example.org/shibboleth">
+<md:SPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+${key_descriptors}
+<md:AssertionConsumerService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST" Location="https://sp${index}.bench.example.org/acs" index="1"/>
+</md:SPSSODescriptor>
+</md:EntityDescriptor>""")
+
+"""KeyDescriptor with md: and ds: prefixes"""
+PREFIXED_KEY_TMPL = Template("""<md:KeyDescriptor${use}><ds:KeyInfo><ds:X509Data><ds:X509Certificate>
+${certificate}
+</ds:X509Certificate></ds:X509Data></ds:KeyInfo></md:KeyDescriptor>""")
+
+"""Entity in the default namespace"""
+UNPREFIXED_ENTITY_TMPL = Template("""<EntityDescriptor xmlns="urn:oasis:names:tc:SAML:2.0:metadata" entityID="https://idp${index}.bench.example.org/idp/shibboleth">
+<IDPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+${key_descriptors}
+<SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect" Location="https://idp${index}.bench.example.org/idp/profile/SAML2/Redirect/SSO"/>
+</IDPSSODescriptor>
+</EntityDescriptor>""")
+
+"""KeyDescriptor in the default namespaces"""
+UNPREFIXED_KEY_TMPL = Template("""<KeyDescriptor${use}><KeyInfo xmlns="http://www.w3.org/2000/09/xmldsig#"><X509Data><X509Certificate>
+${certificate}
+</X509Certificate></X509Data></KeyInfo></KeyDescriptor>""")
+
+"""Keycloak realm entity. The KeyInfo starts with a KeyName"""
+KEYCLOAK_ENTITY_TMPL = Template("""<md:EntityDescriptor entityID="https://keycloak${index}.bench.example.org/auth/realms/bench">
+<md:IDPSSODescriptor WantAuthnRequestsSigned="true" protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+${key_descriptors}
+<md:SingleSignOnService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST" Location="https://keycloak${index}.bench.example.org/auth/realms/bench/protocol/saml"/>
+</md:IDPSSODescriptor>
+</md:EntityDescriptor>""")
+
+"""Keycloak KeyDescriptor"""
+KEYCLOAK_KEY_TMPL = Template("""<md:KeyDescriptor${use}><ds:KeyInfo><ds:KeyName>bench-${index}</ds:KeyName><ds:X509Data><ds:X509Certificate>${certificate}</ds:X509Certificate></ds:X509Data></ds:KeyInfo></md:KeyDescriptor>""")
+
+ENTITY_TEMPLATES = {
+    'prefixed': (PREFIXED_ENTITY_TMPL, PREFIXED_KEY_TMPL),
+    'unprefixed': (UNPREFIXED_ENTITY_TMPL, UNPREFIXED_KEY_TMPL),
+    'keycloak': (KEYCLOAK_ENTITY_TMPL, KEYCLOAK_KEY_TMPL),
+}
+
+
+def generate_certificates(count):
+    """
+    :return: base64 bodies of self signed certificates with different validity periods
+    :rtype: list
+    """
+    # cryptography is installed along with pyOpenSSL, whose certificate building API is deprecated
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    certificates = []
+    now = datetime.now(timezone.utc)
+    for index in range(count):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'bench-' + str(index) + '.example.org')])
+        cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+            .serial_number(index + 1).not_valid_before(now - timedelta(days=1)) \
+            .not_valid_after(now + timedelta(days=30 + 60 * index)).sign(key, hashes.SHA256())
+        pem = cert.public_bytes(serialization.Encoding.PEM).decode()
+        certificates.append('\n'.join(line for line in pem.splitlines() if not line.startswith('-----')))
+    return certificates
+
+
+def generate_metadata(entities, certificates, seed=0):
+    """
+    :param entities: number of entities
+    :type entities: int
+
+    :param certificates: certificate bodies to pick from
+    :type certificates: list
+
+    :param seed: seed of the style, use and certificate choices
+    :type seed: int
+
+    :return: the metadata document. A single entity is a Keycloak style EntityDescriptor document
+    :rtype: str
+    """
+    rand = random.Random(seed)
+    if entities == 1:
+        return '<?xml version="1.0" encoding="UTF-8"?>\n' + generate_entity(0, 'keycloak', USES[0], certificates,
+                                                                          rand).replace(
+            '<md:EntityDescriptor ', '<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" '
+                                     'xmlns:ds="http://www.w3.org/2000/09/xmldsig#" ', 1)
+    return ENTITIES_TMPL.substitute(entities='\n'.join(
+        generate_entity(index, STYLES[index % len(STYLES)], USES[rand.randrange(len(USES))], certificates, rand)
+        for index in range(entities)))
+
+
+def generate_entity(index, style, uses, certificates, rand):
+    """:return: the xml of one entity"""
+    entity_tmpl, key_tmpl = ENTITY_TEMPLATES[style]
+    key_descriptors = '\n'.join(key_tmpl.substitute(use='' if use is None else ' use="' + use + '"',
+                                                    certificate=rand.choice(certificates), index=index)
+                                for use in uses)
+    return entity_tmpl.substitute(index=index, key_descriptors=key_descriptors)
+
+
+def serve_directory(directory):
+    """
+    Serve the directory on a local port
+    :return: the server and its base url
+    :rtype: (ThreadingHTTPServer, str)
+    """
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=str(directory)))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:' + str(server.server_address[1])
+
+
+def prepare_stage(stage, path, url):
+    """
+    :return: the callable of one iteration of the stage and the number of items it handles
+    :rtype: (callable, int)
+    """
+    import xmltodict
+    from rciam_probes.shared.utils import create_http_session, evaluate_single_certificate, fetch_cert_from_type, \
+        gen_dict_extract, get_xml, iter_key_descriptors, stream_key_descriptors
+
+    if stage == 'get_xml':
+        session = create_http_session(1)
+        return lambda: get_xml(url, 30, None, session), 1
+    if stage == 'stream_key_descriptors':
+        session = create_http_session(1)
+        return lambda: sum(1 for key_descriptor in stream_key_descriptors(url, 30, None, session)), 1
+    if stage in ['gen_dict_extract', 'fetch_cert_from_type']:
+        metadata_dict = xmltodict.parse(Path(path).read_text())
+        if stage == 'gen_dict_extract':
+            return lambda: sum(1 for key_descriptor in gen_dict_extract(metadata_dict, 'KeyDescriptor')), 1
+        return lambda: fetch_cert_from_type(metadata_dict, 'all'), 1
+    certificates = [x509 for entity_id, role, use, x509 in iter_key_descriptors(path)]
+
+    def evaluate_all():
+        for x509 in certificates:
+            evaluate_single_certificate(x509)
+    return evaluate_all, len(certificates)
+
+
+def run_stage(stage, path, url, repeat):
+    """
+    Run one stage over one document in this process and print its record as a json line
+    """
+    iteration, items = prepare_stage(stage, path, url)
+    # Warm up the connection pool and the imports
+    iteration()
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        iteration()
+        latencies.append(time.perf_counter() - start)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # A separate traced iteration. Tracing slows down the allocations a lot
+    tracemalloc.start()
+    iteration()
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(json.dumps({
+        'latencies': latencies,
+        'items': items,
+        'baseline_rss_kib': baseline_rss,
+        'peak_rss_kib': peak_rss,
+        'peak_traced_kib': traced_peak // 1024,
+    }))
+
+
+def measure(stage, entities, path, url, repeat):
+    """
+    Run one stage over one document in a child process
+    :return: the record of the stage
+    :rtype: dict
+    """
+    command = [sys.executable, __file__, '--run-stage', stage, '--path', str(path), '--url', url,
+               '--repeat', str(repeat)]
+    completed = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    lines = completed.stdout.decode(errors='replace').strip().splitlines()
+    record = {'stage': stage, 'entities': entities, 'bytes': path.stat().st_size}
+    try:
+        raw = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        record['error'] = lines[-1] if lines else 'exit ' + str(completed.returncode)
+        return record
+
+    latencies = sorted(raw['latencies'])
+    total = sum(latencies)
+    per_item = 'certificate' if stage == 'evaluate_single_certificate' else 'document'
+    record.update({
+        'repeat': len(latencies),
+        'items': raw['items'],
+        'latency_s': {
+            'per': per_item,
+            'min': percentile(latencies, 0),
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': percentile(latencies, 100),
+        },
+        'throughput': {
+            'entities_per_s': round(entities * len(latencies) / total, 2) if total else None,
+            'mib_per_s': round(record['bytes'] * len(latencies) / total / 1048576, 2) if total else None,
+        },
+        'baseline_rss_kib': raw['baseline_rss_kib'],
+        'peak_rss_kib': raw['peak_rss_kib'],
+        'peak_traced_kib': raw['peak_traced_kib'],
+    })
+    if per_item == 'certificate':
+        # Latency of one certificate, the iteration evaluates all the certificates of the document
+        record['latency_s'] = {name: (round(value / raw['items'], 8) if isinstance(value, float) and raw['items']
+                                      else value) for name, value in record['latency_s'].items()}
+        record['throughput']['certificates_per_s'] = round(raw['items'] * len(latencies) / total, 2) \
+            if total else None
+    return record
+
+
+def percentile(ordered, rank):
+    """:return: the nearest rank percentile of the sorted values"""
+    if not ordered:
+        return None
+    return round(ordered[min(len(ordered) - 1, int(round(rank / 100 * (len(ordered) - 1))))], 6)
+
+
+def main(args):
+    options = parse_arguments(args)
+    if options.run_stage is not None:
+        run_stage(options.run_stage, options.path, options.url, options.repeat)
+        return 0
+
+    certificates = generate_certificates(options.certificates)
+    records = []
+    with tempfile.TemporaryDirectory(prefix='bench_metadata') as directory:
+        server, base_url = serve_directory(directory)
+        try:
+            for entities in options.sizes:
+                path = Path(directory).joinpath('metadata-' + str(entities) + '.xml')
+                path.write_text(generate_metadata(entities, certificates, options.seed))
+                for stage in options.stages:
+                    record = measure(stage, entities, path, base_url + '/' + path.name, options.repeat)
+                    records.append(record)
+                    print(stage + ' ' + str(entities) + ' entities: '
+                          + (str(record['latency_s']['p50']) + 's p50 ' + str(record['peak_rss_kib']) + 'KiB'
+                             if 'error' not in record else 'failed ' + record['error']), file=sys.stderr)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    results = {
+        'meta': {
+            'date': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': options.repeat,
+            'certificates': options.certificates,
+            'seed': options.seed,
+        },
+        'results': records,
+    }
+    text = json.dumps(results, indent=2)
+    if options.output == '-':
+        print(text)
+    else:
+        Path(options.output).write_text(text + '\n')
+    return 0 if all('error' not in record for record in records) else 1
+
+
+def parse_arguments(args):
+    """
+    Parse the arguments provided in the command line
+    :param args: list of arguments
+    :type args: list
+    :return: argument object
+    :rtype: ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description="Metadata pipeline micro-benchmark")
+    parser.add_argument('--sizes', dest="sizes", default=','.join(str(size) for size in SIZES),
+                        help='csv list of the number of entities of the documents. Defaults to '
+                             + ','.join(str(size) for size in SIZES))
+    parser.add_argument('--stages', dest="stages", default=','.join(STAGES),
+                        help='csv list of the stages to run. Defaults to all: ' + ','.join(STAGES))
+    parser.add_argument('--repeat', '-n', dest="repeat", type=int, default=5,
+                        help='Timed iterations per stage and size. Defaults to 5')
+    parser.add_argument('--certificates', dest="certificates", type=int, default=8,
+                        help='Number of distinct certificates in the documents. Defaults to 8')
+    parser.add_argument('--seed', dest="seed", type=int, default=0, help='Seed of the generated documents')
+    parser.add_argument('--output', '-o', dest="output", default='bench_metadata.json',
+                        help='json results file, - for stdout. Defaults to bench_metadata.json')
+    # Used by the child processes
+    parser.add_argument('--run-stage', dest="run_stage", choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument('--path', dest="path", help=argparse.SUPPRESS)
+    parser.add_argument('--url', dest="url", help=argparse.SUPPRESS)
+    options = parser.parse_args(args)
+    if options.run_stage is None:
+        options.sizes = [int(size) for size in options.sizes.split(',') if size.strip()]
+        options.stages = [stage.strip() for stage in options.stages.split(',') if stage.strip()]
+        unknown = set(options.stages) - set(STAGES)
+        if unknown:
+            parser.error('unknown stages: ' + ', '.join(sorted(unknown)))
+    return options
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,390 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local stand-ins for the services a login check walks through. Three HTTP servers on 127.0.0.1 play the SP, the
+RCIAM proxy and the IdP:
+
+SP /sp/login -> proxy discovery(SimpleSAMLphp, thiss.io or Keycloak) -> proxy /sso -> SAMLRequest auto submit ->
+Shibboleth IdP client side storage read, login, consent and client side storage write -> SAMLResponse auto submit ->
+simpleSAMLphp module chain -> OIDC consent -> dummy SP /sp/home with #table_with_attributes
+
+The proxy also serves the json MDQ the thiss.io page searches, /entities/{sha1}<hex>.json and /entities/?q=<text>.
+
+The pages carry the same elements, ids and forms as the real ones, so both login engines run unchanged.
+"""
+import hashlib
+import json
+import re
+import threading
+from html import escape
+from http import cookies
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from string import Template
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlparse
+
+IDP_SESSION_COOKIE = 'shib_idp_session'
+
+"""Page layout. The proxy pages carry the cookie banner the probes hide"""
+PAGE_TMPL = Template("""<!DOCTYPE html>
+<html>
+<head><meta charset="utf-8"><title>${title}</title></head>
+<body${onload}>
+${banner}
+<div id="content">
+${content}
+</div>
+</body>
+</html>""")
+
+"""Cookie policy banner of the proxy pages"""
+COOKIE_BANNER = """<div id="cookies"><p>This site uses cookies</p><button id="js-accept-cookies">Accept</button></div>"""
+
+"""Auto submitted form of the SAML HTTP-POST binding"""
+AUTO_SUBMIT_TMPL = Template("""<form method="post" action="${action}">
+<input type="hidden" name="${field}" value="${value}">
+<input type="hidden" name="RelayState" value="${relay_state}">
+<noscript><button type="submit" class="btn">Continue</button></noscript>
+</form>""")
+
+"""SimpleSAMLphp discovery"""
+SSP_DISCO_TMPL = Template("""<h1>Select your Identity Provider</h1>
+<div class="idplist"><a href="${sso}?idpentityid=${entity_id}">${name}</a></div>""")
+
+"""thiss.io search page. The results show up while typing"""
+THISS_DISCO_TMPL = Template("""<h1>Find your institution</h1>
+<input id="searchinput" type="text" autocomplete="off">
+<script>
+document.getElementById('searchinput').addEventListener('input', function(e) {
+    var old = document.getElementById('ds-search-list');
+    if (old) old.remove();
+    var list = document.createElement('ul');
+    list.id = 'ds-search-list';
+    if ('${name}'.indexOf(e.target.value) >= 0 || '${search}'.indexOf(e.target.value) >= 0) {
+        var item = document.createElement('li');
+        item.className = 'institution identityprovider';
+        item.setAttribute('data-href', '${entity_id_raw}');
+        item.textContent = '${name}';
+        item.addEventListener('click', function() {
+            window.location.href = '${sso}?idpentityid=${entity_id}';
+        });
+        list.appendChild(item);
+    }
+    document.body.appendChild(list);
+});
+</script>""")
+
+"""Keycloak broker page with the identity provider filter"""
+KEYCLOAK_DISCO_TMPL = Template("""<div class="login-pf-page">
+<div id="kc-header"><div id="kc-header-wrapper">Stand-in realm</div></div>
+<input id="kc-providers-filter" type="text">
+<div id="spinner" class="hidden"></div>
+<ul id="kc-social-providers">
+<li><a class="pf-c-button kc-social-item" href="${sso}?idpentityid=${entity_id}"><span>${name}</span></a></li>
+</ul>
+</div>""")
+
+"""
+Shibboleth IdP client side storage page, "Loading Session Information" on the way in and "Saving Session
+Information" on the way out. doLoad() reports whether the browser supports local storage and posts the form
+"""
+IDP_CLIENT_STORAGE_TMPL = Template("""<script>
+function doLoad() {
+    document.form1['shib_idp_ls_supported'].value = 'true';
+    document.form1.submit();
+}
+</script>
+<noscript><p>Since your browser does not support JavaScript, you must press the Continue button.</p></noscript>
+<form name="form1" action="${action}" method="post">
+<input type="hidden" name="csrf_token" value="stand-in-csrf">
+<input name="shib_idp_ls_exception.shib_idp_session_ss" type="hidden">
+<input name="shib_idp_ls_success.shib_idp_session_ss" type="hidden" value="false">
+<input name="shib_idp_ls_value.shib_idp_session_ss" type="hidden">
+<input name="shib_idp_ls_supported" type="hidden">
+<input name="_eventId_proceed" type="hidden">
+<noscript><button type="submit">Continue</button></noscript>
+</form>""")
+
+"""Shibboleth IdP login page"""
+IDP_LOGIN_TMPL = Template("""<form method="post" action="${action}">
+<input type="hidden" name="RelayState" value="${relay_state}">
+<label for="username">Username</label><input id="username" name="j_username" type="text">
+<label for="password">Password</label><input id="password" name="j_password" type="password">
+<button type="submit">Login</button>
+</form>""")
+
+"""Shibboleth IdP attribute release page"""
+IDP_CONSENT_TMPL = Template("""<form method="post" action="${action}">
+<input type="hidden" name="RelayState" value="${relay_state}">
+<p>Information to be provided to the service</p>
+<input type="submit" name="_eventId_proceed" value="Accept">
+</form>""")
+
+"""simpleSAMLphp module page. The last module is the consent"""
+SSP_MODULE_TMPL = Template("""<form method="post" action="${action}">
+<input type="hidden" name="StateId" value="${state}">
+<p>Module ${number}</p>
+<button id="yesbutton" type="submit" name="yes" value="yes">Continue</button>
+</form>""")
+
+"""MitreId OIDC consent page"""
+OIDC_CONSENT_TMPL = Template("""<form method="post" action="${action}">
+<input type="hidden" name="user_oauth_approval" value="true">
+<input type="submit" name="authorize" value="Authorise">
+</form>""")
+
+"""Dummy SP attributes page"""
+SP_HOME_TMPL = Template("""<h1>SAML 2.0 SP Demo Example</h1>
+<table id="table_with_attributes">
+<tr><td><tt>eduPersonUniqueId</tt></td><td>${username}@stand-in</td></tr>
+<tr><td><tt>mail</tt></td><td>${username}@example.org</td></tr>
+</table>""")
+
+
+class StandInServices:
+    """The SP, proxy and IdP stand-ins, each on its own local port"""
+    __servers = None
+    __threads = None
+    username = None
+    password = None
+    ssp_modules = None
+    sp_url = None
+    proxy_url = None
+    idp_url = None
+    idp_entity_id = None
+    idp_name = 'Stand-in Identity Provider'
+
+    def __init__(self, username='bench', password='bench', ssp_modules=3):
+        """
+        :param username: the user the IdP accepts
+        :type username: str
+
+        :param password: the password the IdP accepts
+        :type password: str
+
+        :param ssp_modules: number of simpleSAMLphp module pages, the last one being the consent
+        :type ssp_modules: int
+        """
+        self.username = username
+        self.password = password
+        self.ssp_modules = max(1, ssp_modules)
+        self.__servers = {}
+        self.__threads = []
+
+    def start(self):
+        """Start the servers on free ports"""
+        for role in ['sp', 'proxy', 'idp']:
+            server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+            server.daemon_threads = True
+            server.services = self
+            server.role = role
+            self.__servers[role] = server
+        self.sp_url = self.__base_url('sp')
+        self.proxy_url = self.__base_url('proxy')
+        self.idp_url = self.__base_url('idp')
+        self.idp_entity_id = self.idp_url + '/idp/shibboleth'
+        for server in self.__servers.values():
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+        return self
+
+    def stop(self):
+        """Stop the servers"""
+        for server in self.__servers.values():
+            server.shutdown()
+            server.server_close()
+        for thread in self.__threads:
+            thread.join()
+
+    def login_url(self, disco):
+        """
+        :param disco: discovery service type, ssp, thiss or keycloak
+        :type disco: str
+
+        :return: the SP login url the probe starts from
+        :rtype: str
+        """
+        return self.sp_url + '/sp/login?disco=' + disco
+
+    def mdq_url(self):
+        """
+        :return: the json MDQ of the thiss.io discovery
+        :rtype: str
+        """
+        return self.proxy_url + '/entities/'
+
+    def landing_url(self):
+        """
+        :return: the SP landing page
+        :rtype: str
+        """
+        return self.sp_url + '/sp/home'
+
+    def __base_url(self, role):
+        return 'http://127.0.0.1:' + str(self.__servers[role].server_address[1])
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Routes the requests of the SP, proxy and IdP stand-ins"""
+
+    def do_GET(self):
+        self.__route({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        form = parse_qs(self.rfile.read(length).decode(), keep_blank_values=True)
+        self.__route({name: values[0] for name, values in form.items()})
+
+    def log_message(self, format, *args):
+        # Keep the benchmark output clean
+        pass
+
+    def __route(self, form):
+        services = self.server.services
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        routes = {
+            ('sp', '/sp/login'): self.__sp_login,
+            ('sp', '/sp/home'): self.__sp_home,
+            ('proxy', '/disco'): self.__disco,
+            ('proxy', '/sso'): self.__proxy_sso,
+            ('proxy', '/acs'): self.__proxy_acs,
+            ('proxy', '/oidc/authorize'): self.__oidc_authorize,
+            ('idp', '/idp/profile/SAML2/POST/SSO'): self.__idp_sso,
+            ('idp', '/idp/login'): self.__idp_login,
+            ('idp', '/idp/consent'): self.__idp_consent,
+            ('idp', '/robots.txt'): self.__robots,
+        }
+        if self.server.role == 'proxy' and url.path.startswith('/module.php/'):
+            return self.__ssp_module(url.path, form)
+        if self.server.role == 'proxy' and url.path.startswith('/entities/'):
+            return self.__mdq(services, unquote(url.path[len('/entities/'):]), query)
+        route = routes.get((self.server.role, url.path))
+        if route is None:
+            return self.__page(404, 'Not Found', '<p>' + escape(self.path) + '</p>')
+        route(services, query, form)
+
+    def __sp_login(self, services, query, form):
+        # SAML Identity Provider Discovery protocol request
+        self.__redirect(services.proxy_url + '/disco?' + urlencode({'disco': query.get('disco', 'ssp'),
+                                                                    'entityID': services.proxy_url + '/sp',
+                                                                    'return': services.proxy_url + '/sso',
+                                                                    'returnIDParam': 'idpentityid'}))
+
+    def __sp_home(self, services, query, form):
+        self.__page(200, 'SAML 2.0 SP Demo Example', SP_HOME_TMPL.substitute(username=escape(services.username)))
+
+    def __disco(self, services, query, form):
+        disco = query.get('disco', 'ssp')
+        values = {
+            'sso': services.proxy_url + '/sso',
+            'entity_id': quote(services.idp_entity_id, safe=''),
+            'entity_id_raw': services.idp_entity_id,
+            'name': services.idp_name + ' (127.0.0.1)',
+            'search': '127.0.0.1',
+        }
+        if disco == 'thiss':
+            self.__page(200, 'Seamless Access', THISS_DISCO_TMPL.substitute(values))
+        elif disco == 'keycloak':
+            self.__page(200, 'Sign in to the stand-in realm', KEYCLOAK_DISCO_TMPL.substitute(values))
+        else:
+            self.__page(200, 'Select your identity provider', SSP_DISCO_TMPL.substitute(values), banner=True)
+
+    def __mdq(self, services, entity, query):
+        record = {'entityID': services.idp_entity_id, 'title': services.idp_name, 'type': 'idp',
+                  'id': '{sha1}' + hashlib.sha1(services.idp_entity_id.encode()).hexdigest()}
+        if entity == record['id'] + '.json':
+            return self.__send(200, json.dumps(record).encode(), 'application/json')
+        if entity == '' and 'q' in query:
+            matches = [record] if query['q'].lower() in (record['title'] + ' 127.0.0.1').lower() else []
+            return self.__send(200, json.dumps(matches).encode(), 'application/json')
+        self.__send(404, b'[]', 'application/json')
+
+    def __proxy_sso(self, services, query, form):
+        self.__auto_submit(services.idp_url + '/idp/profile/SAML2/POST/SSO', 'SAMLRequest', 'stand-in-request')
+
+    def __idp_sso(self, services, query, form):
+        if 'shib_idp_ls_supported' not in form:
+            return self.__client_storage('Loading Session Information', '/idp/profile/SAML2/POST/SSO')
+        if self.__cookie(IDP_SESSION_COOKIE) == services.username:
+            return self.__page(200, 'Information Release',
+                               IDP_CONSENT_TMPL.substitute(action='/idp/consent', relay_state='proxy'))
+        self.__page(200, 'Web Login Service', IDP_LOGIN_TMPL.substitute(action='/idp/login', relay_state='proxy'))
+
+    def __idp_login(self, services, query, form):
+        if form.get('j_username') != services.username or form.get('j_password') != services.password:
+            return self.__page(401, 'Web Login Service', '<p class="form-error">The password you entered was '
+                                                         'incorrect.</p>')
+        self.__page(200, 'Information Release', IDP_CONSENT_TMPL.substitute(action='/idp/consent',
+                                                                            relay_state='proxy'),
+                    headers={'Set-Cookie': IDP_SESSION_COOKIE + '=' + services.username + '; Path=/; HttpOnly'})
+
+    def __idp_consent(self, services, query, form):
+        if 'shib_idp_ls_supported' not in form:
+            return self.__client_storage('Saving Session Information', '/idp/consent')
+        self.__auto_submit(services.proxy_url + '/acs', 'SAMLResponse', 'stand-in-response')
+
+    def __robots(self, services, query, form):
+        self.__send(200, b'User-agent: *\nDisallow: /\n', 'text/plain')
+
+    def __proxy_acs(self, services, query, form):
+        self.__redirect(services.proxy_url + '/module.php/stand-in/module1.php', status=303)
+
+    def __ssp_module(self, path, form):
+        services = self.server.services
+        if path.endswith('getconsent.php'):
+            return self.__redirect(services.proxy_url + '/oidc/authorize', status=303)
+        match = re.search(r'/module(\d+)\.php$', path)
+        if match is None:
+            return self.__page(404, 'Not Found', '<p>' + escape(path) + '</p>')
+        number = int(match.group(1))
+        if self.command == 'POST':
+            return self.__redirect(services.proxy_url + '/module.php/stand-in/module' + str(number + 1) + '.php',
+                                   status=303)
+        action = '/module.php/consent/getconsent.php' if number >= services.ssp_modules \
+            else '/module.php/stand-in/module' + str(number) + '.php'
+        self.__page(200, 'simpleSAMLphp module ' + str(number),
+                    SSP_MODULE_TMPL.substitute(action=action, state='stand-in-state', number=number), banner=True)
+
+    def __oidc_authorize(self, services, query, form):
+        if self.command == 'POST':
+            return self.__redirect(services.landing_url(), status=303)
+        self.__page(200, 'Approve Access', OIDC_CONSENT_TMPL.substitute(action='/oidc/authorize'), banner=True)
+
+    def __auto_submit(self, action, field, value):
+        self.__page(200, 'Working...', AUTO_SUBMIT_TMPL.substitute(action=action, field=field, value=value,
+                                                                   relay_state='stand-in'),
+                    onload=' onload="document.forms[0].submit()"')
+
+    def __client_storage(self, title, action):
+        self.__page(200, title, IDP_CLIENT_STORAGE_TMPL.substitute(action=action), onload=' onload="doLoad()"')
+
+    def __cookie(self, name):
+        jar = cookies.SimpleCookie(self.headers.get('Cookie', ''))
+        return jar[name].value if name in jar else None
+
+    def __redirect(self, location, status=302):
+        self.send_response(status)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def __page(self, status, title, content, banner=False, onload='', headers=None):
+        body = PAGE_TMPL.substitute(title=escape(title), content=content, onload=onload,
+                                    banner=COOKIE_BANNER if banner else '')
+        self.__send(status, body.encode(), 'text/html; charset=utf-8', headers)
+
+    def __send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
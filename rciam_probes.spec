@@ -31,6 +31,7 @@ Requires: python3-setuptools
 Requires: logrotate
 Requires: firefox
 Requires: python3-selenium
+Requires: python3-pillow
 
 %description
 This package includes probes for RCIAM.
@@ -79,6 +80,9 @@ install --directory -m 755 %{buildroot}%{_localstatedir}/log/%{name}
 # Copy the log rotate configuration
 install --directory -m 755 %{buildroot}%{_sysconfdir}/%{logrotate_dir}/
 cp -r extras/%{logrotate_dir}/ %{buildroot}%{_sysconfdir}
+# Copy the systemd unit of the browser daemon
+install --directory -m 755 %{buildroot}%{_unitdir}
+cp extras/systemd/checklogind.service %{buildroot}%{_unitdir}
 
 %clean
 rm -rf $RPM_BUILD_ROOT
@@ -98,6 +102,8 @@ rm -rf $RPM_BUILD_ROOT
 # logrotate
 %attr(0755,root,root) %dir %{_sysconfdir}/%{logrotate_dir}/
 %attr(0644,root,root) %{_sysconfdir}/%{logrotate_dir}/%{name}
+# browser daemon
+%attr(0644,root,root) %{_unitdir}/checklogind.service
 # documentation
 %doc README.md
 %license LICENSE
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+from contextlib import contextmanager
+
+# Slim version comes with no Selenium and no firefox. Only checks that need no browser can run
+try:
+    from selenium.common.exceptions import NoAlertPresentException, WebDriverException
+except ImportError:
+    class NoAlertPresentException(Exception):
+        pass
+
+    class WebDriverException(Exception):
+        pass
+
+from rciam_probes.probes.checkhealth.checkhealth import RciamHealthCheck, create_browser
+from rciam_probes.probes.checkhealth.checkhealth import parse_arguments as parse_check_arguments
+from rciam_probes.shared.enums import NagiosStatusCode, ParamDefaults
+
+"""Wipe cookies, storage, caches and HTTP auth state of every site. Runs in the chrome(privileged) context"""
+CLEAR_BROWSER_DATA_JS = """
+var done = arguments[arguments.length - 1];
+Services.clearData.deleteData(Ci.nsIClearDataService.CLEAR_ALL, function(failedFlags) {
+    done(failedFlags === 0);
+});
+"""
+
+
+def reset_browser(browser):
+    """
+    Bring a browser back to a clean state so that the next check shares nothing with the previous one
+    :param browser: Webdriver object of Firefox agent
+    :type browser: webdriver.Firefox
+
+    :raises WebDriverException: if the browser could not be reset
+    """
+    try:
+        browser.switch_to.alert.dismiss()
+    except NoAlertPresentException:
+        pass
+    # Keep only one window open
+    for handle in browser.window_handles[1:]:
+        browser.switch_to.window(handle)
+        browser.close()
+    browser.switch_to.window(browser.window_handles[0])
+    browser.get('about:blank')
+    with browser.context(browser.CONTEXT_CHROME):
+        cleared = browser.execute_async_script(CLEAR_BROWSER_DATA_JS)
+    if not cleared:
+        raise WebDriverException('Browser data were not cleared')
+    # Drop the requests captured by selenium-wire and the capture of the previous check
+    del browser.requests
+    del browser.request_interceptor
+    del browser.response_interceptor
+    del browser.scopes
+
+
+class BrowserPool:
+    """
+    A fixed size pool of warm, headless browsers. Every browser is reset after each use and recycled
+    after max_uses checks or whenever the reset fails.
+    """
+    __args = None
+    __logger = None
+    __max_uses = None
+    __idle = None
+    __uses = None
+    __lock = None
+
+    def __init__(self, args, size, max_uses=ParamDefaults.DAEMON_MAX_USES.value, logger=None):
+        """
+        :param args: arguments used to start the browsers(firefox, geckodriver, console, log)
+        :type args: ArgumentParser
+
+        :param size: number of browsers in the pool
+        :type size: int
+
+        :param max_uses: number of checks a browser serves before it gets replaced
+        :type max_uses: int
+
+        :param logger: Logger object
+        :type logger: Logger
+        """
+        self.__args = args
+        self.__logger = logger
+        self.__max_uses = max_uses
+        self.__idle = queue.Queue()
+        self.__uses = {}
+        self.__lock = threading.Lock()
+        # Browsers are started lazily. An empty slot is a None entry
+        for _ in range(size):
+            self.__idle.put(None)
+
+    def warm_up(self):
+        """Start every browser of the pool now instead of on first use"""
+        browsers = [self.acquire() for _ in range(self.__idle.qsize())]
+        for browser in browsers:
+            self.__idle.put(browser)
+
+    def acquire(self, timeout=None):
+        """
+        Lease a browser. Blocks until one is available
+        :param timeout: seconds to wait for an idle browser
+        :type timeout: float
+
+        :return: the web driver
+        :rtype: webdriver.Firefox
+
+        :raises queue.Empty: if no browser became available in time
+        """
+        browser = self.__idle.get(timeout=timeout)
+        if browser is None:
+            try:
+                browser = create_browser(self.__args)
+            except Exception:
+                # Give the slot back so that the pool does not shrink
+                self.__idle.put(None)
+                raise
+            with self.__lock:
+                self.__uses[id(browser)] = 0
+            if self.__logger is not None:
+                self.__logger.info('Browser started')
+        return browser
+
+    def release(self, browser):
+        """
+        Reset the browser and give it back to the pool. Broken or worn out browsers are replaced
+        :param browser: the web driver returned from acquire
+        :type browser: webdriver.Firefox
+        """
+        with self.__lock:
+            self.__uses[id(browser)] += 1
+            worn_out = self.__uses[id(browser)] >= self.__max_uses
+        try:
+            if worn_out:
+                raise WebDriverException('Browser reached the maximum number of uses')
+            reset_browser(browser)
+        except Exception as e:
+            if self.__logger is not None:
+                self.__logger.warning('Recycle browser: ' + str(e))
+            self.__discard(browser)
+            browser = None
+        self.__idle.put(browser)
+
+    @contextmanager
+    def lease(self, timeout=None):
+        """
+        Context manager around acquire and release
+        :param timeout: seconds to wait for an idle browser
+        :type timeout: float
+        """
+        browser = self.acquire(timeout)
+        try:
+            yield browser
+        finally:
+            self.release(browser)
+
+    def close(self):
+        """Quit all the idle browsers"""
+        while True:
+            try:
+                browser = self.__idle.get_nowait()
+            except queue.Empty:
+                break
+            if browser is not None:
+                self.__discard(browser)
+
+    def __discard(self, browser):
+        """Quit the browser and forget about it"""
+        with self.__lock:
+            self.__uses.pop(id(browser), None)
+        try:
+            browser.quit()
+        except Exception as e:
+            if self.__logger is not None:
+                self.__logger.warning('Browser quit failed: ' + str(e))
+
+
+def run_pooled_check(pool, check_args, logger, session=None):
+    """
+    Run one login check on a browser leased from the pool. Checks that need no browser run without a lease
+    :param pool: the browser pool
+    :type pool: BrowserPool
+
+    :param check_args: checklogin command line arguments
+    :type check_args: list
+
+    :param logger: Logger object
+    :type logger: Logger
+
+    :param session: requests session shared between the checks. A new one per check if not provided
+    :type session: requests.Session
+
+    :return: value, value type, NagiosStatusCode exit code and the duration of every login stage
+    :rtype: (float|str, str, int, dict)
+    """
+    try:
+        check_opts = parse_check_arguments(check_args)
+    except SystemExit:
+        # argparse exits on invalid arguments
+        return "State " + NagiosStatusCode.UNKNOWN.name + "(Invalid arguments)", '-', \
+               NagiosStatusCode.UNKNOWN.value, {}
+    # Data pulled from an external source and the http engine need no browser
+    if check_opts.inlocation is not None or check_opts.engine != 'browser':
+        check = RciamHealthCheck(check_args, logger=logger, session=session)
+        return check.evaluate_login() + (check.stage_timings(),)
+
+    try:
+        with pool.lease() as browser:
+            check = RciamHealthCheck(check_args, browser=browser, logger=logger, session=session)
+            msg_value, msg_vtype, code = check.evaluate_login()
+    except Exception as e:
+        # Browser failed to start. The check itself never raises
+        logger.critical('Browser not available: ' + str(e))
+        return "State " + NagiosStatusCode.UNKNOWN.name + "(Browser not available)", '-', \
+               NagiosStatusCode.UNKNOWN.value, {}
+    return msg_value, msg_vtype, code, check.stage_timings()
@@ -2,91 +2,187 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import json
 import os
 import re
+import socket
 import time as t
 from urllib.parse import *
 
-# Slim version comes with no Selenium and no firefox
+# Slim version comes with no Selenium and no firefox. The web driver itself is imported by import_webdriver()
 try:
-    from seleniumwire import webdriver
     from selenium.common.exceptions import *
-    from selenium.webdriver.common.keys import Keys
-    from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
-    from selenium.webdriver.firefox.firefox_profile import FirefoxProfile
 except ImportError:
     has_selenium = False
+
+    # Stand-ins that keep the exception handling of the probe working without Selenium, e.g. with the http engine
+    class TimeoutException(Exception):
+        pass
+
+    class ErrorInResponseException(Exception):
+        pass
 else:
     has_selenium = True
 
 from json.decoder import JSONDecodeError
 
+from rciam_probes.probes.checkhealth.httplogin import HttpFlowTimeout, RciamHttpLogin
 from rciam_probes.shared.authentication import *
+from rciam_probes.shared.cache import HttpCache, IdpSessionCache
+from rciam_probes.shared.discovery import ThissDiscovery, is_thiss_url
 # import methods from the lib directory
 from rciam_probes.shared.enums import *
+from rciam_probes.shared.history import history_size, history_stats, read_history, stale_window
+from rciam_probes.shared.interceptors import LOGIN_UI_DOMAINS, RequestRing, ResourcePolicy, capture_scopes
+from rciam_probes.shared.results import lookup_results
 from rciam_probes.shared.templates import *
+from rciam_probes.shared.trace import TRACE_FORMATS, TraceStore
 from rciam_probes.shared.utils import *
+from rciam_probes.shared.waits import ELEMENT_INTERACTABLE_JS, PageWait
+
+"""The page shows the cookie policy banner"""
+HAS_COOKIE_BANNER_JS = "return document.getElementById('cookies') !== null;"
+
+"""Action of the first form of the page, null if there is no form"""
+FIRST_FORM_ACTION_JS = """
+var form = document.querySelector('form');
+return form ? form.getAttribute('action') : null;
+"""
+
+"""Discovery Service type: thiss, keycloak or ssp"""
+DISCO_TYPE_JS = """
+if (document.getElementById('searchinput')) return 'thiss';
+if (document.querySelector('.login-pf-page') && document.getElementById('kc-header')) return 'keycloak';
+return 'ssp';
+"""
+
+"""
+Where a cached IdP session led the flow: 'login' if the IdP asks for the credentials again, 'consent' if it shows
+its consent page, 'passed' once the proxy modules, the OIDC consent or the landing page arguments[0] show up
+"""
+IDP_SESSION_OUTCOME_JS = ELEMENT_INTERACTABLE_JS + """
+if (interactable(document.getElementById('username'))) return 'login';
+if (interactable(document.querySelector("form [type='submit'][name*='proceed']"))) return 'consent';
+if (interactable(document.getElementById('yesbutton'))
+    || interactable(document.querySelector("form [type='submit'][value='Authorise']"))) return 'passed';
+if (document.readyState === 'complete' && window.location.href.indexOf(arguments[0]) === 0) return 'passed';
+return null;
+"""
+
+"""[name, value] of every user attribute listed by the simplesamlPHP dummy SP"""
+USER_ATTRIBUTES_JS = """
+var table = document.getElementById('table_with_attributes');
+if (!table) return [];
+var attributes = [];
+table.querySelectorAll('tr').forEach(function(row) {
+    var columns = row.querySelectorAll('td');
+    var name = columns.length > 1 ? columns[0].querySelector('tt') : null;
+    if (name) attributes.push([name.textContent, columns[1].textContent]);
+});
+return attributes;
+"""
 
 
 class RciamHealthCheck:
     __browser = None
+    __owns_browser = True
     __last_url = None
     __cached_cookies = None
-    __options = None
-    __profile = None
     __wait = None
+    __page_wait = None
     __start_time = None
     __args = None
+    __raw_args = None
     __nagios_msg = None
     __logger = None
-    __firefox_binary = None
-    __geckodriver_binary = None
+    __stages = None
+    __request_ring = None
+    __resource_policy = None
+    __idp_session = None
+    __idp_login_url = None
+    __detach_snapshots = False
+    __session = None
+
+    def __init__(self, args=sys.argv[1:], browser=None, logger=None, session=None):
+        """
+        Initialize
+        :param args: list of arguments
+        :type args: list
+
+        :param browser: A warm web driver to run the flow with. The caller keeps ownership, it will not be quit
+        :type browser: webdriver.Firefox
+
+        :param logger: Logger object. If not provided one is configured from the arguments
+        :type logger: Logger
 
-    def __init__(self, args=sys.argv[1:]):
-        """Initialize"""
+        :param session: requests session whose connections are reused, e.g. shared between the checks of a runner.
+                        The http engine keeps its cookies apart
+        :type session: requests.Session
+        """
+        self.__raw_args = list(args)
+        self.__session = session
         self.__args = parse_arguments(args)
+        self.__stages = {}
 
         # configure the logger
-        self.__logger = configure_logger(self.__args)
-        # We do not need to create a web object if we are fetching the data from a url
-        if has_selenium == True and self.__args.inlocation is None:
+        self.__logger = logger if logger is not None else configure_logger(self.__args)
+        if browser is not None:
+            import_webdriver()
+            self.__browser = browser
+            self.__owns_browser = False
+            self.__wait = WebDriverWait(self.__browser, self.__args.timeout, poll_frequency=self.__args.poll)
+            self.__page_wait = PageWait(self.__browser, self.__args.timeout, self.__args.poll)
+            self.__init_capture()
+        # We do not need to create a web object if we are fetching the data from a url,
+        # if a browser daemon runs the flow for us or if the flow runs with plain HTTP requests
+        elif has_selenium == True and self.__args.inlocation is None and self.__args.daemon_socket is None \
+                and self.__args.engine == 'browser':
             # configure the web driver
             self.__init_browser()
 
     def __init_browser(self):
         """ configure the web driver """
-        self.__options = webdriver.FirefoxOptions()
-        self.__options.headless = True
-        self.__options.accept_insecure_certs = True
-        self.__geckodriver_binary = self.__args.geckodriver
-        self.__firefox_binary = FirefoxBinary(self.__args.firefox)
-        # Set firefox profile
-        self.__profile = webdriver.FirefoxProfile()
-        firefox_profile(self.__profile)
-        if self.__browser is not None:
-            self.__browser.close()
-
-        if self.__args.console:
-            self.__browser = webdriver.Firefox(options=self.__options,
-                                               firefox_binary=self.__firefox_binary,
-                                               firefox_profile=self.__profile,
-                                               executable_path=self.__geckodriver_binary,
-                                               log_path=os.path.devnull)
-            self.__browser.set_window_size(1920, 1080)
+        self.__browser = create_browser(self.__args)
+        self.__wait = WebDriverWait(self.__browser, self.__args.timeout, poll_frequency=self.__args.poll)
+        self.__page_wait = PageWait(self.__browser, self.__args.timeout, self.__args.poll)
+        self.__init_capture()
+
+    def __init_capture(self):
+        """
+        Capture only the responses of the hosts the flow evaluates and keep just their status, URL and timing
+        in a bounded ring. Nothing else is stored by selenium-wire
+        """
+        flow_urls = self.__args.identity.split(',') + [self.__args.sp, self.__args.rs]
+        scopes = capture_scopes([self.__args.hostname], flow_urls)
+        if self.__args.block_resources:
+            # Every request has to pass through the interceptor to be blocked, the scopes would let them by.
+            # The ring drops the responses of the other hosts instead
+            del self.__browser.scopes
+            self.__request_ring = RequestRing(scopes=scopes)
+            self.__resource_policy = ResourcePolicy([self.__args.hostname]
+                                                    + [urlparse(url).netloc for url in flow_urls if url],
+                                                    (self.__args.allow_domains or '').split(','),
+                                                    (self.__args.deny_domains or '').split(','))
+            self.__browser.request_interceptor = self.__filter_request
         else:
-            self.__browser = webdriver.Firefox(options=self.__options,
-                                               firefox_binary=self.__firefox_binary,
-                                               firefox_profile=self.__profile,
-                                               executable_path=self.__geckodriver_binary,
-                                               log_path=self.__args.log)
-            self.__browser.set_window_size(1920, 1080)
-        self.__wait = WebDriverWait(self.__browser, self.__args.timeout)
+            self.__request_ring = RequestRing()
+            self.__browser.scopes = scopes
+            self.__browser.request_interceptor = self.__request_ring.record_sent
+        self.__browser.response_interceptor = self.__request_ring.record
+
+    def __filter_request(self, request):
+        """selenium-wire request interceptor. Block the request or time it"""
+        if self.__resource_policy.filter(request):
+            self.__request_ring.record_sent(request)
+
+    def __debug_page(self):
+        """Log the title and the url of the current page. Both are WebDriver round trips, skipped unless debugging"""
+        if self.__logger.isEnabledFor(LoggingLevel.debug.value):
+            self.__logger.debug('%s(%s)', self.__browser.title, self.__browser.current_url)
 
     def __hide_cookie_policy(self):
         """Hide the cookie policy banner"""
-        cookie_soup = BeautifulSoup(self.__browser.page_source, 'html.parser')
-        cookie_div = cookie_soup.find(id='cookies')
-        if cookie_div:
+        if self.__browser.execute_script(HAS_COOKIE_BANNER_JS):
             self.__wait.until(EC.element_to_be_clickable((By.ID, "js-accept-cookies")))
             cookie_banner = self.__browser.find_element_by_id("cookies")
             self.__browser.execute_script("arguments[0].setAttribute('style','display: none;')", cookie_banner)
@@ -94,14 +190,9 @@ class RciamHealthCheck:
             self.__wait.until(EC.invisibility_of_element_located((By.ID, 'cookies')))
 
     def __wait_for_spinner(self):
-        """Wait for the loading spinner to disappear"""
-        self.__wait.until(EC.presence_of_element_located((By.TAG_NAME, "body")))
+        """Wait for the page to load and the loading spinner to disappear"""
         try:
-            if self.__browser.find_element_by_class_name('loader-container'):
-                self.__wait.until(EC.invisibility_of_element_located((By.CLASS_NAME, 'loader-container')))
-        except NoSuchElementException:
-            self.__logger.warning('No known loader found.Wait for 3s and resume.')
-            t.sleep(3)
+            self.__page_wait.page_ready()
         except TimeoutException as te:
             # Throw the exception back to the main thread to catch
             raise Exception from te
@@ -111,17 +202,14 @@ class RciamHealthCheck:
         This method iterates over the user attributes fetched by the proxy. It only applies to
         dummy SPs created by simplesamlPHP
         """
-        spSoup = BeautifulSoup(self.__browser.page_source, 'html.parser')
-        user_attributes = spSoup.find(id='table_with_attributes').find_all('tr')
-        # todo: Check if we release all the attributes. Attributes are in columns[0].find('tt').text
-        for row in user_attributes:
-            columns = row.find_all('td')
-            self.__logger.info("%s(Attribute) => %s" % (columns[0].find('tt').text, columns[1].text))
+        # todo: Check if we release all the attributes
+        for name, value in self.__browser.execute_script(USER_ATTRIBUTES_JS):
+            self.__logger.info("%s(Attribute) => %s" % (name, value))
 
     def __sp_redirect_disco_n_click(self):
         """Discovery Service View"""
         self.__browser.get(self.__args.sp)
-        evaluate_response_status(self.__browser, self.__args, self.__logger)
+        evaluate_response_status(self.__request_ring, self.__args, self.__logger)
 
         if self.__args.skip_idp_discovery:
             self.__logger.debug('Skipping IdP discovery page')
@@ -129,7 +217,7 @@ class RciamHealthCheck:
 
         # Detect the discovery type (thiss, keycloak, or ssp)
         disco_type = self.__detect_disco_type()
-        self.__logger.debug(f'Discovery Service type detected: {disco_type}')
+        self.__logger.debug('Discovery Service type detected: %s', disco_type)
 
         # In case I have a list of IdPs
         idp_list = self.__args.identity.split(',')
@@ -140,10 +228,10 @@ class RciamHealthCheck:
             if disco_type == "ssp":
                 for idp in idp_list:
                     # Log the title of the view
-                    self.__logger.debug(self.__browser.title)
+                    self.__debug_page()
                     # URL-encode IdP entityID
                     idp_entity_id_url_enc = quote(idp, safe='')
-                    self.__logger.debug('Safe URL IdP entity ID: ' + idp_entity_id_url_enc)
+                    self.__logger.debug('Safe URL IdP entity ID: %s', idp_entity_id_url_enc)
                     selector_callable = "a[href*='%s']" % (idp_entity_id_url_enc)
                     # Find the hyperlink
                     self.__wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, selector_callable)))
@@ -156,6 +244,16 @@ class RciamHealthCheck:
                     # Select IdP defined in the params
                     self.__browser.find_element_by_css_selector(selector_callable).click()
 
+            # Resolve the IdP through the thiss.io json API and skip its search page
+            elif disco_type == "thiss" and self.__args.thiss_api:
+                thiss = ThissDiscovery(self.__args.thiss_api, self.__args.timeout, self.__session, self.__logger)
+                for i, idp in enumerate(idp_list):
+                    if idp_name_list and i < len(idp_name_list):
+                        search_term = idp_name_list[i]
+                    else:
+                        search_term = urlparse(idp).hostname
+                    self.__browser.get(thiss.select(self.__browser.current_url, idp, search_term))
+
             # Handle thiss.io discovery service
             elif disco_type == "thiss":
                 for i, idp in enumerate(idp_list):
@@ -164,7 +262,7 @@ class RciamHealthCheck:
                     else:
                         search_term = urlparse(idp).hostname
 
-                    self.__logger.debug(f'Searching for IdP: {search_term}')
+                    self.__logger.debug('Searching for IdP: %s', search_term)
                     search_box = self.__browser.find_element(By.ID, "searchinput")
                     # Ensure the element is clickable or interactable
                     self.__wait.until(EC.element_to_be_clickable((By.ID, "searchinput")))
@@ -191,14 +289,11 @@ class RciamHealthCheck:
                         # Fallback to idp if no hostname
                         search_term = urlparse(idp).hostname or idp
 
-                    self.__logger.debug(f'Processing IdP {i+1}/{len(idp_list)}: {idp}, search_term: {search_term}')
-                    t.sleep(5)  # Initial delay for page loading
-                    self.__logger.debug(f'Searching for IdP: {search_term}')
-
-                    # Locate the search box
-                    search_box = self.__browser.find_element(By.ID, "kc-providers-filter")
-                    # Ensure the element is clickable or interactable
-                    self.__wait.until(EC.element_to_be_clickable((By.ID, "kc-providers-filter")))
+                    self.__logger.debug('Processing IdP %d/%d: %s, search_term: %s',
+                                        i + 1, len(idp_list), idp, search_term)
+                    # Locate the search box as soon as the page renders it
+                    search_box = self.__page_wait.clickable('#kc-providers-filter')
+                    self.__logger.debug('Searching for IdP: %s', search_term)
                     search_box.clear()
                     search_box.send_keys(search_term)
                     self.__logger.debug("Typed search term into kc-providers-filter")
@@ -211,7 +306,9 @@ class RciamHealthCheck:
                             self.__logger.debug("Spinner hidden")
                         self.__wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, "a.pf-c-button.kc-social-item")))
                         elements = self.__browser.find_elements(By.CSS_SELECTOR, "a.pf-c-button.kc-social-item")
-                        self.__logger.debug(f"Found {len(elements)} IdP buttons: {[e.text for e in elements]}")
+                        if self.__logger.isEnabledFor(LoggingLevel.debug.value):
+                            # Every text is a WebDriver round trip
+                            self.__logger.debug('Found %d IdP buttons: %s', len(elements), [e.text for e in elements])
                     except (NoSuchElementException, TimeoutException) as e:
                         self.__logger.error(f"Failed to load IdP list for '{idp}' after searching '{search_term}': {str(e)}")
                         raise RuntimeError("Keycloak IdP list not loaded")
@@ -221,11 +318,12 @@ class RciamHealthCheck:
                     try:
                         self.__wait.until(EC.element_to_be_clickable((By.XPATH, result_selector)))
                         self.__browser.find_element(By.XPATH, result_selector).click()
-                        self.__logger.debug(f"Clicked IdP: {search_term}")
+                        self.__logger.debug('Clicked IdP: %s', search_term)
                         break  # Exit after successful click (single login intent)
                     except (NoSuchElementException, TimeoutException) as e:
                         self.__logger.error(f"Could not find IdP '{idp}' after searching '{search_term}' in Keycloak: {str(e)}")
-                        self.__logger.debug(f"Page source: {self.__browser.page_source[:1000]}")
+                        if self.__logger.isEnabledFor(LoggingLevel.debug.value):
+                            self.__logger.debug('Page source: %s', self.__browser.page_source[:1000])
                         raise RuntimeError(f"IdP '{idp}' not found in Keycloak discovery service")
 
             else:
@@ -236,19 +334,10 @@ class RciamHealthCheck:
 
     def __detect_disco_type(self):
         """Detect whether the discovery type is thiss.io, Keycloak or SimpleSAMLphp (default)."""
-        try:
-            # Check for elements unique to thiss.io
-            self.__browser.find_element(By.ID, "searchinput")
+        # thiss.io has a #searchinput, Keycloak a .login-pf-page and a #kc-header
+        if is_thiss_url(self.__browser.current_url):
             return "thiss"
-        except NoSuchElementException:
-            try:
-                # Check for Keycloak (login-pf-page and kc-header)
-                if (self.__browser.find_element(By.CLASS_NAME, "login-pf-page") and
-                    self.__browser.find_element(By.ID, "kc-header")):
-                    return "keycloak"
-            except NoSuchElementException:
-                # Fallback to SimpleSAMLphp
-                return "ssp"
+        return self.__browser.execute_script(DISCO_TYPE_JS)
 
     def __accept_all_ssp_modules(self):
         """
@@ -263,10 +352,9 @@ class RciamHealthCheck:
                 self.__wait.until(EC.presence_of_element_located((By.ID, "cookies")))
                 self.__wait.until(EC.element_to_be_clickable((By.ID, "yesbutton")))
                 # Log the title of the view
-                self.__logger.debug(self.__browser.title)
+                self.__debug_page()
                 # find if this is the consent page
-                soup = BeautifulSoup(self.__browser.page_source, 'html.parser')
-                ssp_module_action = soup.find('form').get('action')
+                ssp_module_action = self.__browser.execute_script(FIRST_FORM_ACTION_JS) or ''
                 if "getconsent.php" in ssp_module_action:
                     ssp_modules = False
                 # Now click yes on the form and proceed
@@ -277,7 +365,7 @@ class RciamHealthCheck:
                     continue_btn.click()
                     self.__cached_cookies = self.__browser.get_cookies()
             except TimeoutException:
-                evaluate_response_status(self.__browser, self.__args, self.__logger)
+                evaluate_response_status(self.__request_ring, self.__args, self.__logger)
 
                 self.__logger.warning('No simplesamlPHP modules found. Continue...')
                 ssp_modules = False
@@ -301,7 +389,7 @@ class RciamHealthCheck:
             # todo: Revisit the implementation approach if there is a solution with browser drivers
             try:
                 self.__wait.until(EC.alert_is_present())
-                self.__logger.debug(self.__browser.current_url)
+                self.__debug_page()
                 alert = self.__browser.switch_to.alert
                 alert.send_keys(self.__args.username)
                 alert.send_keys(Keys.TAB)
@@ -322,7 +410,8 @@ class RciamHealthCheck:
                 # Load the cookies from Identity Provider authentication
                 browser_load_cookies(self.__browser,
                                      self.__cached_cookies,
-                                     self.__last_url)
+                                     self.__last_url,
+                                     self.__args.poll)
                 # Retry with proxy
                 self.__browser.get(self.__last_url)
         else:
@@ -336,14 +425,63 @@ class RciamHealthCheck:
             password.send_keys(self.__args.password)
 
             # Log the title of the view
-            self.__logger.debug(self.__browser.title)
+            self.__debug_page()
             self.__wait.until(EC.element_to_be_clickable((By.CSS_SELECTOR, "button[type='submit']")))
             # Cache cookies
             self.__last_url = self.__browser.current_url
+            self.__idp_login_url = self.__last_url
             self.__cached_cookies = self.__browser.get_cookies()
             # Accept the form
             self.__browser.find_element_by_css_selector("form button[type='submit']").click()
 
+    def __idp_session_sso(self):
+        """
+        The IdP leg with the cached IdP session. The IdP signs the user in with the session cookies, unless the
+        session expired on its side. Then the cached session is dropped and the user authenticates in full
+
+        :raises TimeoutException: if the flow neither asked for the credentials nor came back from the IdP
+        """
+        outcome = self.__page_wait.until_js(IDP_SESSION_OUTCOME_JS, self.__landing_page().strip('/'),
+                                            message='Single sign-on with the cached IdP session failed')
+        if outcome == 'login':
+            self.__logger.info('The cached IdP session expired. Authenticate to the IdP')
+            self.__idp_session.discard(self.__args.identity, self.__args.username)
+            self.__idp_login_url = None
+            self.__idp_authenticate()
+
+    def __restore_idp_session(self):
+        """
+        Load the cached IdP session cookies into the browser
+        :return: True if the flow can skip the IdP authentication
+        :rtype: bool
+        """
+        session = self.__idp_session.load(self.__args.identity, self.__args.username)
+        if session is None:
+            return False
+        url, cookies = session
+        try:
+            if browser_restore_cookies(self.__browser, cookies, url) == 0:
+                return False
+        except WebDriverException as e:
+            self.__logger.warning('Could not restore the cached IdP session: ' + str(e))
+            return False
+        self.__logger.debug('Restored the cached IdP session of %s', url)
+        return True
+
+    def __save_idp_session(self):
+        """Keep the IdP session cookies of a full login for the next runs"""
+        if self.__idp_login_url is None:
+            return
+        try:
+            parsed_url = urlparse(self.__idp_login_url)
+            self.__browser.get(parsed_url.scheme + '://' + parsed_url.netloc + '/robots.txt')
+            cookies = self.__browser.get_cookies()
+        except WebDriverException as e:
+            self.__logger.warning('Could not read the IdP session cookies: ' + str(e))
+            return
+        self.__idp_session.save(self.__args.identity, self.__args.username, self.__idp_login_url, cookies)
+        self.__logger.debug('Cached the IdP session of %s', self.__idp_login_url)
+
     def __oidc_server_consent_page(self):
         """
         If the OIDC server prompts for explicit consent in order to release the attributes
@@ -352,22 +490,21 @@ class RciamHealthCheck:
         - OIDC MitreId consent pages have element: input[type='submit'][value='Authorise']
         """
         try:
-            regex_domain = r"^https?:[\/]{2}(.*?)[\/]{1}.*$"
-            domain = re.search(regex_domain, self.__args.identity).group(1)
-            # Only wait at most 5 seconds.
-            WebDriverWait(self.__browser, self.__args.timeout).until(lambda driver: self.__browser.current_url.strip('/').find(domain))
-            WebDriverWait(self.__browser, self.__args.timeout).until(
-                EC.element_to_be_clickable((By.CSS_SELECTOR, "form [type='submit'][value='Authorise']")))
+            # Stop waiting as soon as the SP landing page loads
+            consent_btn = self.__page_wait.clickable_unless_passed("form [type='submit'][value='Authorise']",
+                                                                   [self.__landing_page()])
+            if consent_btn is None:
+                raise TimeoutException('Landed on the Service Provider')
             # Log the title of the view
-            self.__logger.debug(self.__browser.title)
+            self.__debug_page()
             # Cache cookies
             self.__cached_cookies = self.__browser.get_cookies()
             self.__last_url = self.__browser.current_url
             # Accept the form
-            self.__browser.find_element_by_css_selector("form [type='submit'][value='Authorise']").click()
+            consent_btn.click()
             # Get the source code from the page and check if authentication failed
         except TimeoutException:
-            evaluate_response_status(self.__browser, self.__args, self.__logger)
+            evaluate_response_status(self.__request_ring, self.__args, self.__logger)
             self.__logger.warning('OIDC Server has no consent page. Continue...')
 
     def __idp_shib_consent_page(self):
@@ -381,24 +518,26 @@ class RciamHealthCheck:
         try:
             regex_domain = r"^https?:[\/]{2}(.*?)[\/]{1}.*$"
             domain = re.search(regex_domain, self.__args.identity).group(1)
-            # Only wait at most 5 seconds.
-            WebDriverWait(self.__browser, self.__args.timeout).until(lambda driver: self.__browser.current_url.strip('/').find(domain))
-            WebDriverWait(self.__browser, self.__args.timeout).until(
-                EC.element_to_be_clickable((By.CSS_SELECTOR, "form [type='submit'][name*='proceed']")))
-                # EC.element_to_be_clickable((By.CSS_SELECTOR, "form [type='submit'][value='Accept']")))
+            # Stop waiting as soon as we are back to the service or the SP. Unless the IdP is hosted by the service
+            passed_urls = [self.__landing_page()]
+            if domain != self.__args.hostname:
+                passed_urls += [protocol + '://' + self.__args.hostname + '/' for protocol in ['https', 'http']]
+            consent_btn = self.__page_wait.clickable_unless_passed("form [type='submit'][name*='proceed']", passed_urls)
+            if consent_btn is None:
+                raise TimeoutException('Left the Identity Provider')
             # Log the title of the view
-            self.__logger.debug(self.__browser.title)
+            self.__debug_page()
             # Cache cookies
             self.__cached_cookies = self.__browser.get_cookies()
             self.__last_url = self.__browser.current_url
             # Accept the form
-            self.__browser.find_element_by_css_selector("form [type='submit'][name*='proceed']").click()
+            consent_btn.click()
             # self.__browser.find_element_by_css_selector("form [type='submit'][value='Accept']").click()
             # Get the source code from the page and check if authentication failed
         except TimeoutException:
             # I will try to catch the error here because not every IdP has a consent page.
             # This should not trigger false results since we filter responses by domain/host name.
-            evaluate_response_status(self.__browser, self.__args, self.__logger)
+            evaluate_response_status(self.__request_ring, self.__args, self.__logger)
             self.__logger.warning('Idp has no consent page. Continue...')
 
     def __get_attrs_checking_dummy_sps(self):
@@ -407,25 +546,25 @@ class RciamHealthCheck:
         self.__wait.until(EC.presence_of_all_elements_located((By.ID, "table_with_attributes")))
         self.__print_user_attributes()
 
+    def __landing_page(self):
+        """
+        :return: the Service Providers Home page
+        :rtype: str
+        """
+        if self.__args.rs is not None:
+            return self.__args.rs
+        return self.__args.sp
+
     def __verify_sp_home_page_loaded(self):
         """
         Verify that the Service Providers Home page loaded successfully
         :raises TimeoutException: if an element fails to load
         """
-        if self.__args.rs is not None:
-            landing_page = self.__args.rs
-        else:
-            landing_page = self.__args.sp
-        self.__wait.until(
-            lambda driver: self.__browser.current_url.strip('/').find(landing_page.strip('/')) == 0)
-        # self.__wait.until(
-        #     lambda driver: self.__browser.current_url.strip('/').find('https://testvm.agora.grnet.gr/ui') == 0)
-        self.__wait.until(EC.presence_of_all_elements_located((By.CSS_SELECTOR, "head")))
-        self.__wait.until(EC.presence_of_all_elements_located((By.CSS_SELECTOR, "title")))
-        self.__wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, "body")))
+        # One wait for the url, head, title and body
+        self.__page_wait.landing_page(self.__landing_page())
 
         # Log the title of the view
-        self.__logger.debug(self.__browser.title + "(" + self.__browser.current_url + ")")
+        self.__debug_page()
 
     def check_login(self):
         """Check the login flow"""
@@ -438,45 +577,96 @@ class RciamHealthCheck:
             del sys.argv[pass_index:pass_index + 2]
 
         self.__logger.info(' '.join([(repr(arg) if ' ' in arg else arg) for arg in sys.argv]))
+        if self.__args.daemon_socket is not None and self.__args.inlocation is None and self.__args.engine == 'browser':
+            msg_value, msg_vtype, code = self.__daemon_login()
+        else:
+            # The probe exits right after the check, the snapshot is written by a process of its own
+            self.__detach_snapshots = True
+            msg_value, msg_vtype, code = self.evaluate_login()
+
+        msg = construct_probe_msg(self.__args, msg_value, msg_vtype, code, self.__stages)
+        self.__logger.info(msg)
+        print_output(self.__args, msg, self.__logger)
+        exit(code)
+
+    def evaluate_login(self):
+        """
+        Run the login flow, or evaluate the data pulled from the external source, without exiting
+        :return: value, value type and NagiosStatusCode exit code
+        :rtype: (float|str, str, int)
+        """
         # start counting progress time
         self.__start_time = start_ticking()
+        self.__stages = {}
         try:
-            if self.__args.inlocation is None:
+            if self.__args.inlocation is None and self.__args.engine == 'http':
+                # Walk the same flow with plain HTTP requests and no browser
+                if self.__args.trace:
+                    self.__request_ring = RequestRing()
+                http_login = RciamHttpLogin(self.__args, self.__logger, self.__session, self.__request_ring)
+                self.__run_stage(LoginStage.DISCOVERY, http_login.sp_redirect_disco_n_click)
+                self.__run_stage(LoginStage.IDP_AUTHENTICATION, http_login.idp_authenticate)
+                self.__run_stage(LoginStage.IDP_CONSENT, http_login.idp_shib_consent_page)
+                self.__run_stage(LoginStage.SSP_MODULES, http_login.accept_all_ssp_modules)
+                self.__run_stage(LoginStage.OIDC_CONSENT, http_login.oidc_server_consent_page)
+                self.__run_stage(LoginStage.SP_LANDING, http_login.verify_sp_home_page_loaded)
+                msg_value = round(stop_ticking(self.__start_time), 2)
+                msg_vtype = 's'
+                code = NagiosStatusCode.OK.value
+            elif self.__args.inlocation is None:
+                idp_session_restored = False
+                if self.__args.idp_session is not None and not self.__args.basic_auth:
+                    self.__idp_session = IdpSessionCache(self.__args.idp_session, self.__args.idp_session_ttl,
+                                                         self.__logger)
+                    idp_session_restored = self.__restore_idp_session()
+                    # Loading the cookies is not part of the login
+                    self.__start_time = start_ticking()
                 # Go to Discovery Service and choose your Identity Provider
-                self.__sp_redirect_disco_n_click()
-                # Authenticate
-                self.__idp_authenticate()
+                self.__run_stage(LoginStage.DISCOVERY, self.__sp_redirect_disco_n_click)
+                # Authenticate, or sign in with the cached IdP session
+                self.__run_stage(LoginStage.IDP_AUTHENTICATION,
+                                 self.__idp_session_sso if idp_session_restored else self.__idp_authenticate)
                 # Some IdPs might request explicit consent for the transmitted attributes
                 # todo: Currently supporting only Consent pages from Shibboleth IdPs
-                self.__idp_shib_consent_page()
+                self.__run_stage(LoginStage.IDP_CONSENT, self.__idp_shib_consent_page)
                 # You came back from the Idp. Iterate over all SSP modules and press continue
-                self.__accept_all_ssp_modules()
+                self.__run_stage(LoginStage.SSP_MODULES, self.__accept_all_ssp_modules)
                 # Accept OIDC consent page if present
-                self.__oidc_server_consent_page()
+                self.__run_stage(LoginStage.OIDC_CONSENT, self.__oidc_server_consent_page)
                 # Verify that the SPs home page loaded
-                self.__verify_sp_home_page_loaded()
+                self.__run_stage(LoginStage.SP_LANDING, self.__verify_sp_home_page_loaded)
                 msg_value = round(stop_ticking(self.__start_time), 2)
                 msg_vtype = 's'
+                if self.__idp_session is not None:
+                    self.__save_idp_session()
                 # msg_value = login_health_check_nagios_tmpl.substitute(defaults_login_health_check, time=login_finished)
                 code = NagiosStatusCode.OK.value
             else:
-                raw_data_list = []
-                for out_file in construct_out_filename(self.__args, "json"):
-                    self.__logger.debug('Parse endpoint: ' + self.__args.inlocation + "/" + out_file)
-                    raw_data_list.append( get_json(self.__args.inlocation + "/" + out_file, self.__args.timeout, self.__logger))
+                cache = None
+                if self.__args.cache_dir is not None:
+                    cache = HttpCache(self.__args.cache_dir, self.__args.cache_size * 1024 * 1024, self.__logger)
+                idp_list = self.__args.identity.split(',')
+                if self.__args.results_store:
+                    raw_data_list = self.__fetch_results_store(idp_list, cache)
+                else:
+                    raw_data_list = self.__fetch_result_files(idp_list, cache)
+                history = self.__fetch_history(cache) if self.__args.history else []
 
-                code, msg_list, type_list = blk_validate_probe_data(raw_data_list)
+                code, msg_list, type_list = blk_validate_probe_data(raw_data_list, stale_window(history))
                 msg_vtype = '-' if len(type_list) > 1 else type_list.pop()
                 msg_value = ','.join(msg_list) if len(msg_list) > 1 else msg_list.pop()
-        except TimeoutException as e:
+                stats = history_stats(history)
+                if stats is not None:
+                    msg_value += login_health_check_history_tmpl.substitute(defaults_login_health_check_history,
+                                                                            **stats)
+        except (TimeoutException, HttpFlowTimeout) as e:
             msg_value = "State " + NagiosStatusCode.UNKNOWN.name + "(Request Timed out)"
             msg_vtype = '-'
             # Log print here
             code = NagiosStatusCode.UNKNOWN.value
             self.__logger.critical('TimeoutException: ' + str(e))
             if self.__browser is not None:
-                take_snapshot(self.__browser, self.__logger)
-                self.__logger.debug('Snapshot taken')
+                take_snapshot(self.__browser, self.__args, self.__logger, self.__detach_snapshots)
         except ErrorInResponseException as e:
             msg_value = "State " + NagiosStatusCode.CRITICAL.name + "(HTTP status code:)"
             msg_vtype = '-'
@@ -484,8 +674,7 @@ class RciamHealthCheck:
             code = NagiosStatusCode.CRITICAL.value
             self.__logger.critical('ErrorInResponseException: ' + str(e))
             if self.__browser is not None:
-                take_snapshot(self.__browser, self.__logger)
-                self.__logger.debug('Snapshot taken')
+                take_snapshot(self.__browser, self.__args, self.__logger, self.__detach_snapshots)
         except JSONDecodeError as e:
             msg_value = "State " + NagiosStatusCode.UNKNOWN.name
             msg_vtype = '-'
@@ -493,8 +682,7 @@ class RciamHealthCheck:
             code = NagiosStatusCode.UNKNOWN.value
             self.__logger.critical("JSON decode error.JSON invalid format or not available: " + str(e))
             if self.__browser is not None:
-                take_snapshot(self.__browser, self.__logger)
-                self.__logger.debug('Snapshot taken')
+                take_snapshot(self.__browser, self.__args, self.__logger, self.__detach_snapshots)
         except RuntimeError as e:
             msg_value = "State " + NagiosStatusCode.CRITICAL.name
             msg_vtype = '-'
@@ -502,8 +690,7 @@ class RciamHealthCheck:
             code = NagiosStatusCode.CRITICAL.value
             self.__logger.critical("Runtime Exception: " + str(e))
             if self.__browser is not None:
-                take_snapshot(self.__browser, self.__logger)
-                self.__logger.debug('Snapshot taken')
+                take_snapshot(self.__browser, self.__args, self.__logger, self.__detach_snapshots)
         except Exception as e:
             msg_value = "State " + NagiosStatusCode.CRITICAL.name
             msg_vtype = '-'
@@ -511,15 +698,173 @@ class RciamHealthCheck:
             code = NagiosStatusCode.CRITICAL.value
             self.__logger.critical('Catch All Exception: ' + str(e))
             if self.__browser is not None:
-                take_snapshot(self.__browser, self.__logger)
-                self.__logger.debug('Snapshot taken')
+                take_snapshot(self.__browser, self.__args, self.__logger, self.__detach_snapshots)
         finally:
-            if self.__browser is not None:
+            if self.__resource_policy is not None:
+                self.__logger.debug('Requests blocked: %d', self.__resource_policy.blocked)
+            # A borrowed browser goes back to its owner(e.g. the browser daemon pool)
+            if self.__browser is not None and self.__owns_browser:
                 self.__browser.quit()
-            msg = construct_probe_msg(self.__args, msg_value, msg_vtype, code)
-            self.__logger.info(msg)
-            print_output(self.__args, msg, self.__logger)
-            exit(code)
+
+        if self.__args.trace and self.__request_ring is not None \
+                and (code != NagiosStatusCode.OK.value
+                     or (msg_vtype == 's' and msg_value > self.__args.trace_threshold)):
+            self.__save_trace(msg_value, msg_vtype, code)
+        return msg_value, msg_vtype, code
+
+    def stage_timings(self):
+        """
+        Duration of every login stage of the last evaluate_login, in the order they ran. A failed stage is
+        included with the time it took to fail
+        :return: {LoginStage value: seconds}
+        :rtype: dict
+        """
+        return dict(self.__stages)
+
+    def __fetch_result_files(self, idp_list, cache):
+        """
+        Fetch the out_<key>.json file of every IdP
+        :param idp_list: the IdPs of the check
+        :type idp_list: list
+
+        :param cache: conditional GET cache or None
+        :type cache: HttpCache
+
+        :return: the data of every IdP, in the order of idp_list
+        :rtype: list
+        """
+        url_list = [self.__args.inlocation + "/" + out_file
+                    for out_file in construct_out_filename(self.__args, "json")]
+        # All the files travel over the same keep-alive connections and the whole fetch
+        # is bounded by the probe timeout
+        raw_data = {}
+        for url, data, error in get_json_concurrently(url_list, self.__args.timeout, self.__args.timeout,
+                                                      self.__logger,
+                                                      self.__session or create_http_session(len(url_list)), cache):
+            self.__logger.debug('Parse endpoint: %s', url)
+            if error is not None:
+                data = self.__missing_result(idp_list[url_list.index(url)], error)
+            raw_data[url] = data
+        return [raw_data[url] for url in url_list]
+
+    def __fetch_results_store(self, idp_list, cache):
+        """
+        Fetch the consolidated results file once and look up the result of every IdP
+        :param idp_list: the IdPs of the check
+        :type idp_list: list
+
+        :param cache: conditional GET cache or None
+        :type cache: HttpCache
+
+        :return: the data of every IdP, in the order of idp_list
+        :rtype: list
+        """
+        url = self.__args.inlocation + "/" + ParamDefaults.RESULTS_FILE.value
+        self.__logger.debug('Parse endpoint: %s', url)
+        try:
+            document = get_json(url, self.__args.timeout, self.__logger, self.__session, cache)
+        except requests.exceptions.Timeout as e:
+            self.__logger.critical(url + ' Timeout: ' + str(e))
+            return [self.__missing_result(idp, 'Request Timed out') for idp in idp_list]
+        except Exception as e:
+            self.__logger.critical(url + ' ' + str(e))
+            return [self.__missing_result(idp, 'Not available') for idp in idp_list]
+        return [data if data is not None else self.__missing_result(idp, 'Not available')
+                for idp, data in zip(idp_list, lookup_results(document, self.__args))]
+
+    def __fetch_history(self, cache):
+        """
+        Fetch the latency history of the check. The file has a fixed size and only the latest --history runs are read
+        :param cache: conditional GET cache or None
+        :type cache: HttpCache
+
+        :return: the latest runs, oldest first. Empty if the history is not available
+        :rtype: list
+        """
+        url = self.__args.inlocation + "/" + history_filename(self.__args)
+        try:
+            if cache is not None:
+                with cache.get(url, self.__args.timeout, self.__session).open() as body:
+                    data = body.read()
+            else:
+                requests.packages.urllib3.disable_warnings()
+                response = (self.__session or requests).get(url, verify=False, timeout=self.__args.timeout)
+                response.raise_for_status()
+                data = response.content
+        except Exception as e:
+            self.__logger.warning(url + ' History not available: ' + str(e))
+            return []
+        return read_history(data, self.__args.history)
+
+    def __missing_result(self, idp, error):
+        """
+        :return: the data of an IdP whose result could not be fetched
+        :rtype: dict
+        """
+        return {'date': None, 'value': None, 'vtype': '', 'idp': idp, 'xcode': NagiosStatusCode.UNKNOWN.value,
+                'error': error}
+
+    def __run_stage(self, stage, stage_method):
+        """
+        Run one stage of the login flow and keep its duration
+        :param stage: the stage
+        :type stage: LoginStage
+
+        :param stage_method: the method implementing the stage
+        :type stage_method: callable
+        """
+        if self.__request_ring is not None:
+            self.__request_ring.stage = stage.value
+        stage_start = t.monotonic()
+        try:
+            stage_method()
+        finally:
+            self.__stages[stage.value] = round(t.monotonic() - stage_start, 2)
+            self.__logger.debug('Stage %s took %ss', stage.value, self.__stages[stage.value])
+
+    def __save_trace(self, msg_value, msg_vtype, code):
+        """
+        Write the trace of the slow or failed login next to the results
+        :param msg_value: value returned from the login flow
+        :type msg_value: float|str
+
+        :param msg_vtype: value type
+        :type msg_vtype: str
+
+        :param code: NagiosStatusCode exit code
+        :type code: int
+        """
+        trace_dir = results_directory(self.__args)
+        if trace_dir is None:
+            self.__logger.warning('No trace written, --trace needs -J or --json')
+            return
+        try:
+            trace_dir.mkdir(0o755, parents=True, exist_ok=True)
+            TraceStore(trace_dir, self.__args.trace, self.__args.trace_size * 1024 * 1024,
+                       logger=self.__logger).put(self.__args, self.__request_ring,
+                                                 NagiosStatusCode(code).name + ' ' + str(msg_value) + msg_vtype)
+        except OSError as e:
+            self.__logger.warning('Cannot write the trace: ' + str(e))
+
+    def __daemon_login(self):
+        """
+        Hand the login flow over to the browser daemon listening on the local socket
+        :return: value, value type and NagiosStatusCode exit code
+        :rtype: (float|str, str, int)
+        """
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(ParamDefaults.DAEMON_TIMEOUT.value)
+                sock.connect(self.__args.daemon_socket)
+                sock.sendall((json.dumps({'args': self.__raw_args}) + '\n').encode())
+                with sock.makefile('r', encoding='utf-8') as sock_file:
+                    response = json.loads(sock_file.readline())
+            self.__stages = response.get('stages') or {}
+            return response['value'], response['vtype'], response['code']
+        except (OSError, ValueError, KeyError, AttributeError) as e:
+            self.__logger.critical('Browser daemon unavailable: ' + str(e))
+            return "State " + NagiosStatusCode.UNKNOWN.name + "(Browser daemon unavailable)", '-', \
+                   NagiosStatusCode.UNKNOWN.value
 
 
 def parse_arguments(args):
@@ -550,6 +895,13 @@ def parse_arguments(args):
     parser.add_argument('--console', '-C', dest="console",
                         help='No Value needed. The presence of the flag indicates log output in stdout',
                         action='store_true')
+    parser.add_argument('--log-queue', dest="log_queue",
+                        help='No Value needed. Log calls only queue the records and a background thread writes them '
+                             'in batches',
+                        action='store_true')
+    parser.add_argument('--syslog', dest="syslog", nargs='?', const=ParamDefaults.SYSLOG_SOCKET.value,
+                        help='Ship the log records to the syslog or log collector socket SYSLOG, a path or HOST:PORT, '
+                             'instead of the log file. Defaults to ' + ParamDefaults.SYSLOG_SOCKET.value)
     parser.add_argument('-J', dest="json",
                         help='The presence of the flag indicates probe output in /var/www/html directory, in file xxx.json',
                         action='store_true')
@@ -557,8 +909,51 @@ def parse_arguments(args):
                         help='Provide the output directory for the xxx.json file. The flag is mutually exclusive with -J.')
     parser.add_argument('--timeout', '-t', dest="timeout", help='Timeout after x amount of seconds. Defaults to 5s.',
                         type=int, default=7)
+    parser.add_argument('--poll', dest="poll", type=float, default=ParamDefaults.WAIT_POLL.value,
+                        help='Seconds between checks of the page conditions that no DOM change reports. Defaults to '
+                             + str(ParamDefaults.WAIT_POLL.value) + 's.')
     parser.add_argument('--inlocation', '-e', dest="inlocation", help='URL location to get raw monitoring data from.',
                         type=str, required=False)
+    parser.add_argument('--results-store', dest="results_store",
+                        help='With -J or --json keep the result in the consolidated results file '
+                             + ParamDefaults.RESULTS_FILE.value + ' of the output directory instead of one file per '
+                             'IdP. With --inlocation fetch the results of all the IdPs from that file in one request',
+                        action='store_true')
+    parser.add_argument('--history', dest="history", type=history_size, nargs='?', const=ParamDefaults.HISTORY_SIZE.value,
+                        help='With -J or --json record the login time of the latest HISTORY runs, defaults to '
+                             + str(ParamDefaults.HISTORY_SIZE.value) + ', in a fixed size file next to the results. '
+                             'With --inlocation report the p50, p95 and max login time of the latest HISTORY runs '
+                             'and consider the results stale after ' + str(ParamDefaults.HISTORY_STALE_RUNS.value)
+                             + ' missed runs, 30 minutes at least')
+    parser.add_argument('--trace', dest="trace", nargs='?', choices=TRACE_FORMATS, const='har',
+                        help='With -J or --json write the URL, host, status, start offset, TTFB, total time and size '
+                             'of every request of a failed login, or of one slower than --trace-threshold, grouped '
+                             'by login stage in a har, the default, or ndjson file next to the results. The browser '
+                             'engine does not measure the TTFB')
+    parser.add_argument('--trace-threshold', dest="trace_threshold", type=float,
+                        default=ParamDefaults.TRACE_THRESHOLD.value,
+                        help='Login seconds above which the trace is written. Defaults to '
+                             + str(ParamDefaults.TRACE_THRESHOLD.value) + 's.')
+    parser.add_argument('--trace-size', dest="trace_size", type=int, default=ParamDefaults.TRACE_SIZE_MB.value,
+                        help='Size bound of the trace files in MB. The oldest are removed first and none is kept '
+                             'longer than ' + str(ParamDefaults.TRACE_RETENTION.value) + ' days. Defaults to '
+                             + str(ParamDefaults.TRACE_SIZE_MB.value) + 'MB.')
+    parser.add_argument('--snapshot-dir', dest="snapshot_dir",
+                        help='Directory of the screenshots of the pages a login failed on. Defaults to ~/html/results')
+    parser.add_argument('--snapshot-interval', dest="snapshot_interval", type=int,
+                        default=ParamDefaults.SNAPSHOT_INTERVAL.value,
+                        help='Minutes between two screenshots of the service. Pages already captured are never '
+                             'captured again. Defaults to ' + str(ParamDefaults.SNAPSHOT_INTERVAL.value) + ' minutes.')
+    parser.add_argument('--snapshot-size', dest="snapshot_size", type=int,
+                        default=ParamDefaults.SNAPSHOT_SIZE_MB.value,
+                        help='Size bound of the screenshots in MB. The oldest are removed first and none is kept '
+                             'longer than ' + str(ParamDefaults.SNAPSHOT_RETENTION.value) + ' days. Defaults to '
+                             + str(ParamDefaults.SNAPSHOT_SIZE_MB.value) + 'MB.')
+    parser.add_argument('--cache-dir', dest="cache_dir",
+                        help='Cache the --inlocation data in this directory and revalidate them with ETag/Last-Modified')
+    parser.add_argument('--cache-size', dest="cache_size", type=int, default=ParamDefaults.CACHE_SIZE_MB.value,
+                        help='Size bound of the cache directory in MB. Defaults to '
+                             + str(ParamDefaults.CACHE_SIZE_MB.value) + 'MB.')
     parser.add_argument('--sp', '-s', dest="sp",
                         help='Service Provider Login Authentication Protected URL, e.g. https://example.com/ssp/module.php/core/authenticate.php'
                              '?as=example-sp',
@@ -577,10 +972,82 @@ def parse_arguments(args):
     parser.add_argument('--skip-idp-discovery', dest="skip_idp_discovery",
                         help='Skip IdP discovery if this flag is present',
                         action='store_true')
+    parser.add_argument('--idp-session', dest="idp_session",
+                        help='Cache the IdP session cookies in this directory. Later runs skip the IdP authentication '
+                             'and measure the discovery, proxy and SP legs only. Browser engine, form based logins only')
+    parser.add_argument('--idp-session-ttl', dest="idp_session_ttl", type=int,
+                        default=ParamDefaults.IDP_SESSION_TTL.value,
+                        help='Minutes a cached IdP session is reused before the next full login. Defaults to '
+                             + str(ParamDefaults.IDP_SESSION_TTL.value) + ' minutes.')
+    parser.add_argument('--block-resources', dest="block_resources",
+                        help='Abort the requests for images, fonts, media, trackers and third party scripts and style '
+                             'sheets the login does not need. Browser engine only',
+                        action='store_true')
+    parser.add_argument('--allow-domains', dest="allow_domains", type=str,
+                        help='csv list of third party domains whose scripts and style sheets are loaded with '
+                             '--block-resources, e.g. cdn.example.org. ' + ', '.join(LOGIN_UI_DOMAINS)
+                             + ' are always allowed')
+    parser.add_argument('--deny-domains', dest="deny_domains", type=str,
+                        help='csv list of domains that are never loaded with --block-resources')
+    parser.add_argument('--thiss-api', dest="thiss_api", nargs='?', const=ParamDefaults.THISS_MDQ_URL.value,
+                        help='Select the IdP on a thiss.io discovery service through the json API of its MDQ '
+                             'THISS_API instead of its search page. Defaults to ' + ParamDefaults.THISS_MDQ_URL.value
+                             + '. Required by the http engine for thiss.io')
+    parser.add_argument('--engine', dest="engine", choices=['browser', 'http'], default='browser',
+                        help='Login engine. browser drives a headless Firefox. http walks the SimpleSAMLphp/Keycloak '
+                             'discovery and form based IdP flow with plain HTTP requests. Defaults to browser.')
+    parser.add_argument('--daemon', dest="daemon_socket", nargs='?', const=ParamDefaults.DAEMON_SOCKET.value,
+                        help='Run the login flow in the warm browser daemon(checklogind) listening on this unix socket. '
+                             'Defaults to ' + ParamDefaults.DAEMON_SOCKET.value)
     parser.add_argument('--version', '-V', version='%(prog)s 1.2.14', action='version')
     return parser.parse_args(args)
 
 
+def import_webdriver():
+    """
+    Import selenium-wire and the selenium web driver modules. They take longer to import than the rest of the
+    probe, so only the checks that drive a browser import them. The http engine, --inlocation and --daemon-socket
+    checks never do
+    """
+    global webdriver, Keys, FirefoxBinary, FirefoxProfile, WebDriverWait, EC, By
+    from seleniumwire import webdriver
+    from selenium.webdriver.common.keys import Keys
+    from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
+    from selenium.webdriver.firefox.firefox_profile import FirefoxProfile
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.common.by import By
+
+
+def create_browser(args):
+    """
+    Start a headless Firefox driven by geckodriver
+    :param args: arguments retrieved from command line(firefox, geckodriver, console, log)
+    :type args: ArgumentParser
+
+    :return: the web driver
+    :rtype: webdriver.Firefox
+    """
+    import_webdriver()
+    options = webdriver.FirefoxOptions()
+    options.headless = True
+    options.accept_insecure_certs = True
+    # Set firefox profile
+    profile = webdriver.FirefoxProfile()
+    firefox_profile(profile)
+    # Redirect Geckodriver's logs to dev/null if on console mode
+    # The probe reads only the status of the responses it intercepts. Do not let selenium-wire store any request
+    browser = webdriver.Firefox(options=options,
+                                firefox_binary=FirefoxBinary(args.firefox),
+                                firefox_profile=profile,
+                                executable_path=args.geckodriver,
+                                log_path=os.path.devnull if args.console else args.log,
+                                seleniumwire_options={'request_storage': 'memory',
+                                                      'request_storage_max_size': 0})
+    browser.set_window_size(1920, 1080)
+    return browser
+
+
 def firefox_profile(firefox_profile):
     """
     Apply firefox profile configuration
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from pathlib import Path
+
+from rciam_probes.probes.checkhealth.browserpool import BrowserPool, run_pooled_check
+from rciam_probes.shared.enums import *
+from rciam_probes.shared.utils import configure_logger
+
+
+class CheckRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Serve one checklogin client. The client sends a single json line {"args": [...]} with its command line
+    arguments and receives a single json line {"value": ..., "vtype": ..., "code": ..., "stages": {...}}
+    """
+
+    def handle(self):
+        daemon = self.server.probe_daemon
+        try:
+            request = json.loads(self.rfile.readline())
+            msg_value, msg_vtype, code, stages = daemon.run_check(request['args'])
+        except (ValueError, KeyError, TypeError) as e:
+            daemon.logger.error('Invalid request: ' + str(e))
+            msg_value = "State " + NagiosStatusCode.UNKNOWN.name + "(Invalid request)"
+            msg_vtype = '-'
+            code = NagiosStatusCode.UNKNOWN.value
+            stages = {}
+        response = {'value': msg_value, 'vtype': msg_vtype, 'code': code, 'stages': stages}
+        self.wfile.write((json.dumps(response) + '\n').encode())
+
+
+class RciamBrowserDaemon:
+    """Long running daemon that runs checklogin flows on a pool of warm browsers"""
+    __args = None
+    __pool = None
+    __server = None
+    logger = None
+
+    def __init__(self, args=sys.argv[1:]):
+        self.__args = parse_arguments(args)
+        self.logger = configure_logger(self.__args)
+        self.__pool = BrowserPool(self.__args, self.__args.pool_size, self.__args.max_uses, self.logger)
+
+    def run_check(self, check_args):
+        """
+        Run one login check on a leased browser
+        :param check_args: checklogin command line arguments
+        :type check_args: list
+
+        :return: value, value type, NagiosStatusCode exit code and the duration of every login stage
+        :rtype: (float|str, str, int, dict)
+        """
+        msg_value, msg_vtype, code, stages = run_pooled_check(self.__pool, check_args, self.logger)
+        self.logger.info('Check finished with code ' + str(code))
+        return msg_value, msg_vtype, code, stages
+
+    def serve(self):
+        """Listen on the unix socket until SIGTERM or SIGINT"""
+        socket_path = Path(self.__args.socket)
+        socket_path.parent.mkdir(0o755, parents=True, exist_ok=True)
+        if socket_path.exists():
+            if socket_in_use(str(socket_path)):
+                self.logger.critical('Another daemon listens on ' + str(socket_path))
+                exit(NagiosStatusCode.CRITICAL.value)
+            socket_path.unlink()
+
+        # Only the owner of the daemon may talk to it. Credentials travel over this socket.
+        old_umask = os.umask(0o077)
+        try:
+            self.__server = socketserver.ThreadingUnixStreamServer(str(socket_path), CheckRequestHandler)
+        finally:
+            os.umask(old_umask)
+        self.__server.daemon_threads = True
+        self.__server.probe_daemon = self
+
+        def shutdown(signum, frame):
+            # shutdown() blocks until serve_forever returns, so it can not run on the serving thread
+            threading.Thread(target=self.__server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        if self.__args.warm_up:
+            self.__pool.warm_up()
+        self.logger.info('Listening on ' + str(socket_path))
+        try:
+            self.__server.serve_forever()
+        finally:
+            self.__server.server_close()
+            self.__pool.close()
+            socket_path.unlink(missing_ok=True)
+            self.logger.info('Stopped')
+
+
+def socket_in_use(socket_path):
+    """
+    Check whether a process accepts connections on the unix socket
+    :param socket_path: full path of the socket
+    :type socket_path: str
+
+    :return: True if somebody listens
+    :rtype: bool
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+def parse_arguments(args):
+    """
+    Parse the arguments provided in the command line
+    :param args: list of arguments
+    :type args: list
+    :return: argument object
+    :rtype: ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description="Browser daemon for the RCIAM Health Check Probe")
+
+    parser.add_argument('--socket', '-S', dest="socket", help='Unix socket to listen on. Defaults to '
+                                                              + ParamDefaults.DAEMON_SOCKET.value,
+                        default=ParamDefaults.DAEMON_SOCKET.value)
+    parser.add_argument('--pool-size', '-n', dest="pool_size", help='Number of warm browsers',
+                        type=int, default=ParamDefaults.DAEMON_POOL_SIZE.value)
+    parser.add_argument('--max-uses', dest="max_uses",
+                        help='Number of checks a browser serves before it gets replaced',
+                        type=int, default=ParamDefaults.DAEMON_MAX_USES.value)
+    parser.add_argument('--warm-up', dest="warm_up",
+                        help='No Value needed. Start all browsers of the pool before accepting checks',
+                        action='store_true')
+    parser.add_argument('--firefox', '-f', dest="firefox", help='Firefox binary full path',
+                        default=ParamDefaults.FIREFOX_PATH.value)
+    parser.add_argument('--geckodriver', '-g', dest="geckodriver", help='geckodriver binary full path',
+                        default=ParamDefaults.GECKODRIVER_PATH.value)
+    parser.add_argument('--log', '-l', dest="log", help='Logfile full path', default=ParamDefaults.LOG_FILE.value)
+    parser.add_argument('--verbose', '-v', dest="verbose", help='Set log verbosity, levels are -v to -vvvv',
+                        action="count",
+                        default=0)
+    parser.add_argument('--console', '-C', dest="console",
+                        help='No Value needed. The presence of the flag indicates log output in stdout',
+                        action='store_true')
+    parser.add_argument('--log-queue', dest="log_queue",
+                        help='No Value needed. Log calls only queue the records and a background thread writes them '
+                             'in batches',
+                        action='store_true')
+    parser.add_argument('--syslog', dest="syslog", nargs='?', const=ParamDefaults.SYSLOG_SOCKET.value,
+                        help='Ship the log records to the syslog or log collector socket SYSLOG, a path or HOST:PORT, '
+                             'instead of the log file. Defaults to ' + ParamDefaults.SYSLOG_SOCKET.value)
+    parser.add_argument('--logowner', '-o', dest="logowner", default=ParamDefaults.LOG_OWNER.value,
+                        help='Owner of the log file rciam_probes.log under /var/log/rciam_probes/. Default owner is nagios user.')
+
+    return parser.parse_args(args)
+
+
+# Entry point
+if __name__ == "__main__":
+    daemon = RciamBrowserDaemon()
+    daemon.serve()
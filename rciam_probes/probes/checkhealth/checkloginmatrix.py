@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import copy
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from rciam_probes.probes.checkhealth.browserpool import BrowserPool, run_pooled_check
+from rciam_probes.probes.checkhealth.checkhealth import parse_arguments as parse_check_arguments
+from rciam_probes.shared.enums import *
+from rciam_probes.shared.templates import *
+from rciam_probes.shared.utils import *
+
+
+class RciamLoginMatrix:
+    """Run the SP/IdP combinations of a config file concurrently on a bounded pool of browsers"""
+    __args = None
+    __logger = None
+    __pool = None
+
+    def __init__(self, args=sys.argv[1:]):
+        """
+        Initialize
+        :param args: list of arguments
+        :type args: list
+        """
+        self.__args = parse_arguments(args)
+        self.__logger = configure_logger(self.__args)
+        self.__pool = BrowserPool(self.__args, self.__args.pool_size, self.__args.max_uses, self.__logger)
+
+    def check_matrix(self):
+        """Evaluate all the combinations, print a summary line and one line per combination and exit"""
+        self.__logger.info(' '.join([(repr(arg) if ' ' in arg else arg) for arg in sys.argv]))
+        try:
+            combinations = read_combinations(self.__args.config)
+        except (OSError, ValueError) as e:
+            self.__logger.critical("Login matrix config: " + str(e))
+            exit(NagiosStatusCode.UNKNOWN.value)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.__args.pool_size) as executor:
+                results = list(executor.map(self.evaluate_combination, combinations))
+        finally:
+            self.__pool.close()
+
+        ncode = max([code for msg, code in results], default=NagiosStatusCode.UNKNOWN.value)
+        counts = {status: 0 for status in NagiosStatusCode}
+        for msg, code in results:
+            counts[NagiosStatusCode(code)] += 1
+        msg_list = [msg for msg, code in results]
+        # Nagios takes the first line as the status and the rest as long output
+        msg_list.insert(0, login_health_check_matrix_summary_tmpl.substitute(defaults_login_health_check_matrix_summary,
+                                                                             status=NagiosStatusCode(ncode).name,
+                                                                             combinations=len(results),
+                                                                             ok=counts[NagiosStatusCode.OK],
+                                                                             warning=counts[NagiosStatusCode.WARNING],
+                                                                             critical=counts[NagiosStatusCode.CRITICAL],
+                                                                             unknown=counts[NagiosStatusCode.UNKNOWN]))
+        msg = '\n'.join(msg_list)
+        # print to logs
+        self.__logger.info(msg)
+        # print to output
+        print(msg)
+        exit(ncode)
+
+    def evaluate_combination(self, options):
+        """
+        Run the login check of one combination. Its result is written through the checklogin output path,
+        so the json files of the combinations stay available to the --inlocation consumers
+        :param options: checklogin options of the combination
+        :type options: dict
+
+        :return: Nagios message line and NagiosStatusCode exit code
+        :rtype: (str, int)
+        """
+        msg, code, check_opts = evaluate_login_options(self.__pool, options, self.__logger)
+        if check_opts is None:
+            sp, idp = options.get('sp', ''), options.get('idp', '')
+        else:
+            sp, idp = check_opts.sp, check_opts.identity
+        return login_health_check_matrix_tmpl.substitute(defaults_login_health_check_matrix, sp=sp, idp=idp,
+                                                         msg=msg), code
+
+
+def evaluate_login_options(pool, options, logger, session=None):
+    """
+    Run the login check of a set of checklogin options on a browser of the pool. Its result is written through the
+    checklogin output path, so the json files stay available to the --inlocation consumers
+    :param pool: the browser pool
+    :type pool: BrowserPool
+
+    :param options: checklogin options, e.g. {"sp": "https://sp.example.org", "idp": "https://idp.example.org"}
+    :type options: dict
+
+    :param logger: Logger object
+    :type logger: Logger
+
+    :param session: requests session shared between the checks. A new one per check if not provided
+    :type session: requests.Session
+
+    :return: Nagios message, NagiosStatusCode exit code and the parsed checklogin arguments, None if invalid
+    :rtype: (str, int, ArgumentParser)
+    """
+    check_args = options_to_arguments(options)
+    try:
+        check_opts = parse_check_arguments(check_args)
+    except SystemExit:
+        # argparse exits on invalid arguments
+        logger.critical('Invalid login check: ' + str(options.get('sp')) + ' ' + str(options.get('idp')))
+        return "State " + NagiosStatusCode.UNKNOWN.name + "(Invalid arguments)", NagiosStatusCode.UNKNOWN.value, None
+
+    logger.info('Check ' + check_opts.sp + ' via ' + check_opts.identity)
+    msg_value, msg_vtype, code, stages = run_pooled_check(pool, check_args, logger, session)
+    if check_opts.json or check_opts.json_path:
+        print_output(check_opts, construct_probe_msg(check_opts, msg_value, msg_vtype, code, stages), logger)
+
+    # The returned message is always the Nagios message
+    plain_opts = copy.copy(check_opts)
+    plain_opts.json = False
+    plain_opts.json_path = None
+    return construct_probe_msg(plain_opts, msg_value, msg_vtype, code, stages), code, check_opts
+
+
+def read_combinations(config_file):
+    """
+    Read the login matrix config. The config is a json object with the checklogin options shared by all
+    combinations under "defaults" and the options of every SP/IdP combination under "combinations", e.g.
+    {"defaults": {"hostname": "example.com", "username": "user", "password": "secret", "json": "rciam/out"},
+     "combinations": [{"sp": "https://sp.example.com/login", "idp": "https://idp.example.org/idp/shibboleth"}]}
+    :param config_file: path of the file or - for stdin
+    :type config_file: str
+
+    :return: list of options, one per combination
+    :rtype: list
+
+    :raises ValueError: if the config is malformed
+    """
+    if config_file == '-':
+        config = json.load(sys.stdin)
+    else:
+        with open(config_file, encoding='utf-8') as f:
+            config = json.load(f)
+
+    if not isinstance(config, dict) or not isinstance(config.get('combinations'), list):
+        raise ValueError('"combinations" list is missing')
+    defaults = config.get('defaults', {})
+    if not isinstance(defaults, dict):
+        raise ValueError('"defaults" is not an object')
+
+    combinations = []
+    for combination in config['combinations']:
+        if not isinstance(combination, dict):
+            raise ValueError('Invalid combination: ' + json.dumps(combination))
+        options = dict(defaults)
+        options.update(combination)
+        combinations.append(options)
+    return combinations
+
+
+def parse_arguments(args):
+    """
+    Parse the arguments provided in the command line
+    :param args: list of arguments
+    :type args: list
+    :return: argument object
+    :rtype: ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description="SP/IdP login matrix for the RCIAM Health Check Probe")
+
+    parser.add_argument('--config', '-c', dest="config", required=True,
+                        help='json file with the checklogin options of every SP/IdP combination. Use - to read from stdin')
+    parser.add_argument('--pool-size', '-n', dest="pool_size",
+                        help='Number of browsers, i.e. combinations checked concurrently. Defaults to '
+                             + str(ParamDefaults.DAEMON_POOL_SIZE.value),
+                        type=int, default=ParamDefaults.DAEMON_POOL_SIZE.value)
+    parser.add_argument('--max-uses', dest="max_uses",
+                        help='Number of checks a browser serves before it gets replaced',
+                        type=int, default=ParamDefaults.DAEMON_MAX_USES.value)
+    parser.add_argument('--firefox', '-f', dest="firefox", help='Firefox binary full path',
+                        default=ParamDefaults.FIREFOX_PATH.value)
+    parser.add_argument('--geckodriver', '-g', dest="geckodriver", help='geckodriver binary full path',
+                        default=ParamDefaults.GECKODRIVER_PATH.value)
+    parser.add_argument('--log', '-l', dest="log", help='Logfile full path', default=ParamDefaults.LOG_FILE.value)
+    parser.add_argument('--verbose', '-v', dest="verbose", help='Set log verbosity, levels are -v to -vvvv',
+                        action="count",
+                        default=0)
+    parser.add_argument('--console', '-C', dest="console",
+                        help='No Value needed. The presence of the flag indicates log output in stdout',
+                        action='store_true')
+    parser.add_argument('--log-queue', dest="log_queue",
+                        help='No Value needed. Log calls only queue the records and a background thread writes them '
+                             'in batches',
+                        action='store_true')
+    parser.add_argument('--syslog', dest="syslog", nargs='?', const=ParamDefaults.SYSLOG_SOCKET.value,
+                        help='Ship the log records to the syslog or log collector socket SYSLOG, a path or HOST:PORT, '
+                             'instead of the log file. Defaults to ' + ParamDefaults.SYSLOG_SOCKET.value)
+    parser.add_argument('--logowner', '-o', dest="logowner", default=ParamDefaults.LOG_OWNER.value,
+                        help='Owner of the log file rciam_probes.log under /var/log/rciam_probes/. Default owner is nagios user.')
+
+    return parser.parse_args(args)
+
+
+# Entry point
+if __name__ == "__main__":
+    matrix = RciamLoginMatrix()
+    matrix.check_matrix()
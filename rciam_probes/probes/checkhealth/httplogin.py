@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import re
+from urllib.parse import quote, urljoin, urlparse
+
+import requests
+from requests.auth import HTTPBasicAuth
+
+from rciam_probes.shared.discovery import ThissDiscovery, is_thiss_url
+from rciam_probes.shared.enums import AuthenticateTxt, LoggingLevel
+
+
+class HttpFlowTimeout(Exception):
+    """
+    The expected page or element never showed up. This is the http engine counterpart of the
+    TimeoutException the browser engine raises while waiting for an element.
+    """
+
+
+class RciamHttpLogin:
+    """
+    Browserless login flow. It walks the same steps as the browser engine with a requests.Session
+    and plain HTML form parsing:
+    SimpleSAMLphp or Keycloak discovery -> form based(or Basic Authentication) IdP -> Shibboleth consent ->
+    SAMLResponse auto submit -> simpleSAMLphp modules -> OIDC consent -> SP landing page
+    """
+    __args = None
+    __logger = None
+    __session = None
+    __response = None
+    __soup = None
+    __max_hops = 20
+
+    def __init__(self, args, logger, session=None, captured=None):
+        """
+        :param args: arguments retrieved from command line
+        :type args: ArgumentParser
+
+        :param logger: Logger object
+        :type logger: Logger
+
+        :param session: requests session whose connection pools are reused, e.g. shared between the checks of a
+                        runner. The login keeps its own cookies and hooks, so concurrent logins never mix sessions
+        :type session: requests.Session
+
+        :param captured: ring that records the status, URL and timing of every response, e.g. for the trace
+        :type captured: RequestRing
+        """
+        self.__args = args
+        self.__logger = logger
+        self.__session = requests.Session()
+        if session is not None:
+            for prefix, adapter in session.adapters.items():
+                self.__session.mount(prefix, adapter)
+        if captured is not None:
+            self.__session.hooks['response'].append(captured.record_http)
+        # Same as the browser, which accepts insecure certificates
+        self.__session.verify = False
+        requests.packages.urllib3.disable_warnings()
+
+    def login(self):
+        """Run the whole login flow"""
+        self.sp_redirect_disco_n_click()
+        self.idp_authenticate()
+        self.idp_shib_consent_page()
+        self.accept_all_ssp_modules()
+        self.oidc_server_consent_page()
+        self.verify_sp_home_page_loaded()
+
+    def sp_redirect_disco_n_click(self):
+        """Discovery Service View"""
+        self.__get(self.__args.sp)
+
+        if self.__args.skip_idp_discovery:
+            self.__logger.debug('Skipping IdP discovery page')
+            return
+
+        disco_type = self.__detect_disco_type()
+        self.__logger.debug('Discovery Service type detected: %s', disco_type)
+
+        # In case I have a list of IdPs
+        idp_list = self.__args.identity.split(',')
+        idp_name_list = self.__args.idp_name.split(',') if self.__args.idp_name else []
+
+        if disco_type == "ssp":
+            for idp in idp_list:
+                # Log the title of the view
+                self.__debug_page()
+                # URL-encode IdP entityID
+                idp_entity_id_url_enc = quote(idp, safe='')
+                self.__logger.debug('Safe URL IdP entity ID: %s', idp_entity_id_url_enc)
+                link = self.__soup.select_one('a[href*="%s"]' % idp_entity_id_url_enc)
+                if link is None:
+                    raise RuntimeError('Discovery Service timeout')
+                self.__get(urljoin(self.__response.url, link.get('href')))
+
+        elif disco_type == "keycloak":
+            for i, idp in enumerate(idp_list):
+                if idp_name_list and i < len(idp_name_list):
+                    search_term = idp_name_list[i]
+                else:
+                    # Fallback to idp if no hostname
+                    search_term = urlparse(idp).hostname or idp
+                self.__logger.debug('Searching for IdP: %s', search_term)
+                for link in self.__soup.select('a.kc-social-item'):
+                    if any(search_term in span.get_text() for span in link.find_all('span')):
+                        self.__get(urljoin(self.__response.url, link.get('href')))
+                        break
+                else:
+                    self.__logger.error(f"Could not find IdP '{idp}' after searching '{search_term}' in Keycloak")
+                    raise RuntimeError(f"IdP '{idp}' not found in Keycloak discovery service")
+                # Exit after successful click (single login intent)
+                break
+
+        elif disco_type == "thiss" and self.__args.thiss_api:
+            # Answer the discovery request instead of running the search page
+            thiss = ThissDiscovery(self.__args.thiss_api, self.__args.timeout, self.__session, self.__logger)
+            for i, idp in enumerate(idp_list):
+                search_term = idp_name_list[i] if idp_name_list and i < len(idp_name_list) \
+                    else urlparse(idp).hostname
+                self.__get(thiss.select(self.__response.url, idp, search_term))
+
+        elif disco_type == "thiss":
+            raise RuntimeError('The http engine needs --thiss-api for the thiss.io Discovery Service')
+
+        else:
+            raise RuntimeError('Unsupported Discovery Service type for the http engine')
+
+    def idp_authenticate(self):
+        """
+        Authenticate to IdP
+        :raises HttpFlowTimeout: if the login form is not available
+        """
+        if self.__args.basic_auth:
+            self.__get(self.__response.url, auth=HTTPBasicAuth(self.__args.username, self.__args.password))
+            if self.__response.status_code in [400, 401]:
+                raise Exception('Unauthorized Access')
+            self.__logger.info(AuthenticateTxt.Success.value)
+            return
+
+        username = self.__soup.find(id='username')
+        password = self.__soup.find(id='password')
+        if username is None or password is None:
+            raise HttpFlowTimeout('Login form not found in ' + self.__response.url)
+        form = username.find_parent('form')
+        # Log the title of the view
+        self.__debug_page()
+        self.__submit(form,
+                      form.select_one("button[type='submit']"),
+                      {username.get('name'): self.__args.username,
+                       password.get('name'): self.__args.password})
+
+    def idp_shib_consent_page(self):
+        """
+        If the IdP prompts for explicit consent in order to release the attributes
+        - Shibboleth consent pages have element: [type='submit'][name*='proceed']
+        """
+        regex_domain = r"^https?:[\/]{2}(.*?)[\/]{1}.*$"
+        domain = re.search(regex_domain, self.__args.identity).group(1)
+        button = self.__soup.select_one("form [type='submit'][name*='proceed']")
+        if domain not in self.__response.url or button is None:
+            self.__logger.warning('Idp has no consent page. Continue...')
+            return
+        # Log the title of the view
+        self.__debug_page()
+        self.__submit(button.find_parent('form'), button)
+
+    def accept_all_ssp_modules(self):
+        """simplesamlPHP View. Accept all modules."""
+        button = self.__soup.find(id='yesbutton')
+        if button is None:
+            self.__logger.warning('No simplesamlPHP modules found. Continue...')
+            return
+        for _ in range(self.__max_hops):
+            # Log the title of the view
+            self.__debug_page()
+            form = button.find_parent('form')
+            # find if this is the consent page
+            last_module = "getconsent.php" in (form.get('action') or '')
+            self.__submit(form, button)
+            button = self.__soup.find(id='yesbutton')
+            if last_module or button is None:
+                return
+        raise RuntimeError('Too many simplesamlPHP modules')
+
+    def oidc_server_consent_page(self):
+        """
+        If the OIDC server prompts for explicit consent in order to release the attributes
+        - OIDC MitreId consent pages have element: input[type='submit'][value='Authorise']
+        """
+        button = self.__soup.select_one("form [type='submit'][value='Authorise']")
+        if button is None:
+            self.__logger.warning('OIDC Server has no consent page. Continue...')
+            return
+        # Log the title of the view
+        self.__debug_page()
+        self.__submit(button.find_parent('form'), button)
+
+    def verify_sp_home_page_loaded(self):
+        """
+        Verify that the Service Providers Home page loaded successfully
+        :raises HttpFlowTimeout: if we did not land on the Service Provider
+        """
+        if self.__args.rs is not None:
+            landing_page = self.__args.rs
+        else:
+            landing_page = self.__args.sp
+        if self.__response.url.strip('/').find(landing_page.strip('/')) != 0 or self.__soup.body is None:
+            raise HttpFlowTimeout('Landed on ' + self.__response.url + ' instead of ' + landing_page)
+        # Log the title of the view
+        self.__debug_page()
+
+    def __detect_disco_type(self):
+        """Detect whether the discovery type is thiss.io, Keycloak or SimpleSAMLphp (default)."""
+        if self.__soup.find(id='searchinput') is not None or is_thiss_url(self.__response.url):
+            return "thiss"
+        if self.__soup.select_one('.login-pf-page') is not None and self.__soup.find(id='kc-header') is not None:
+            return "keycloak"
+        return "ssp"
+
+    def __debug_page(self):
+        """Log the title and the url of the current page, unless debugging is off"""
+        if self.__logger.isEnabledFor(LoggingLevel.debug.value):
+            self.__logger.debug('%s(%s)', self.__title(), self.__response.url)
+
+    def __title(self):
+        """Title of the current page"""
+        return self.__soup.title.get_text().strip() if self.__soup.title is not None else ''
+
+    def __get(self, url, **kwargs):
+        """GET the url and load the response as the current page"""
+        self.__load(self.__request('get', url, **kwargs))
+
+    def __submit(self, form, button=None, values=None):
+        """
+        Submit the form the same way a browser would
+        :param form: the form to submit
+        :type form: Tag
+
+        :param button: the submit button pressed. Its name/value travels with the form
+        :type button: Tag
+
+        :param values: values filled in by the user
+        :type values: dict
+        """
+        data = form_fields(form)
+        if button is not None and button.get('name'):
+            data[button.get('name')] = button.get('value', '')
+        data.update(values or {})
+        self.__load(self.__send_form(form, data))
+
+    def __send_form(self, form, data):
+        """Send the form data to the form action"""
+        action = urljoin(self.__response.url, form.get('action') or self.__response.url)
+        if (form.get('method') or 'get').lower() == 'post':
+            return self.__request('post', action, data=data)
+        # Browsers replace the query of the action with the form data
+        return self.__request('get', urlparse(action)._replace(query='').geturl(), params=data)
+
+    def __request(self, method, url, **kwargs):
+        """
+        Perform the request and evaluate the status codes of every hop
+        :raises HttpFlowTimeout: if the request timed out
+        :raises RuntimeError: if the service is down or not reachable
+        """
+        try:
+            response = self.__session.request(method, url, timeout=self.__args.timeout, **kwargs)
+        except requests.exceptions.Timeout as e:
+            raise HttpFlowTimeout(str(e)) from e
+        except requests.exceptions.RequestException as e:
+            raise RuntimeError('Cannot connect to endpoint ' + url) from e
+        for hop in response.history + [response]:
+            self.__logger.debug('%s \nStatus:%s', hop.url, hop.status_code)
+            if urlparse(hop.url).hostname == self.__args.hostname and hop.status_code >= 500:
+                # Log the host, status, request
+                self.__logger.error("Service is down: " + str(hop.status_code))
+                raise RuntimeError('Service unavailable[' + str(hop.status_code) + ']')
+        return response
+
+    def __load(self, response):
+        """
+        Make the response the current page. Pages that a browser would submit on its own,
+        e.g. the SAMLResponse/SAMLRequest post forms and the Shibboleth client side storage pages, are submitted
+        right away.
+        """
+        # bs4 is slow to import and only this engine parses pages
+        from bs4 import BeautifulSoup
+        for _ in range(self.__max_hops):
+            self.__response = response
+            self.__soup = BeautifulSoup(response.text, 'html.parser')
+            form = self.__soup.find('form')
+            if form is None or not is_auto_submit_form(self.__soup, form):
+                return
+            self.__logger.debug('Auto submit form: %s', form.get('action'))
+            data = form_fields(form)
+            if 'shib_idp_ls_supported' in data:
+                # No local storage here. The IdP keeps its session in the cookies instead
+                data['shib_idp_ls_supported'] = 'false'
+            response = self.__send_form(form, data)
+        raise RuntimeError('Too many auto submitted forms')
+
+
+def is_auto_submit_form(soup, form):
+    """
+    Check if the page posts the form on load, i.e. the SAML HTTP-POST binding pages and the Shibboleth IdP v4+
+    client side storage pages("Loading Session Information", "Saving Session Information")
+    :param soup: the parsed page
+    :type soup: BeautifulSoup
+
+    :param form: the first form of the page
+    :type form: Tag
+
+    :return: True if a browser would submit the form without user interaction
+    :rtype: bool
+    """
+    if form.find('input', {'name': re.compile(r'^(SAML(Response|Request)$|shib_idp_ls_)')}) is not None:
+        return True
+    onload = soup.body.get('onload', '') if soup.body is not None else ''
+    return 'submit()' in onload or 'doLoad()' in onload
+
+
+def form_fields(form):
+    """
+    Collect the successful controls of a form, the way a browser would send them
+    :param form: the form
+    :type form: Tag
+
+    :return: field name to value
+    :rtype: dict
+    """
+    data = {}
+    for field in form.find_all(['input', 'textarea', 'select']):
+        name = field.get('name')
+        if not name or field.has_attr('disabled'):
+            continue
+        field_type = (field.get('type') or 'text').lower()
+        if field.name == 'input' and field_type in ['submit', 'button', 'image', 'reset', 'file']:
+            continue
+        if field_type in ['checkbox', 'radio'] and not field.has_attr('checked'):
+            continue
+        if field.name == 'textarea':
+            data[name] = field.get_text()
+        elif field.name == 'select':
+            option = field.find('option', selected=True) or field.find('option')
+            if option is not None:
+                data[name] = option.get('value', option.get_text())
+        else:
+            data[name] = field.get('value', 'on' if field_type in ['checkbox', 'radio'] else '')
+    return data
@@ -2,14 +2,18 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import json
 import sys
-import pkg_resources
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 # import methods from the lib directory
+from rciam_probes.shared.cache import CertCache, HttpCache
 from rciam_probes.shared.enums import *
 from rciam_probes.shared.templates import *
 from rciam_probes.shared.utils import *
 
+CERT_USES = ['signing', 'encryption', 'all']
+
 
 class RciamMetadataCheck:
     __logger = None
@@ -19,66 +23,389 @@ class RciamMetadataCheck:
     __url = None
     __protocol = None
     __timeout = None
+    __session = None
+    __cache = None
+    __cert_cache = None
+
+    def __init__(self, args=sys.argv[1:], logger=None, session=None, cache=None, cert_cache=None):
+        """
+        Initialize
+        :param args: list of arguments
+        :type args: list
+
+        :param logger: Logger object. If not provided one is configured from the arguments
+        :type logger: Logger
+
+        :param session: requests session shared between checks. If not provided one is created for batch mode
+        :type session: requests.Session
+
+        :param cache: metadata cache shared between checks. If not provided one is created from --cache-dir
+        :type cache: HttpCache
 
-    def __init__(self, args=sys.argv[1:]):
+        :param cert_cache: certificate cache shared between checks. If not provided one is created from --cert-cache
+        :type cert_cache: CertCache
+        """
         self.__args = parse_arguments(args)
-        self.__logger = configure_logger(self.__args)
+        self.__logger = logger if logger is not None else configure_logger(self.__args)
+        self.__session = session
         self.__protocol = 'http' if self.__args.port == 80 else 'https'
         self.__timeout = self.__args.timeout
-        self.__url =  self.__protocol +\
-                      '://' + self.__args.hostname +\
-                      '/' + self.__args.endpoint
-        self.__logger.info('Metadata URL: %s' % (self.__url))
+        self.__cache = cache
+        self.__cert_cache = cert_cache
+        if self.__cache is None and self.__args.cache_dir is not None:
+            self.__cache = HttpCache(self.__args.cache_dir, self.__args.cache_size * 1024 * 1024, self.__logger)
+        if self.__cert_cache is None and self.__args.cert_cache is not None:
+            self.__cert_cache = CertCache(self.__args.cert_cache, logger=self.__logger)
+        if self.__args.targets is None:
+            self.__url = self.metadata_url(self.__args.hostname, self.__args.endpoint)
+            self.__logger.info('Metadata URL: %s' % (self.__url))
+
+    def metadata_url(self, hostname, endpoint):
+        """
+        Construct the metadata URL of a target
+        :param hostname: domain name of the service
+        :type hostname: str
+
+        :param endpoint: endpoint advertising the metadata
+        :type endpoint: str
+
+        :return: the URL
+        :rtype: str
+        """
+        return self.__protocol + '://' + hostname + '/' + endpoint
 
     def check_cert(self):
         # log my running command
         self.__logger.info(' '.join([(repr(arg) if ' ' in arg else arg) for arg in sys.argv]))
 
+        if self.__args.targets is not None:
+            self.check_targets()
+        if self.__args.aggregate:
+            self.check_aggregate()
+
         try:
-            metadata_dict = get_xml(self.__url, self.__timeout, self.__logger)
-            # Find the certificate by type
-            x509_dict = fetch_cert_from_type(metadata_dict, self.__args.certuse)
-            if len(x509_dict) > 1:
-                msg_list = []
-                for certuse, value in x509_dict.items():
-                    expiration_days, certData = evaluate_single_certificate(value)
-                    status, code = get_nagios_status_n_code(expiration_days, self.__args.warning, self.__args.critical, self.__logger)
-                    msg_list.append(cert_health_check_all_tmpl.substitute(defaults_cert_health_check_all,
-                                                                          type=certuse,
-                                                                          status=status))
-                    self.__ncode = [self.__ncode, code][self.__ncode < code]
-                separator = ', '
-                self.__msg = separator.join(msg_list)
-                # Add the performance data
-                self.__msg += " | 'SSL Metadata Cert Status'=" + str(self.__ncode)
-            else:
-                expiration_days, certData = evaluate_single_certificate(list(x509_dict.values())[0])
-                status, code = get_nagios_status_n_code(expiration_days, self.__args.warning, self.__args.critical, self.__logger)
-                self.__ncode = code
-                self.__msg = cert_health_check_tmpl.substitute(defaults_cert_health_check,
-                                                               type=list(x509_dict.keys())[0],
-                                                               status=status,
-                                                               subject=certData['Subject']['CN'],
-                                                               issuer=certData['Issuer']['CN'],
-                                                               not_after=certData['not After'],
-                                                               expiration_days=expiration_days,
-                                                               warning=self.__args.warning,
-                                                               critical=self.__args.critical
-                                                               )
+            self.__msg, self.__ncode = self.evaluate_metadata(self.__url, self.__args.certuse)
         except RuntimeError as e:
             # Log Print here
-            self.__logger.critical("Runtime Exception: " + e)
+            self.__logger.critical("Runtime Exception: " + str(e))
+            exit(NagiosStatusCode.CRITICAL.value)
+        except Exception as e:
+            self.__logger.critical(e)
+            exit(NagiosStatusCode.UNKNOWN.value)
+
+        self.__save_cert_cache()
+        # print to output
+        print(self.__msg)
+        # print to logs
+        self.__logger.info(self.__msg)
+        exit(self.__ncode)
+
+    def evaluate_metadata(self, url, certuse):
+        """
+        Fetch the metadata and evaluate the certificates of the requested use
+        :param url: URL of the metadata
+        :type url: str
+
+        :param certuse: type of certificate {signing, encryption, all}
+        :type certuse: str
+
+        :return: Nagios message and NagiosStatusCode exit code
+        :rtype: (str, int)
+
+        :raises RuntimeError: if the metadata are not reachable
+        :raises Exception: if the metadata or the certificates can not be parsed
+        """
+        ncode = -1
+        key_descriptors = self.__key_descriptors(url)
+        # Find the certificate by type
+        x509_dict = fetch_cert_from_key_descriptors(key_descriptors, certuse)
+        if len(x509_dict) > 1:
+            msg_list = []
+            for x509_use, value in x509_dict.items():
+                expiration_days, certData = evaluate_single_certificate(value, self.__cert_cache)
+                status, code = get_nagios_status_n_code(expiration_days, self.__args.warning, self.__args.critical, self.__logger)
+                msg_list.append(cert_health_check_all_tmpl.substitute(defaults_cert_health_check_all,
+                                                                      type=x509_use,
+                                                                      status=status))
+                ncode = [ncode, code][ncode < code]
+            separator = ', '
+            msg = separator.join(msg_list)
+            # Add the performance data
+            msg += " | 'SSL Metadata Cert Status'=" + str(ncode)
+        else:
+            expiration_days, certData = evaluate_single_certificate(list(x509_dict.values())[0], self.__cert_cache)
+            status, code = get_nagios_status_n_code(expiration_days, self.__args.warning, self.__args.critical, self.__logger)
+            ncode = code
+            msg = cert_health_check_tmpl.substitute(defaults_cert_health_check,
+                                                    type=list(x509_dict.keys())[0],
+                                                    status=status,
+                                                    subject=certData['Subject']['CN'],
+                                                    issuer=certData['Issuer']['CN'],
+                                                    not_after=cert_date(certData['not After']),
+                                                    expiration_days=expiration_days,
+                                                    warning=self.__args.warning,
+                                                    critical=self.__args.critical
+                                                    )
+        return msg, ncode
+
+    def evaluate_cert(self):
+        """
+        Evaluate the metadata of the command line. Failures are reported in the message instead of exiting
+        :return: Nagios message and NagiosStatusCode exit code
+        :rtype: (str, int)
+        """
+        return self.__evaluate_reported(self.__url, self.__args.certuse)
+
+    def evaluate_target(self, hostname, endpoint, certuse):
+        """
+        Evaluate one target of a batch. Failures are reported in the message instead of exiting
+        :return: Nagios message and NagiosStatusCode exit code
+        :rtype: (str, int)
+        """
+        msg, code = self.__evaluate_reported(self.metadata_url(hostname, endpoint), certuse)
+        return cert_health_check_target_tmpl.substitute(defaults_cert_health_check_target,
+                                                        target=hostname + '/' + endpoint,
+                                                        msg=msg), code
+
+    def __evaluate_reported(self, url, certuse):
+        """
+        :return: Nagios message and NagiosStatusCode exit code. Failures are reported in the message
+        :rtype: (str, int)
+        """
+        try:
+            msg, code = self.evaluate_metadata(url, certuse)
+        except RuntimeError as e:
+            self.__logger.critical(url + " Runtime Exception: " + str(e))
+            code = NagiosStatusCode.CRITICAL.value
+            msg = cert_health_check_error_tmpl.substitute(defaults_cert_health_check_error, type=certuse,
+                                                          status=NagiosStatusCode.CRITICAL.name, error=str(e))
+        except Exception as e:
+            self.__logger.critical(url + " " + str(e))
+            code = NagiosStatusCode.UNKNOWN.value
+            msg = cert_health_check_error_tmpl.substitute(defaults_cert_health_check_error, type=certuse,
+                                                          status=NagiosStatusCode.UNKNOWN.name, error=str(e))
+        return msg, code
+
+    def check_targets(self):
+        """Evaluate all the targets of the target list concurrently, print one line per target and exit"""
+        try:
+            targets = read_targets(self.__args.targets, self.__args.certuse)
+        except (OSError, ValueError) as e:
+            self.__logger.critical("Target list: " + str(e))
+            exit(NagiosStatusCode.UNKNOWN.value)
+        if self.__session is None:
+            self.__session = create_http_session(self.__args.workers)
+
+        with ThreadPoolExecutor(max_workers=self.__args.workers) as executor:
+            results = list(executor.map(lambda target: self.evaluate_target(*target), targets))
+
+        msg_list = [msg for msg, code in results]
+        for msg in msg_list:
+            self.__logger.info(msg)
+        self.__ncode = max([code for msg, code in results], default=NagiosStatusCode.UNKNOWN.value)
+        if self.__args.summary:
+            counts = {status: 0 for status in NagiosStatusCode}
+            for msg, code in results:
+                counts[NagiosStatusCode(code)] += 1
+            # Nagios takes the first line as the status and the rest as long output
+            msg_list.insert(0, cert_health_check_summary_tmpl.substitute(defaults_cert_health_check_summary,
+                                                                         status=NagiosStatusCode(self.__ncode).name,
+                                                                         ok=counts[NagiosStatusCode.OK],
+                                                                         warning=counts[NagiosStatusCode.WARNING],
+                                                                         critical=counts[NagiosStatusCode.CRITICAL],
+                                                                         unknown=counts[NagiosStatusCode.UNKNOWN]))
+        self.__msg = '\n'.join(msg_list)
+        self.__save_cert_cache()
+        # print to output
+        print(self.__msg)
+        exit(self.__ncode)
+
+
+    def check_aggregate(self):
+        """
+        Evaluate the signing and encryption certificates of every entity and role of a federation aggregate.
+        Print a summary line with the number of certificates per state, write the details in the report file and exit
+        """
+        try:
+            report, entities = self.evaluate_aggregate(self.__url, self.__args.certuse)
+        except RuntimeError as e:
+            self.__logger.critical("Runtime Exception: " + str(e))
             exit(NagiosStatusCode.CRITICAL.value)
         except Exception as e:
             self.__logger.critical(e)
             exit(NagiosStatusCode.UNKNOWN.value)
 
+        counts = {status: 0 for status in NagiosStatusCode}
+        for record in report:
+            counts[NagiosStatusCode[record['status']]] += 1
+        self.__ncode = max([NagiosStatusCode[record['status']].value for record in report],
+                           default=NagiosStatusCode.UNKNOWN.value)
+        self.__msg = cert_health_check_aggregate_tmpl.substitute(defaults_cert_health_check_aggregate,
+                                                                 type=self.__args.certuse,
+                                                                 status=NagiosStatusCode(self.__ncode).name,
+                                                                 entities=entities,
+                                                                 certificates=len(report),
+                                                                 ok=counts[NagiosStatusCode.OK],
+                                                                 warning=counts[NagiosStatusCode.WARNING],
+                                                                 critical=counts[NagiosStatusCode.CRITICAL],
+                                                                 unknown=counts[NagiosStatusCode.UNKNOWN])
+        if self.__args.report:
+            try:
+                write_text_atomic(self.__args.report, ''.join(json.dumps(record) + '\n' for record in report))
+            except OSError as e:
+                self.__logger.warning("Could not write report " + self.__args.report + ": " + str(e))
+        self.__save_cert_cache()
         # print to output
         print(self.__msg)
         # print to logs
         self.__logger.info(self.__msg)
         exit(self.__ncode)
 
+    def evaluate_aggregate(self, url, certuse):
+        """
+        Stream the aggregate and evaluate every certificate. Certificates shared by many entities are evaluated once
+        :param url: URL of the aggregate
+        :type url: str
+
+        :param certuse: type of certificate {signing, encryption, all}
+        :type certuse: str
+
+        :return: one record per entityID, role, use and certificate and the number of entities in the aggregate,
+                 including the ones without certificates
+        :rtype: (list, int)
+        """
+        evaluated = {}
+        entities = set()
+        report = []
+        for entity_id, role, use, x509 in self.__key_descriptors(url, entities):
+            if certuse != 'all' and use not in [certuse, 'unknown']:
+                continue
+            if x509 not in evaluated:
+                evaluated[x509] = self.__evaluate_aggregate_cert(x509)
+            record = {'entityID': entity_id, 'role': role, 'use': use}
+            record.update(evaluated[x509])
+            report.append(record)
+        return report, len(entities)
+
+    def __key_descriptors(self, url, entities=None):
+        """
+        Stream the KeyDescriptors of the metadata. With a cache the metadata are revalidated and, if not modified,
+        the KeyDescriptors parsed on a previous run are reused
+        :param url: URL of the metadata
+        :type url: str
+
+        :param entities: set the entityID of every EntityDescriptor is added to
+        :type entities: set
+
+        :return: yields (entityID, role descriptor, use, x509 certificate body)
+        :rtype: Iterator[tuple]
+        """
+        if self.__cache is None:
+            yield from stream_key_descriptors(url, self.__timeout, self.__logger, self.__session, entities)
+            return
+        entry = self.__cache.get(url, self.__timeout, self.__session)
+        packed = self.__cache.load_derived(entry, 'key_descriptors')
+        with entry.open() as body:
+            # Entries derived before the entities were kept are parsed again
+            if packed is None or 'entities' not in packed:
+                # Kept for the later runs, whatever this one needs
+                seen = set() if entities is None else entities
+                packed = pack_key_descriptors(iter_key_descriptors(body, seen), seen)
+                self.__cache.store_derived(entry, 'key_descriptors', packed)
+            else:
+                self.__logger.debug('Reuse parsed KeyDescriptors of ' + url)
+                if entities is not None:
+                    entities.update(packed['entities'])
+        yield from unpack_key_descriptors(packed)
+
+    def __save_cert_cache(self):
+        """Persist the certificates parsed in this run"""
+        if self.__cert_cache is not None:
+            self.__cert_cache.save()
+
+    def __evaluate_aggregate_cert(self, x509):
+        """
+        :return: status and details of the certificate
+        :rtype: dict
+        """
+        try:
+            expiration_days, certData = evaluate_single_certificate(x509, self.__cert_cache)
+        except Exception as e:
+            return {'status': NagiosStatusCode.UNKNOWN.name, 'error': 'Invalid certificate: ' + repr(e.__cause__ or e)}
+        status, code = get_nagios_status_n_code(expiration_days, self.__args.warning, self.__args.critical)
+        return {
+            'status': status,
+            'expiration_days': expiration_days,
+            'not_after': str(cert_date(certData['not After'])),
+            'subject': certData['Subject'].get('CN', ''),
+            'issuer': certData['Issuer'].get('CN', '')
+        }
+
+
+def pack_key_descriptors(key_descriptors, entities=None):
+    """
+    Pack the KeyDescriptors in a json serializable form. Certificates shared by many entities are stored once
+    :param key_descriptors: iterator returned from iter_key_descriptors
+    :type key_descriptors: Iterator[tuple]
+
+    :param entities: the entityIDs iter_key_descriptors collects, read once the KeyDescriptors are consumed
+    :type entities: set
+
+    :return: {'certs': [certificate], 'rows': [[entityID, role descriptor, use, certificate index]],
+              'entities': [entityID]}
+    :rtype: dict
+    """
+    certs = {}
+    rows = []
+    for entity_id, role, use, x509 in key_descriptors:
+        rows.append([entity_id, role, use, certs.setdefault(x509, len(certs))])
+    return {'certs': list(certs), 'rows': rows, 'entities': sorted(entities or (), key=str)}
+
+
+def unpack_key_descriptors(packed):
+    """
+    :param packed: the KeyDescriptors returned from pack_key_descriptors
+    :type packed: dict
+
+    :return: yields (entityID, role descriptor, use, x509 certificate body)
+    :rtype: Iterator[tuple]
+    """
+    certs = packed['certs']
+    for entity_id, role, use, index in packed['rows']:
+        yield entity_id, role, use, certs[index]
+
+
+def read_targets(targets_file, default_certuse):
+    """
+    Read the target list. One target per line: HOSTNAME ENDPOINT [CERTUSE]. Empty lines and lines
+    starting with # are ignored
+    :param targets_file: path of the file or - for stdin
+    :type targets_file: str
+
+    :param default_certuse: certificate use of the targets that do not define one
+    :type default_certuse: str
+
+    :return: list of (hostname, endpoint, certuse)
+    :rtype: list
+
+    :raises ValueError: if a line is malformed
+    """
+    if targets_file == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(targets_file, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+
+    targets = []
+    for line in lines:
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        if len(fields) not in [2, 3] or (len(fields) == 3 and fields[2] not in CERT_USES):
+            raise ValueError("Invalid target line: " + line)
+        targets.append((fields[0], fields[1].lstrip('/'), fields[2] if len(fields) == 3 else default_certuse))
+    return targets
+
 
 def parse_arguments(args):
     """
@@ -98,20 +425,57 @@ def parse_arguments(args):
     parser.add_argument('--warning', '-w', dest="warning", help='Warning threshold', type=int, default=30)
     parser.add_argument('--critical', '-c', dest="critical", help='Critical threshold', type=int, default=10)
     parser.add_argument('--certuse', '-s', dest="certuse", help='Certificate Use', default='signing',
-                        choices=['signing', 'encryption', 'all'])
-    parser.add_argument('--hostname', '-H', dest="hostname", required=True,
-                        help='Domain, protocol assumed to be https, e.g. example.com')
-    parser.add_argument('--endpoint', '-e', dest="endpoint", required=True,
-                        help='Metadata endpoint, e.g. proxy/saml2/idp/metadata.php')
+                        choices=CERT_USES)
+    parser.add_argument('--hostname', '-H', dest="hostname",
+                        help='Domain, protocol assumed to be https, e.g. example.com. Required unless --targets is used')
+    parser.add_argument('--endpoint', '-e', dest="endpoint",
+                        help='Metadata endpoint, e.g. proxy/saml2/idp/metadata.php. Required unless --targets is used')
+    # A run checks either many targets or one aggregate
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--targets', '-T', dest="targets",
+                      help='File with one target per line: HOSTNAME ENDPOINT [CERTUSE]. Use - to read from stdin. '
+                           'All targets are checked concurrently and one line per target is printed')
+    mode.add_argument('--aggregate', dest="aggregate",
+                      help='No Value needed. The endpoint serves a federation aggregate. Evaluate the certificates '
+                           'of every entity and role and print the number of certificates per state',
+                      action='store_true')
+    parser.add_argument('--workers', '-W', dest="workers", type=int, default=10,
+                        help='Number of targets checked concurrently in --targets mode. Default is 10.')
+    parser.add_argument('--report', dest="report",
+                        help='In --aggregate mode write one json line per entityID, role and certificate in this file')
+    parser.add_argument('--summary', dest="summary",
+                        help='No Value needed. In --targets mode print a worst state summary line first',
+                        action='store_true')
     parser.add_argument('--timeout', '-t', dest="timeout", type=int,
                         help='Timeout after x seconds.Default is 5s.', default=5)
+    parser.add_argument('--cache-dir', dest="cache_dir",
+                        help='Cache the metadata in this directory and revalidate them with ETag/Last-Modified. '
+                             'Unchanged metadata are neither downloaded nor parsed again')
+    parser.add_argument('--cache-size', dest="cache_size", type=int, default=ParamDefaults.CACHE_SIZE_MB.value,
+                        help='Size bound of the cache directory in MB. Default is '
+                             + str(ParamDefaults.CACHE_SIZE_MB.value) + 'MB.')
+    parser.add_argument('--cert-cache', dest="cert_cache",
+                        help='Keep the attributes of the evaluated certificates in this file, keyed by their SHA-256 '
+                             'fingerprint. Known certificates are not parsed again')
     parser.add_argument('--logowner', '-o', dest="logowner", default=ParamDefaults.LOG_OWNER.value,
                         help='Owner of the log file rciam_probes.log under /var/log/rciam_probes/. Default owner is nagios user.')
     parser.add_argument('--console', '-C', dest="console",
                         help='No Value needed. The presence of the flag indicates log output in stdout',
                         action='store_true')
+    parser.add_argument('--log-queue', dest="log_queue",
+                        help='No Value needed. Log calls only queue the records and a background thread writes them '
+                             'in batches',
+                        action='store_true')
+    parser.add_argument('--syslog', dest="syslog", nargs='?', const=ParamDefaults.SYSLOG_SOCKET.value,
+                        help='Ship the log records to the syslog or log collector socket SYSLOG, a path or HOST:PORT, '
+                             'instead of the log file. Defaults to ' + ParamDefaults.SYSLOG_SOCKET.value)
 
-    return parser.parse_args(args)
+    parsed_args = parser.parse_args(args)
+    if parsed_args.targets is None and (parsed_args.hostname is None or parsed_args.endpoint is None):
+        parser.error('the following arguments are required: --hostname/-H, --endpoint/-e')
+    if parsed_args.report is not None and not parsed_args.aggregate:
+        parser.error('argument --report: only allowed with --aggregate')
+    return parsed_args
 
 
 # Entry point
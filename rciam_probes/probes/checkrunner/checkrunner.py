@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from rciam_probes.probes.checkhealth.browserpool import BrowserPool
+from rciam_probes.probes.checkhealth.checkloginmatrix import evaluate_login_options
+from rciam_probes.probes.checkmetadata.checkmetadata import RciamMetadataCheck
+from rciam_probes.shared.cache import CertCache, HttpCache
+from rciam_probes.shared.enums import *
+from rciam_probes.shared.templates import *
+from rciam_probes.shared.utils import *
+
+CHECK_TYPES = ['cert', 'login']
+"""checkcert options the runner does not support. Every cert check evaluates one metadata endpoint"""
+UNSUPPORTED_CERT_OPTIONS = ['targets', 'T', 'aggregate', 'report', 'summary']
+
+
+class RciamCheckRunner:
+    """
+    Run the cert and login checks of a config file in one process. The checks share the logger, the HTTP session,
+    the metadata and certificate caches and a bounded pool of browsers
+    """
+    __args = None
+    __logger = None
+    __session = None
+    __cache = None
+    __cert_cache = None
+    __pool = None
+
+    def __init__(self, args=sys.argv[1:]):
+        """
+        Initialize
+        :param args: list of arguments
+        :type args: list
+        """
+        self.__args = parse_arguments(args)
+        self.__logger = configure_logger(self.__args)
+        self.__session = create_http_session(self.__args.workers)
+        if self.__args.cache_dir is not None:
+            self.__cache = HttpCache(self.__args.cache_dir, self.__args.cache_size * 1024 * 1024, self.__logger)
+        if self.__args.cert_cache is not None:
+            self.__cert_cache = CertCache(self.__args.cert_cache, logger=self.__logger)
+        self.__pool = BrowserPool(self.__args, self.__args.pool_size, self.__args.max_uses, self.__logger)
+
+    def check_all(self):
+        """Evaluate all the checks, print the results and exit with the worst state"""
+        self.__logger.info(' '.join([(repr(arg) if ' ' in arg else arg) for arg in sys.argv]))
+        try:
+            checks = read_checks(self.__args.config)
+        except (OSError, ValueError) as e:
+            self.__logger.critical("Check runner config: " + str(e))
+            exit(NagiosStatusCode.UNKNOWN.value)
+
+        try:
+            results = self.run_checks(checks)
+        finally:
+            self.__pool.close()
+            if self.__cert_cache is not None:
+                self.__cert_cache.save()
+
+        ncode = max([result['code'] for result in results], default=NagiosStatusCode.UNKNOWN.value)
+        if self.__args.format == 'json':
+            msg = '\n'.join(json.dumps(result) for result in results)
+        else:
+            counts = {status: 0 for status in NagiosStatusCode}
+            for result in results:
+                counts[NagiosStatusCode(result['code'])] += 1
+            msg_list = [check_runner_tmpl.substitute(defaults_check_runner, name=result['name'], msg=result['msg'])
+                        for result in results]
+            # Nagios takes the first line as the status and the rest as long output
+            msg_list.insert(0, check_runner_summary_tmpl.substitute(defaults_check_runner_summary,
+                                                                    status=NagiosStatusCode(ncode).name,
+                                                                    checks=len(results),
+                                                                    ok=counts[NagiosStatusCode.OK],
+                                                                    warning=counts[NagiosStatusCode.WARNING],
+                                                                    critical=counts[NagiosStatusCode.CRITICAL],
+                                                                    unknown=counts[NagiosStatusCode.UNKNOWN]))
+            msg = '\n'.join(msg_list)
+        # print to logs
+        self.__logger.info(msg)
+        # print to output
+        print(msg)
+        exit(ncode)
+
+    def run_checks(self, checks):
+        """
+        Evaluate the checks concurrently. Login checks on a browser wait for one of the pool
+        :param checks: check definitions returned from read_checks
+        :type checks: list
+
+        :return: one record per check, in the order of the config
+        :rtype: list
+        """
+        with ThreadPoolExecutor(max_workers=self.__args.workers) as executor:
+            return list(executor.map(self.evaluate_check, checks))
+
+    def evaluate_check(self, check):
+        """
+        Evaluate one check. Failures are reported in the record, the runner never exits on a check
+        :param check: check type and its checkcert or checklogin options
+        :type check: dict
+
+        :return: {"name", "type", "status", "code", "msg"}
+        :rtype: dict
+        """
+        options = dict(check)
+        check_type = options.pop('type')
+        name = options.pop('name', None)
+        if check_type == 'cert':
+            msg, code, label = self.__evaluate_cert(options)
+        else:
+            msg, code, check_opts = evaluate_login_options(self.__pool, options, self.__logger, self.__session)
+            label = check_opts.sp + ' via ' + check_opts.identity if check_opts else None
+        return {
+            'name': name or label or check_type,
+            'type': check_type,
+            'status': NagiosStatusCode(code).name,
+            'code': code,
+            'msg': msg,
+        }
+
+    def __evaluate_cert(self, options):
+        """
+        :param options: checkcert options of the check
+        :type options: dict
+
+        :return: Nagios message, NagiosStatusCode exit code and a label of the metadata, None if invalid
+        :rtype: (str, int, str)
+        """
+        unsupported = [option for option in UNSUPPORTED_CERT_OPTIONS if options.get(option)]
+        try:
+            if unsupported:
+                raise SystemExit(2)
+            check = RciamMetadataCheck(options_to_arguments(options), logger=self.__logger, session=self.__session,
+                                       cache=self.__cache, cert_cache=self.__cert_cache)
+        except SystemExit:
+            # argparse exits on invalid arguments
+            self.__logger.critical('Invalid cert check: ' + json.dumps(options))
+            return "State " + NagiosStatusCode.UNKNOWN.name + "(Invalid arguments)", \
+                   NagiosStatusCode.UNKNOWN.value, None
+        msg, code = check.evaluate_cert()
+        return msg, code, str(options.get('hostname', options.get('H'))) + '/' \
+                          + str(options.get('endpoint', options.get('e'))).lstrip('/')
+
+
+def read_checks(config_file):
+    """
+    Read the check runner config. The config holds the options shared by all the checks of a type under "defaults"
+    and one entry per check under "checks". Every check has a "type", cert or login, an optional "name" and the
+    checkcert or checklogin options, e.g.
+    {"defaults": {"cert": {"warning": 30}, "login": {"hostname": "example.com", "username": "user"}},
+     "checks": [{"type": "cert", "hostname": "example.com", "endpoint": "proxy/saml2/idp/metadata.php"},
+                {"type": "login", "sp": "https://sp.example.com/login", "idp": "https://idp.example.org/idp"}]}
+    Files ending in .yaml or .yml are read as YAML, all others and stdin as json
+    :param config_file: path of the file or - for stdin
+    :type config_file: str
+
+    :return: list of checks with the defaults of their type applied
+    :rtype: list
+
+    :raises ValueError: if the config is malformed
+    """
+    if config_file == '-':
+        config = json.load(sys.stdin)
+    elif config_file.endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError('PyYAML is required for YAML configs')
+        with open(config_file, encoding='utf-8') as f:
+            try:
+                config = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ValueError(str(e))
+    else:
+        with open(config_file, encoding='utf-8') as f:
+            config = json.load(f)
+
+    if not isinstance(config, dict) or not isinstance(config.get('checks'), list):
+        raise ValueError('"checks" list is missing')
+    defaults = config.get('defaults', {})
+    if not isinstance(defaults, dict) or not all(isinstance(defaults.get(check_type, {}), dict)
+                                                 for check_type in CHECK_TYPES):
+        raise ValueError('"defaults" is not an object of check types')
+
+    checks = []
+    for check in config['checks']:
+        if not isinstance(check, dict) or check.get('type') not in CHECK_TYPES:
+            raise ValueError('Invalid check: ' + json.dumps(check))
+        options = dict(defaults.get(check['type'], {}))
+        options.update(check)
+        checks.append(options)
+    return checks
+
+
+def parse_arguments(args):
+    """
+    Parse the arguments provided in the command line
+    :param args: list of arguments
+    :type args: list
+    :return: argument object
+    :rtype: ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description="Run the cert and login checks of RCIAM in one process")
+
+    parser.add_argument('--config', '-c', dest="config", required=True,
+                        help='json or YAML file with the checkcert and checklogin options of every check. '
+                             'Use - to read json from stdin')
+    parser.add_argument('--format', '-F', dest="format", choices=['nagios', 'json'], default='nagios',
+                        help='nagios prints a worst state summary line and one line per check, json prints one json '
+                             'record per check and line. Defaults to nagios')
+    parser.add_argument('--workers', '-W', dest="workers", type=int, default=10,
+                        help='Number of checks evaluated concurrently. Default is 10.')
+    parser.add_argument('--pool-size', '-n', dest="pool_size",
+                        help='Number of browsers, i.e. browser login checks run concurrently. Defaults to '
+                             + str(ParamDefaults.DAEMON_POOL_SIZE.value),
+                        type=int, default=ParamDefaults.DAEMON_POOL_SIZE.value)
+    parser.add_argument('--max-uses', dest="max_uses",
+                        help='Number of checks a browser serves before it gets replaced',
+                        type=int, default=ParamDefaults.DAEMON_MAX_USES.value)
+    parser.add_argument('--firefox', '-f', dest="firefox", help='Firefox binary full path',
+                        default=ParamDefaults.FIREFOX_PATH.value)
+    parser.add_argument('--geckodriver', '-g', dest="geckodriver", help='geckodriver binary full path',
+                        default=ParamDefaults.GECKODRIVER_PATH.value)
+    parser.add_argument('--cache-dir', dest="cache_dir",
+                        help='Cache the metadata of all the cert checks in this directory and revalidate them with '
+                             'ETag/Last-Modified')
+    parser.add_argument('--cache-size', dest="cache_size", type=int, default=ParamDefaults.CACHE_SIZE_MB.value,
+                        help='Size bound of the cache directory in MB. Default is '
+                             + str(ParamDefaults.CACHE_SIZE_MB.value) + 'MB.')
+    parser.add_argument('--cert-cache', dest="cert_cache",
+                        help='Keep the attributes of the certificates evaluated by all the cert checks in this file')
+    parser.add_argument('--log', '-l', dest="log", help='Logfile full path', default=ParamDefaults.LOG_FILE.value)
+    parser.add_argument('--verbose', '-v', dest="verbose", help='Set log verbosity, levels are -v to -vvvv',
+                        action="count",
+                        default=0)
+    parser.add_argument('--console', '-C', dest="console",
+                        help='No Value needed. The presence of the flag indicates log output in stdout',
+                        action='store_true')
+    parser.add_argument('--log-queue', dest="log_queue",
+                        help='No Value needed. Log calls only queue the records and a background thread writes them '
+                             'in batches',
+                        action='store_true')
+    parser.add_argument('--syslog', dest="syslog", nargs='?', const=ParamDefaults.SYSLOG_SOCKET.value,
+                        help='Ship the log records to the syslog or log collector socket SYSLOG, a path or HOST:PORT, '
+                             'instead of the log file. Defaults to ' + ParamDefaults.SYSLOG_SOCKET.value)
+    parser.add_argument('--logowner', '-o', dest="logowner", default=ParamDefaults.LOG_OWNER.value,
+                        help='Owner of the log file rciam_probes.log under /var/log/rciam_probes/. Default owner is nagios user.')
+
+    return parser.parse_args(args)
+
+
+# Entry point
+if __name__ == "__main__":
+    runner = RciamCheckRunner()
+    runner.check_all()
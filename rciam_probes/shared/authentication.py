@@ -2,17 +2,20 @@ import copy
 import http
 
 import requests
-from bs4 import BeautifulSoup
 from requests.auth import HTTPBasicAuth
+from urllib.parse import urlparse
+
 try:
-    from selenium.webdriver.support.ui import WebDriverWait
-    from selenium.webdriver.support import expected_conditions as EC
-    from selenium.webdriver.common.by import By
+    from selenium.common.exceptions import WebDriverException
 except ImportError:
+    from rciam_probes.shared.waits import WebDriverException
     has_selenium = False
 else:
     has_selenium = True
 
+from rciam_probes.shared.enums import ParamDefaults
+from rciam_probes.shared.waits import PageWait
+
 def parse_cookies(http_response):
     """
     Read the cookies from the header and add create a dictionary out of them(Morsel type cookies)
@@ -69,7 +72,7 @@ def append_cookie_to_driver_from_request(http_response, driver_cookies):
         driver_cookies.append(dc_cookie)
 
 
-def browser_load_cookies(browser, cookies, url):
+def browser_load_cookies(browser, cookies, url, poll=ParamDefaults.WAIT_POLL.value):
     """
     :param browser: Webdriver Object
     :type browser: Webdriver Object
@@ -79,16 +82,47 @@ def browser_load_cookies(browser, cookies, url):
 
     :param url: Url i want to load the cookies for
     :type url: string
+
+    :param poll: seconds between checks of the page conditions that no DOM change reports
+    :type poll: float
     """
     if url is None:
         return
     browser.get(url)
     browser.delete_all_cookies()
-    WebDriverWait(browser, 3).until(EC.element_to_be_clickable((By.CSS_SELECTOR, "a")))
+    PageWait(browser, 3, poll).clickable('a')
     for cookie in cookies:
         browser.add_cookie(cookie)
 
 
+def browser_restore_cookies(browser, cookies, url):
+    """
+    Add cookies saved from a previous session. The browser first loads a page of the host the cookies belong to
+    :param browser: Webdriver Object
+    :type browser: Webdriver Object
+
+    :param cookies: list of Webdriver compatible cookies
+    :type cookies: list
+
+    :param url: a url of the host of the cookies
+    :type url: string
+
+    :return: the number of cookies added
+    :rtype: int
+    """
+    # robots.txt is small and, even if missing, it does not redirect away from the host
+    parsed_url = urlparse(url)
+    browser.get(parsed_url.scheme + '://' + parsed_url.netloc + '/robots.txt')
+    added = 0
+    for cookie in cookies:
+        try:
+            browser.add_cookie(cookie)
+        except WebDriverException:
+            continue
+        added += 1
+    return added
+
+
 def base_auth_login(endpoint, args, cached_cookie, logger=None):
     """
     Perform one hop or two hop Basic authentication with SAML response
@@ -108,6 +142,7 @@ def base_auth_login(endpoint, args, cached_cookie, logger=None):
     :return: the last url of submitted request
     :rtype: str
     """
+    from bs4 import BeautifulSoup
     try:
         last_url = None
         # fixme: i think i do not need to transfer the session. I only need the state here
@@ -118,7 +153,7 @@ def base_auth_login(endpoint, args, cached_cookie, logger=None):
         r_get.raise_for_status()
         last_url = r_get.url
         if logger is not None:
-            logger.debug(r_get.url + ' \nAuthenticate::Status:' + str(r_get.status_code))
+            logger.debug('%s \nAuthenticate::Status:%s', r_get.url, r_get.status_code)
         append_cookie_to_driver_from_request(r_get, cached_cookie)
         # This now returns the SAMLResponse or not. Check and then proceed
         # This is an auto submit page. We should handle it manually with requests lib
@@ -138,7 +173,7 @@ def base_auth_login(endpoint, args, cached_cookie, logger=None):
             r_post.raise_for_status()
             last_url = r_post.url
             if logger is not None:
-                logger.debug(r_post.url + ' \nSAMLResponse::Status:' + str(r_post.status_code))
+                logger.debug('%s \nSAMLResponse::Status:%s', r_post.url, r_post.status_code)
             append_cookie_to_driver_from_request(r_post, cached_cookie)
 
         return last_url
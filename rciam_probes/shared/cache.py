@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import base64
+import binascii
+import fcntl
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+from rciam_probes.shared.enums import ParamDefaults
+from rciam_probes.shared.utils import write_text_atomic
+
+
+class CacheEntry:
+    """A response body served from the cache directory or, if not cacheable, from memory"""
+    url = None
+    digest = None
+    from_cache = False
+    __body = None
+
+    def __init__(self, url, body, digest=None, from_cache=False):
+        """
+        :param url: URL of the body
+        :type url: str
+
+        :param body: binary file object positioned at the start of the body
+        :type body: BinaryIO
+
+        :param digest: sha256 of the body. None if the body is not cached
+        :type digest: str
+
+        :param from_cache: True if the server answered 304 Not Modified
+        :type from_cache: bool
+        """
+        self.url = url
+        self.digest = digest
+        self.from_cache = from_cache
+        self.__body = body
+
+    def open(self):
+        """
+        :return: binary file object positioned at the start of the body. The caller closes it
+        :rtype: BinaryIO
+        """
+        return self.__body
+
+
+class HttpCache:
+    """
+    Persistent HTTP cache keyed by URL. Every entry is a single file holding a json header line(ETag,
+    Last-Modified, body digest) followed by the body. Entries are revalidated with If-None-Match/If-Modified-Since
+    and the cached body is reused on 304. Data derived from a body(e.g. the parsed certificates) can be stored
+    next to the entry and stay valid as long as the body digest does not change.
+
+    Files are written in a temporary file and renamed into place, so concurrent probe processes never see
+    partial entries. The total size is bounded and the least recently used entries are evicted first.
+    """
+    __directory = None
+    __max_size = None
+    __logger = None
+
+    def __init__(self, directory, max_size=ParamDefaults.CACHE_SIZE_MB.value * 1024 * 1024, logger=None):
+        """
+        :param directory: the cache directory. Created if missing
+        :type directory: str
+
+        :param max_size: size bound of the cache in bytes
+        :type max_size: int
+
+        :param logger: Logger object
+        :type logger: Logger
+        """
+        self.__directory = Path(directory)
+        self.__directory.mkdir(0o755, parents=True, exist_ok=True)
+        self.__max_size = max_size
+        self.__logger = logger
+
+    def get(self, url, timeout=5, session=None):
+        """
+        Conditional GET of the url
+        :param url: URL
+        :type url: str
+
+        :param timeout: seconds to wait for the server
+        :type timeout: int
+
+        :param session: requests session to reuse pooled connections
+        :type session: requests.Session
+
+        :return: the entry of the body
+        :rtype: CacheEntry
+        """
+        entry_path = self.__entry_path(url)
+        # Keep the entry open. Another process may replace it while we revalidate
+        header, body = self.__open_entry(entry_path)
+        request_headers = {}
+        if header is not None:
+            if header.get('etag'):
+                request_headers['If-None-Match'] = header['etag']
+            if header.get('last_modified'):
+                request_headers['If-Modified-Since'] = header['last_modified']
+
+        try:
+            requests.packages.urllib3.disable_warnings()
+            response = (session or requests).get(url, verify=False, timeout=timeout, headers=request_headers,
+                                                 stream=True)
+            try:
+                if response.status_code == 304 and header is not None:
+                    self.__debug('Not modified, reuse cached body of ' + url)
+                    # Mark as recently used
+                    os.utime(str(entry_path))
+                    entry, body = CacheEntry(url, body, header['digest'], from_cache=True), None
+                    return entry
+                if response.status_code != 200:
+                    return CacheEntry(url, io.BytesIO(response.content))
+                response.raw.decode_content = True
+                self.__store(entry_path, {
+                    'url': url,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                }, response.raw)
+            finally:
+                response.close()
+        finally:
+            if body is not None:
+                body.close()
+        self.__evict()
+        header, body = self.__open_entry(entry_path)
+        if header is None:
+            raise OSError('Cache entry of ' + url + ' vanished')
+        return CacheEntry(url, body, header['digest'])
+
+    def load_derived(self, entry, name):
+        """
+        :param entry: the entry the data were derived from
+        :type entry: CacheEntry
+
+        :param name: name of the derived data
+        :type name: str
+
+        :return: the data or None if missing or derived from another version of the body
+        :rtype: object
+        """
+        if entry.digest is None:
+            return None
+        try:
+            with open(str(self.__derived_path(entry.url, name)), encoding='utf-8') as f:
+                derived = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if derived.get('digest') != entry.digest:
+            return None
+        return derived.get('data')
+
+    def store_derived(self, entry, name, data):
+        """
+        :param entry: the entry the data were derived from
+        :type entry: CacheEntry
+
+        :param name: name of the derived data
+        :type name: str
+
+        :param data: json serializable data
+        :type data: object
+        """
+        if entry.digest is None:
+            return
+        path = self.__derived_path(entry.url, name)
+        tmp_path = self.__tmp_path(path)
+        try:
+            with open(str(tmp_path), 'w', encoding='utf-8') as f:
+                json.dump({'digest': entry.digest, 'data': data}, f)
+            os.replace(str(tmp_path), str(path))
+        except OSError as e:
+            self.__debug('Could not store ' + str(path) + ': ' + str(e))
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        self.__evict()
+
+    def __store(self, entry_path, header, body):
+        """Stream the body into the entry file"""
+        tmp_path = self.__tmp_path(entry_path)
+        sha256 = hashlib.sha256()
+        try:
+            with open(str(tmp_path), 'wb') as f:
+                # Reserve a fixed width for the digest so that the header can be written before the body
+                header['digest'] = '0' * 64
+                f.write((json.dumps(header) + '\n').encode())
+                for chunk in iter(lambda: body.read(64 * 1024), b''):
+                    sha256.update(chunk)
+                    f.write(chunk)
+                header['digest'] = sha256.hexdigest()
+                f.seek(0)
+                f.write((json.dumps(header) + '\n').encode())
+            os.replace(str(tmp_path), str(entry_path))
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    def __open_entry(self, entry_path):
+        """
+        :return: the header of the entry and the entry file positioned at the body, (None, None) if there
+                 is no valid entry
+        :rtype: (dict, BinaryIO)
+        """
+        try:
+            f = open(str(entry_path), 'rb')
+        except OSError:
+            return None, None
+        try:
+            return json.loads(f.readline()), f
+        except ValueError:
+            f.close()
+            return None, None
+
+    def __evict(self):
+        """Remove the least recently used files until the cache fits in its size bound"""
+        try:
+            with open(str(self.__directory.joinpath('.lock')), 'w') as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Another process is already evicting
+                    return
+                files = []
+                for dir_entry in os.scandir(str(self.__directory)):
+                    if not dir_entry.is_file():
+                        continue
+                    stat = dir_entry.stat()
+                    if not dir_entry.name.startswith('.'):
+                        files.append((stat.st_mtime, stat.st_size, dir_entry.path))
+                    elif dir_entry.name.endswith('.tmp') and stat.st_mtime < time.time() - 3600:
+                        # Left behind by a killed process
+                        os.unlink(dir_entry.path)
+                total = sum(size for mtime, size, path in files)
+                for mtime, size, path in sorted(files):
+                    if total <= self.__max_size:
+                        break
+                    self.__debug('Evict ' + path)
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+        except OSError as e:
+            self.__debug('Cache eviction failed: ' + str(e))
+
+    def __key(self, url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def __entry_path(self, url):
+        return self.__directory.joinpath(self.__key(url) + '.entry')
+
+    def __derived_path(self, url, name):
+        return self.__directory.joinpath(self.__key(url) + '.' + name + '.derived')
+
+    def __tmp_path(self, path):
+        return path.with_name('.' + path.name + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp')
+
+    def __debug(self, msg):
+        if self.__logger is not None:
+            self.__logger.debug(msg)
+
+
+class CertCache:
+    """
+    Persistent cache of the certificate attributes the probes evaluate, keyed by the SHA-256 fingerprint of the
+    DER bytes. A certificate is parsed once and later runs only recompute the days to expiration from its notAfter,
+    kept in seconds since the epoch. The cache is a single json file. Entries not seen for the longest time are
+    dropped above max_entries.
+    """
+    __path = None
+    __max_entries = None
+    __logger = None
+    __entries = None
+    __dirty = False
+    __lock = None
+
+    def __init__(self, path, max_entries=ParamDefaults.CERT_CACHE_ENTRIES.value, logger=None):
+        """
+        :param path: the cache file. Created on save if missing
+        :type path: str
+
+        :param max_entries: maximum number of certificates kept
+        :type max_entries: int
+
+        :param logger: Logger object
+        :type logger: Logger
+        """
+        self.__path = Path(path)
+        self.__max_entries = max_entries
+        self.__logger = logger
+        self.__lock = threading.Lock()
+        self.__entries = self.__load()
+
+    def get(self, x509):
+        """
+        :param x509: body of x509
+        :type x509: str
+
+        :return: Certificates Attributes(Subject, Issuer, not Before, not After in seconds since the epoch) or None
+                 if not cached
+        :rtype: dict
+        """
+        fingerprint = cert_fingerprint(x509)
+        if fingerprint is None:
+            return None
+        with self.__lock:
+            entry = self.__entries.get(fingerprint)
+            if entry is None:
+                return None
+            now = int(time.time())
+            # Refresh the last seen time once a day. No need to rewrite the file on every run
+            if now - entry['seen'] > 86400:
+                entry['seen'] = now
+                self.__dirty = True
+        return {
+            'Subject': {'CN': entry['subject']} if entry['subject'] is not None else {},
+            'Issuer': {'CN': entry['issuer']} if entry['issuer'] is not None else {},
+            'not Before': entry['not_before'],
+            'not After': entry['not_after'],
+        }
+
+    def put(self, x509, cert_data):
+        """
+        :param x509: body of x509
+        :type x509: str
+
+        :param cert_data: Certificates Attributes returned from evaluate_single_certificate, dates in seconds since
+                          the epoch
+        :type cert_data: dict
+        """
+        fingerprint = cert_fingerprint(x509)
+        if fingerprint is None:
+            return
+        with self.__lock:
+            self.__entries[fingerprint] = {
+                'subject': cert_data['Subject'].get('CN'),
+                'issuer': cert_data['Issuer'].get('CN'),
+                'not_before': cert_data['not Before'],
+                'not_after': cert_data['not After'],
+                'seen': int(time.time()),
+            }
+            self.__dirty = True
+
+    def save(self):
+        """Merge the entries with the ones other probes saved in the meantime and write the cache file"""
+        with self.__lock:
+            if not self.__dirty:
+                return
+            entries = self.__load()
+            for fingerprint, entry in self.__entries.items():
+                if fingerprint not in entries or entries[fingerprint]['seen'] < entry['seen']:
+                    entries[fingerprint] = entry
+            if len(entries) > self.__max_entries:
+                newest = sorted(entries.items(), key=lambda item: item[1]['seen'], reverse=True)
+                entries = dict(newest[:self.__max_entries])
+            try:
+                self.__path.parent.mkdir(0o755, parents=True, exist_ok=True)
+                write_text_atomic(self.__path, json.dumps(entries))
+            except OSError as e:
+                if self.__logger is not None:
+                    self.__logger.warning('Could not save the certificate cache ' + str(self.__path) + ': ' + str(e))
+                return
+            self.__entries = entries
+            self.__dirty = False
+
+    def __load(self):
+        """
+        :return: the entries of the cache file. Empty if missing or corrupted
+        :rtype: dict
+        """
+        try:
+            with open(str(self.__path), encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+
+class IdpSessionCache:
+    """
+    IdP session cookies of a user, kept on disk so that later runs skip the IdP authentication. A directory holds
+    one file per IdP and username. Files are readable only by their owner and are ignored otherwise.
+    A session is reused for ttl minutes after the full login that created it.
+    """
+    __directory = None
+    __ttl = None
+    __logger = None
+
+    def __init__(self, directory, ttl=ParamDefaults.IDP_SESSION_TTL.value, logger=None):
+        """
+        :param directory: the session directory. Created, accessible only by its owner, if missing
+        :type directory: str
+
+        :param ttl: minutes a session is reused for
+        :type ttl: int
+
+        :param logger: Logger object
+        :type logger: Logger
+        """
+        self.__directory = Path(directory)
+        self.__ttl = ttl
+        self.__logger = logger
+
+    def load(self, identity, username):
+        """
+        :param identity: the IdP entityID(s) the session belongs to
+        :type identity: str
+
+        :param username: the user the session belongs to
+        :type username: str
+
+        :return: the IdP login page url and the Webdriver compatible cookies, None if there is no valid session
+        :rtype: (str, list)
+        """
+        path = self.__path(identity, username)
+        try:
+            with open(str(path), encoding='utf-8') as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_uid != os.geteuid() or stat.st_mode & 0o077:
+                    self.__warning('Ignore the IdP session ' + str(path) + ', it is accessible by other users')
+                    return None
+                session = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.__warning('Could not read the IdP session ' + str(path) + ': ' + str(e))
+            return None
+
+        now = time.time()
+        if not isinstance(session, dict) or session.get('created', 0) + self.__ttl * 60 < now:
+            return None
+        # Session cookies have no expiry. They live as long as the cached session
+        cookies = [cookie for cookie in session.get('cookies', []) if cookie.get('expiry', now) >= now]
+        if not cookies or not session.get('url'):
+            return None
+        return session['url'], cookies
+
+    def save(self, identity, username, url, cookies):
+        """
+        :param identity: the IdP entityID(s) the session belongs to
+        :type identity: str
+
+        :param username: the user the session belongs to
+        :type username: str
+
+        :param url: the IdP login page url
+        :type url: str
+
+        :param cookies: the Webdriver compatible cookies of the IdP
+        :type cookies: list
+        """
+        path = self.__path(identity, username)
+        try:
+            self.__directory.mkdir(0o700, parents=True, exist_ok=True)
+            write_text_atomic(path, json.dumps({'created': int(time.time()), 'url': url, 'cookies': cookies}),
+                              mode=0o600)
+        except OSError as e:
+            self.__warning('Could not save the IdP session ' + str(path) + ': ' + str(e))
+
+    def discard(self, identity, username):
+        """Remove the session, e.g. when the IdP no longer accepts it"""
+        try:
+            self.__path(identity, username).unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.__warning('Could not remove the IdP session: ' + str(e))
+
+    def __path(self, identity, username):
+        return self.__directory.joinpath(hashlib.sha256((identity + '\n' + username).encode()).hexdigest() + '.session')
+
+    def __warning(self, msg):
+        if self.__logger is not None:
+            self.__logger.warning(msg)
+
+
+def cert_fingerprint(x509):
+    """
+    :param x509: body of x509
+    :type x509: str
+
+    :return: SHA-256 of the DER bytes in hex, None if the body is not valid base64
+    :rtype: str
+    """
+    try:
+        der = base64.b64decode(''.join(x509.split()), validate=True)
+    except (binascii.Error, ValueError):
+        return None
+    return hashlib.sha256(der).hexdigest()
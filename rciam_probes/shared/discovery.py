@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+from urllib.parse import parse_qs, quote, urlencode, urlparse
+
+import requests
+
+from rciam_probes.shared.interceptors import LOGIN_UI_DOMAINS, in_domains
+
+"""Parameters of the SAML Identity Provider Discovery protocol request the SP sends to the discovery service"""
+DISCOVERY_RETURN = 'return'
+DISCOVERY_RETURN_ID_PARAM = 'returnIDParam'
+DISCOVERY_DEFAULT_ID_PARAM = 'entityID'
+
+
+class ThissDiscovery:
+    """
+    Select the IdP on a thiss.io discovery service without its JavaScript search page. The IdP is looked up in the
+    JSON metadata(MDQ) the page searches, and the discovery request of the page URL is answered the way the page
+    does when the IdP is clicked: by going to the return URL with the entityID of the IdP
+    """
+    __mdq_url = None
+    __session = None
+    __timeout = None
+    __logger = None
+
+    def __init__(self, mdq_url, timeout, session=None, logger=None):
+        """
+        :param mdq_url: the MDQ the discovery service searches, e.g. https://md.seamlessaccess.org/entities/
+        :type mdq_url: str
+
+        :param timeout: seconds to wait for the MDQ
+        :type timeout: int
+
+        :param session: requests session to reuse. A new one is created if not provided
+        :type session: requests.Session
+
+        :param logger: Logger object
+        :type logger: Logger
+        """
+        self.__mdq_url = mdq_url if mdq_url.endswith('/') else mdq_url + '/'
+        self.__session = session if session is not None else requests.Session()
+        self.__timeout = timeout
+        self.__logger = logger
+
+    def select(self, ds_url, entity_id, search_term=None):
+        """
+        :param ds_url: URL of the discovery service page, carrying the discovery request of the SP
+        :type ds_url: str
+
+        :param entity_id: entityID of the IdP
+        :type entity_id: str
+
+        :param search_term: what a user would type in the search box, tried if the lookup by entityID fails
+        :type search_term: str
+
+        :return: the URL the page goes to when the IdP is selected
+        :rtype: str
+
+        :raises RuntimeError: if the page carries no discovery request or the discovery service does not list the IdP
+        """
+        response_url = discovery_response_url(ds_url, entity_id)
+        entity = self.lookup(entity_id, search_term)
+        if self.__logger is not None:
+            self.__logger.debug('IdP found in the discovery service: %s', entity.get('title'))
+        return response_url
+
+    def lookup(self, entity_id, search_term=None):
+        """
+        :param entity_id: entityID of the IdP
+        :type entity_id: str
+
+        :param search_term: text to search for if the MDQ has no entry with the sha1 of the entityID
+        :type search_term: str
+
+        :return: the MDQ entry of the IdP
+        :rtype: dict
+
+        :raises RuntimeError: if the MDQ does not list the IdP or is not reachable
+        """
+        entity_hash = '{sha1}' + hashlib.sha1(entity_id.encode()).hexdigest()
+        entities = self.__get(self.__mdq_url + quote(entity_hash) + '.json')
+        if not find_entity(entities, entity_id) and search_term:
+            entities = self.__get(self.__mdq_url + '?' + urlencode({'q': search_term}))
+        entity = find_entity(entities, entity_id)
+        if entity is None:
+            raise RuntimeError("IdP '" + entity_id + "' not found in the thiss.io discovery service")
+        return entity
+
+    def __get(self, url):
+        """
+        :return: the json of the MDQ response, None if not found
+        :rtype: list|dict
+
+        :raises RuntimeError: if the MDQ is not reachable
+        """
+        if self.__logger is not None:
+            self.__logger.debug('MDQ lookup: %s', url)
+        try:
+            response = self.__session.get(url, timeout=self.__timeout, headers={'Accept': 'application/json'})
+        except requests.exceptions.Timeout:
+            raise RuntimeError('Discovery Service timeout')
+        except requests.exceptions.RequestException as e:
+            raise RuntimeError('Cannot connect to endpoint ' + url) from e
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise RuntimeError('Discovery Service unavailable[' + str(response.status_code) + ']')
+        try:
+            return response.json()
+        except ValueError:
+            raise RuntimeError('Discovery Service returned invalid json')
+
+
+def is_thiss_url(url):
+    """
+    :return: True if the url is a page of the thiss.io or Seamless Access discovery service
+    :rtype: bool
+    """
+    return in_domains(urlparse(url).hostname or '', LOGIN_UI_DOMAINS)
+
+
+def find_entity(entities, entity_id):
+    """
+    :param entities: MDQ json, one entry or a list of entries
+    :type entities: list|dict
+
+    :param entity_id: entityID of the IdP
+    :type entity_id: str
+
+    :return: the entry of the IdP, None if missing
+    :rtype: dict
+    """
+    if isinstance(entities, dict):
+        entities = [entities]
+    for entity in entities or []:
+        if isinstance(entity, dict) and entity_id in (entity.get('entityID'), entity.get('entity_id')):
+            return entity
+    return None
+
+
+def discovery_response_url(ds_url, entity_id):
+    """
+    Answer the discovery request of the SP, i.e. append the entityID of the IdP to the return URL
+    :param ds_url: URL of the discovery service page with the return and returnIDParam parameters
+    :type ds_url: str
+
+    :param entity_id: entityID of the IdP
+    :type entity_id: str
+
+    :return: the return URL with the selected IdP
+    :rtype: str
+
+    :raises RuntimeError: if the URL carries no discovery request
+    """
+    query = parse_qs(urlparse(ds_url).query)
+    if DISCOVERY_RETURN not in query:
+        raise RuntimeError('No discovery request in ' + ds_url)
+    return_url = query[DISCOVERY_RETURN][0]
+    id_param = query.get(DISCOVERY_RETURN_ID_PARAM, [DISCOVERY_DEFAULT_ID_PARAM])[0]
+    return return_url + ('&' if urlparse(return_url).query else '?') + urlencode({id_param: entity_id})
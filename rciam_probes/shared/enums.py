@@ -19,12 +19,47 @@ class ParamDefaults(Enum):
     LOG_FILE = r"/var/log/rciam_probes/rciam_probes.log"
     LOG_OWNER = "nagios"
     LOG_FORMATTER = "%(asctime)s %(processName)s[%(process)d]: %(levelname)s: %(filename)s[%(funcName)s] - %(message)s"
+    LOG_SYSLOG_FORMATTER = "[%(process)d]: %(levelname)s: %(filename)s[%(funcName)s] - %(message)s"
+    LOG_BATCH = 100
+    SYSLOG_SOCKET = r"/dev/log"
     FIREFOX_PATH = r"/usr/bin/firefox"
     JSON_PATH = r"/var/www/html"
     GECKODRIVER_PATH = r"/usr/include/rciam_probes/driver/geckodriver"
+    DAEMON_SOCKET = r"/var/run/rciam_probes/checklogind.sock"
+    DAEMON_TIMEOUT = 300
+    DAEMON_POOL_SIZE = 2
+    DAEMON_MAX_USES = 50
+    CACHE_SIZE_MB = 256
+    CERT_CACHE_ENTRIES = 50000
+    WAIT_POLL = 0.1
+    SCRIPT_TIMEOUT = 30
+    CAPTURE_RING_SIZE = 256
+    IDP_SESSION_TTL = 60
+    RESULTS_FILE = "out_results.json"
+    RESULTS_RETENTION = 7
+    HISTORY_SIZE = 64
+    HISTORY_STALE_RUNS = 3
+    TRACE_THRESHOLD = 10
+    TRACE_SIZE_MB = 64
+    TRACE_RETENTION = 7
+    SNAPSHOT_INTERVAL = 15
+    SNAPSHOT_SIZE_MB = 100
+    SNAPSHOT_RETENTION = 7
+    SNAPSHOT_WIDTH = 960
+    SNAPSHOT_QUALITY = 60
+    THISS_MDQ_URL = r"https://md.seamlessaccess.org/entities/"
 
 
 class AuthenticateTxt(Enum):
     Success = "Authentication Succeeded"
     Failed = "Authentication Failed"
     AlertFailed = "Authentication with Alert failed."
+
+
+class LoginStage(Enum):
+    DISCOVERY = "discovery"
+    IDP_AUTHENTICATION = "idp_auth"
+    IDP_CONSENT = "idp_consent"
+    SSP_MODULES = "ssp_modules"
+    OIDC_CONSENT = "oidc_consent"
+    SP_LANDING = "sp_landing"
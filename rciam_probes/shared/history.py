@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import argparse
+import fcntl
+import math
+import statistics
+import struct
+from pathlib import Path
+
+from rciam_probes.shared.enums import ParamDefaults
+from rciam_probes.shared.utils import write_bytes_atomic
+
+"""Header of a history file: magic, version, capacity, number of records and slot of the next record"""
+HISTORY_HEADER = struct.Struct('<4sHHII')
+
+"""One run of the check: unix time, login seconds(NaN if the login failed) and Nagios exit code"""
+HISTORY_RECORD = struct.Struct('<dfB3x')
+
+HISTORY_MAGIC = b'RCLH'
+HISTORY_VERSION = 1
+
+"""Largest capacity the header can hold"""
+HISTORY_MAX_SIZE = 65535
+
+
+class LatencyHistory:
+    """
+    Fixed size ring with the login time of the latest runs of a check, one fixed width binary record per run.
+    The file never grows, so readers fetch and unpack at most capacity records however long the check runs.
+    Producers update the ring under an exclusive lock and rename a complete copy over it.
+    """
+    __path = None
+    __capacity = None
+    __logger = None
+
+    def __init__(self, path, capacity=ParamDefaults.HISTORY_SIZE.value, logger=None):
+        """
+        :param path: the history file. Created on the first append
+        :type path: Path
+
+        :param capacity: number of runs kept. The oldest are overwritten first
+        :type capacity: int
+
+        :param logger: Logger object
+        :type logger: Logger
+        """
+        self.__path = Path(path)
+        self.__capacity = capacity
+        self.__logger = logger
+
+    def append(self, date, value, xcode):
+        """
+        Record a run
+        :param date: unix time of the run
+        :type date: float
+
+        :param value: login time in seconds, anything else for a failed login
+        :type value: float|str
+
+        :param xcode: NagiosStatusCode exit code
+        :type xcode: int
+        """
+        seconds = float(value) if isinstance(value, (int, float)) else math.nan
+        with open(str(self.__path.with_name('.' + self.__path.name + '.lock')), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(str(self.__path), 'rb') as f:
+                    records = read_history(f.read())
+            except OSError:
+                records = []
+            records = records[-(self.__capacity - 1):] if self.__capacity > 1 else []
+            records.append((date, seconds, xcode))
+            write_bytes_atomic(self.__path, pack_history(records, self.__capacity))
+        if self.__logger is not None:
+            self.__logger.debug('Recorded the run in ' + str(self.__path))
+
+
+def pack_history(records, capacity):
+    """
+    :param records: (date, seconds, xcode) of the runs, oldest first. At most capacity
+    :type records: list
+
+    :param capacity: number of slots of the ring
+    :type capacity: int
+
+    :return: the content of a history file
+    :rtype: bytes
+    """
+    ring = bytearray(HISTORY_HEADER.size + capacity * HISTORY_RECORD.size)
+    HISTORY_HEADER.pack_into(ring, 0, HISTORY_MAGIC, HISTORY_VERSION, capacity, len(records),
+                             len(records) % capacity)
+    for slot, (date, seconds, xcode) in enumerate(records):
+        HISTORY_RECORD.pack_into(ring, HISTORY_HEADER.size + slot * HISTORY_RECORD.size, date, seconds, xcode)
+    return bytes(ring)
+
+
+def read_history(data, last=None):
+    """
+    Unpack the latest runs of a history file. Only the requested records are unpacked
+    :param data: the content of a history file
+    :type data: bytes
+
+    :param last: number of runs to read. Defaults to all the runs kept
+    :type last: int
+
+    :return: (date, seconds, xcode) of the runs, oldest first. Empty if the file is not a valid history
+    :rtype: list
+    """
+    if len(data) < HISTORY_HEADER.size:
+        return []
+    magic, version, capacity, count, next_slot = HISTORY_HEADER.unpack_from(data, 0)
+    if magic != HISTORY_MAGIC or version != HISTORY_VERSION or capacity == 0 or count > capacity \
+            or next_slot >= capacity or len(data) != HISTORY_HEADER.size + capacity * HISTORY_RECORD.size:
+        return []
+    wanted = count if last is None else min(last, count)
+    slots = [(next_slot - wanted + index) % capacity for index in range(wanted)]
+    return [HISTORY_RECORD.unpack_from(data, HISTORY_HEADER.size + slot * HISTORY_RECORD.size) for slot in slots]
+
+
+def history_stats(records):
+    """
+    :param records: runs returned from read_history
+    :type records: list
+
+    :return: p50, p95 and max login time of the successful runs and the number of runs they cover. None if no run
+             succeeded
+    :rtype: dict
+    """
+    times = sorted(seconds for date, seconds, xcode in records if not math.isnan(seconds))
+    if not times:
+        return None
+    return {
+        'p50': round(times[math.ceil(0.5 * len(times)) - 1], 2),
+        'p95': round(times[math.ceil(0.95 * len(times)) - 1], 2),
+        'max': round(times[-1], 2),
+        'runs': len(records),
+    }
+
+
+def stale_window(records, default=30, missed_runs=ParamDefaults.HISTORY_STALE_RUNS.value):
+    """
+    Minutes after which the latest result counts as stale. Checks that run less often than the default window
+    allows get the time of missed_runs of their usual interval instead
+    :param records: runs returned from read_history
+    :type records: list
+
+    :param default: the window in minutes for checks without enough history
+    :type default: int
+
+    :param missed_runs: number of runs a check may miss before its result is stale
+    :type missed_runs: int
+
+    :return: the window in minutes
+    :rtype: float
+    """
+    intervals = [later[0] - earlier[0] for earlier, later in zip(records, records[1:]) if later[0] > earlier[0]]
+    if not intervals:
+        return default
+    return max(default, missed_runs * statistics.median(intervals) / 60)
+
+
+def history_size(value):
+    """
+    argparse type of the number of runs kept in a history file
+    :param value: the command line value
+    :type value: str
+
+    :return: the number of runs
+    :rtype: int
+
+    :raises argparse.ArgumentTypeError: if the value is not a number between 1 and HISTORY_MAX_SIZE
+    """
+    try:
+        size = int(value)
+    except ValueError:
+        size = 0
+    if not 1 <= size <= HISTORY_MAX_SIZE:
+        raise argparse.ArgumentTypeError('invalid history size: ' + repr(value) + ', expected 1 to '
+                                         + str(HISTORY_MAX_SIZE) + ' runs')
+    return size
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import re
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from urllib.parse import urlparse
+
+from rciam_probes.shared.enums import ParamDefaults
+
+"""Analytics and tracking domains. Requests to them are always aborted"""
+TRACKER_DOMAINS = ('google-analytics.com', 'googletagmanager.com', 'doubleclick.net', 'hotjar.com', 'matomo.cloud',
+                   'facebook.net', 'clarity.ms', 'newrelic.com', 'nr-data.net', 'sentry.io')
+
+"""Third party domains whose scripts the login UI needs, e.g. the thiss.io discovery service"""
+LOGIN_UI_DOMAINS = ('seamlessaccess.org', 'thiss.io')
+
+"""Resource types the login flow never needs. Values of the Sec-Fetch-Dest request header"""
+BLOCKED_RESOURCE_TYPES = ('image', 'font', 'audio', 'video', 'track', 'manifest', 'object', 'embed', 'report')
+
+"""Resource type by file extension, for requests without a Sec-Fetch-Dest header"""
+RESOURCE_TYPE_EXTENSIONS = {
+    'png': 'image', 'jpg': 'image', 'jpeg': 'image', 'gif': 'image', 'svg': 'image', 'ico': 'image',
+    'webp': 'image', 'woff': 'font', 'woff2': 'font', 'ttf': 'font', 'otf': 'font', 'eot': 'font',
+    'mp4': 'video', 'webm': 'video', 'mp3': 'audio', 'css': 'style', 'js': 'script',
+}
+
+"""
+A response captured during the login. stage is the LoginStage value the flow was in, start the seconds since the
+capture started, ttfb and total the seconds from sending the request until the response headers and until the
+whole response arrived, size the bytes of the body. Timings that were not measured are None, e.g. the ttfb of the
+browser engine, whose proxy hands over the response only once all of it arrived
+"""
+CapturedResponse = namedtuple('CapturedResponse', ['stage', 'method', 'url', 'host', 'status_code', 'start', 'ttfb',
+                                                   'total', 'size'])
+
+
+class RequestRing:
+    """
+    Fixed size ring with the status, URL and timing of the latest responses. It is installed as the selenium-wire
+    request and response interceptors, or as a requests response hook, so no body is ever kept. Interceptors run on
+    the proxy threads.
+    """
+    __entries = None
+    __sent = None
+    __lock = None
+    __start = None
+    __scopes = None
+    stage = None
+
+    def __init__(self, size=ParamDefaults.CAPTURE_RING_SIZE.value, scopes=None):
+        """
+        :param size: number of responses kept. The oldest are dropped first
+        :type size: int
+
+        :param scopes: regular expressions of the URLs recorded by the interceptor, e.g. from capture_scopes. For
+                       when the selenium-wire scopes can not be set, all the responses are recorded if missing
+        :type scopes: list
+        """
+        self.__entries = deque(maxlen=size)
+        # Send times of the requests waiting for their response, by method and URL. Bounded as well, aborted
+        # requests never get one
+        self.__sent = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__start = time.time()
+        if scopes:
+            self.__scopes = re.compile('|'.join('(?:' + scope + ')' for scope in scopes))
+
+    @property
+    def started(self):
+        """Unix time the capture started"""
+        return self.__start
+
+    def record_sent(self, request):
+        """
+        selenium-wire request interceptor. The request and response interceptors get different request objects,
+        both dated when they were created, so the send time is kept here until the response arrives
+        :param request: the request the browser is about to send
+        :type request: seleniumwire.request.Request
+        """
+        if self.__scopes is not None and not self.__scopes.match(request.url):
+            return
+        now = time.time()
+        with self.__lock:
+            self.__sent.setdefault((request.method, request.url), deque()).append(now)
+            self.__sent.move_to_end((request.method, request.url))
+            if len(self.__sent) > self.__entries.maxlen:
+                self.__sent.popitem(last=False)
+
+    def record(self, request, response):
+        """
+        selenium-wire response interceptor
+        :param request: the captured request
+        :type request: seleniumwire.request.Request
+
+        :param response: the captured response
+        :type response: seleniumwire.request.Response
+        """
+        if self.__scopes is not None and not self.__scopes.match(request.url):
+            return
+        now = time.time()
+        with self.__lock:
+            pending = self.__sent.get((request.method, request.url))
+            sent = pending.popleft() if pending else None
+            if pending is not None and not pending:
+                del self.__sent[(request.method, request.url)]
+        self.__add(request.method, request.url, request.host, response.status_code, sent, None, now,
+                   len(response.body or b''))
+
+    def record_http(self, response, *args, **kwargs):
+        """
+        requests response hook of the http engine. It reads the body, as the session would right after the hook
+        :param response: the response, before its body is read
+        :type response: requests.Response
+        """
+        received = time.time()
+        sent = received - response.elapsed.total_seconds()
+        size = len(response.content)
+        self.__add(response.request.method, response.url, urlparse(response.url).netloc, response.status_code,
+                   sent, received, time.time(), size)
+
+    def __add(self, method, url, host, status_code, sent, received, finished, size):
+        """
+        :param sent: time the request was sent, None if unknown. The response is placed at finished then
+        :param received: time the response headers arrived, None if unknown
+        """
+        if sent is None:
+            start, ttfb, total = round(finished - self.__start, 3), None, None
+        else:
+            start = round(sent - self.__start, 3)
+            ttfb = round(max(received - sent, 0), 3) if received is not None else None
+            total = round(max(finished - sent, 0), 3)
+        entry = CapturedResponse(self.stage, method, url, host, status_code, start, ttfb, total, size)
+        with self.__lock:
+            self.__entries.append(entry)
+
+    def clear(self):
+        """Drop all the captured responses"""
+        with self.__lock:
+            self.__entries.clear()
+
+    def __iter__(self):
+        with self.__lock:
+            return iter(list(self.__entries))
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+
+def capture_scopes(hostnames, urls):
+    """
+    selenium-wire scopes that capture only the hosts the probe evaluates
+    :param hostnames: host names, with an optional port, e.g. example.com
+    :type hostnames: list
+
+    :param urls: URLs whose hosts are captured too, e.g. the IdP entityIDs and the SP
+    :type urls: list
+
+    :return: list of regular expressions matching the URLs of these hosts
+    :rtype: list
+    """
+    hosts = list(hostnames) + [urlparse(url).netloc for url in urls if url]
+    scopes = []
+    for host in hosts:
+        scope = r'^https?://' + re.escape(host) + r'(:\d+)?([/?#]|$)'
+        if host and scope not in scopes:
+            scopes.append(scope)
+    return scopes
+
+
+class ResourcePolicy:
+    """
+    Allow/deny policy for the requests of the browser. It is installed as the selenium-wire request interceptor
+    and aborts the requests the login does not need:
+    - every request to a tracker or a denied domain
+    - images, fonts and media
+    - scripts, style sheets and XHRs of third party domains, unless allowed
+    Navigations are never blocked, the flow may redirect through any IdP or proxy.
+    """
+    __first_party_hosts = None
+    __allowed_domains = None
+    __denied_domains = None
+    __blocked = 0
+    __lock = None
+
+    def __init__(self, first_party_hosts, allowed_domains=(), denied_domains=()):
+        """
+        :param first_party_hosts: hosts whose resources are always loaded, e.g. the service, the IdPs and the SP
+        :type first_party_hosts: list
+
+        :param allowed_domains: third party domains, and their subdomains, whose scripts are loaded
+        :type allowed_domains: list
+
+        :param denied_domains: domains, and their subdomains, that are never loaded
+        :type denied_domains: list
+        """
+        self.__first_party_hosts = {host.split(':')[0] for host in first_party_hosts if host}
+        self.__allowed_domains = LOGIN_UI_DOMAINS + tuple(domain.strip() for domain in allowed_domains if domain.strip())
+        self.__denied_domains = TRACKER_DOMAINS + tuple(domain.strip() for domain in denied_domains if domain.strip())
+        # The interceptor runs on the proxy threads
+        self.__lock = threading.Lock()
+
+    @property
+    def blocked(self):
+        """Number of requests aborted so far"""
+        return self.__blocked
+
+    def filter(self, request):
+        """
+        selenium-wire request interceptor
+        :param request: the request the browser is about to send
+        :type request: seleniumwire.request.Request
+
+        :return: True if the request is sent, False if aborted
+        :rtype: bool
+        """
+        if not self.allows(request.url, request.headers.get('Sec-Fetch-Dest'),
+                           request.headers.get('Accept'), request.headers.get('Referer')):
+            with self.__lock:
+                self.__blocked += 1
+            request.abort()
+            return False
+        return True
+
+    def allows(self, url, destination=None, accept=None, referer=None):
+        """
+        :param url: URL of the request
+        :type url: str
+
+        :param destination: value of the Sec-Fetch-Dest header
+        :type destination: str
+
+        :param accept: value of the Accept header
+        :type accept: str
+
+        :param referer: value of the Referer header, i.e. the page that loads the resource
+        :type referer: str
+
+        :return: True if the request should be sent
+        :rtype: bool
+        """
+        host = urlparse(url).hostname or ''
+        if in_domains(host, self.__denied_domains):
+            return False
+        resource_type = resource_type_of(url, destination, accept)
+        if resource_type is None or resource_type in ('document', 'frame', 'iframe'):
+            return True
+        if resource_type in BLOCKED_RESOURCE_TYPES:
+            return False
+        page_host = urlparse(referer).hostname if referer else None
+        return host in self.__first_party_hosts \
+            or (page_host is not None and same_site(host, page_host)) \
+            or in_domains(host, self.__allowed_domains)
+
+
+def resource_type_of(url, destination=None, accept=None):
+    """
+    :param url: URL of the request
+    :type url: str
+
+    :param destination: value of the Sec-Fetch-Dest header
+    :type destination: str
+
+    :param accept: value of the Accept header
+    :type accept: str
+
+    :return: the Sec-Fetch-Dest resource type or None if unknown
+    :rtype: str
+    """
+    if destination:
+        return destination
+    if accept and accept.startswith('text/html'):
+        return 'document'
+    path = urlparse(url).path
+    if '.' not in path.rsplit('/', 1)[-1]:
+        return None
+    return RESOURCE_TYPE_EXTENSIONS.get(path.rsplit('.', 1)[-1].lower())
+
+
+def in_domains(host, domains):
+    """
+    :return: True if the host is one of the domains or a subdomain of them
+    :rtype: bool
+    """
+    return any(host == domain or host.endswith('.' + domain) for domain in domains)
+
+
+def same_site(host, other_host):
+    """
+    Approximate same site check on the last two labels of the host names, e.g. cdn.example.org and
+    login.example.org. No public suffix list is consulted, so hosts under e.g. ac.uk count as one site
+    :rtype: bool
+    """
+    return host.split('.')[-2:] == other_host.split('.')[-2:]
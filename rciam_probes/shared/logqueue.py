@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import atexit
+import logging
+import logging.handlers
+import queue
+import socket
+
+from rciam_probes.shared.enums import ParamDefaults
+
+
+class BatchedFileHandler(logging.handlers.WatchedFileHandler):
+    """
+    Log file handler that keeps the formatted records in memory and appends them with one write per batch, so the
+    lines of concurrent probes do not interleave. The file is reopened whenever logrotate moved it away
+    """
+    __pending = None
+    __batch = None
+
+    def __init__(self, filename, batch=ParamDefaults.LOG_BATCH.value):
+        """
+        :param filename: the log file
+        :type filename: str
+
+        :param batch: number of records written together at most
+        :type batch: int
+        """
+        super().__init__(filename, delay=True)
+        self.__pending = []
+        self.__batch = batch
+
+    def emit(self, record):
+        try:
+            self.__pending.append(self.format(record) + self.terminator)
+            if len(self.__pending) >= self.__batch:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """Append the pending records to the log file"""
+        self.acquire()
+        try:
+            if not self.__pending:
+                return
+            # Opens the file if it was rotated or not opened yet
+            self.reopenIfNeeded()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(''.join(self.__pending))
+            self.stream.flush()
+            self.__pending = []
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush()
+        super().close()
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """Handle the queued records on a background thread and flush the handlers whenever the queue is drained"""
+
+    def dequeue(self, block):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            self.flush()
+            return self.queue.get(block)
+
+    def flush(self):
+        """Flush all the handlers"""
+        for handler in self.handlers:
+            handler.flush()
+
+    def stop(self):
+        super().stop()
+        self.flush()
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """
+    Put the records on an in memory queue and return at once. A BatchingQueueListener writes them through the
+    target handler. Closing the handler, at the latest on interpreter exit, drains the queue
+    """
+    __listener = None
+    __target = None
+
+    def __init__(self, target):
+        """
+        :param target: the handler that writes the records, e.g. a BatchedFileHandler
+        :type target: logging.Handler
+        """
+        super().__init__(queue.SimpleQueue())
+        self.__target = target
+        self.__listener = BatchingQueueListener(self.queue, target, respect_handler_level=True)
+        self.__listener.start()
+        atexit.register(self.close)
+
+    def close(self):
+        if self.__listener is not None:
+            self.__listener.stop()
+            self.__listener = None
+            self.__target.close()
+        super().close()
+
+
+def syslog_handler(address):
+    """
+    :param address: path of a local syslog or collector socket, e.g. /dev/log, or HOST:PORT of a UDP syslog
+    :type address: str
+
+    :return: handler that ships the records to syslog
+    :rtype: logging.handlers.SysLogHandler
+    """
+    if not address.startswith('/') and ':' in address:
+        host, port = address.rsplit(':', 1)
+        handler = logging.handlers.SysLogHandler(address=(host, int(port)), socktype=socket.SOCK_DGRAM)
+    else:
+        handler = logging.handlers.SysLogHandler(address=address)
+    handler.ident = 'rciam_probes: '
+    return handler
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import fcntl
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+
+from rciam_probes.shared.enums import ParamDefaults
+from rciam_probes.shared.utils import result_key, write_text_atomic
+
+
+class ResultsStore:
+    """
+    The latest result of every login check in one json file, so that the --inlocation consumers fetch all of them
+    with one request. A result is stored once, under the key of its check, and the index maps the key of every IdP,
+    the one of the out_<key>.json files, to it:
+    {"results": {check key: result}, "index": {IdP key: check key}}
+    Producers update the file under an exclusive lock and rename a complete copy over it, readers never see a
+    partial file. Results older than the retention are dropped on update.
+    """
+    __path = None
+    __logger = None
+    __retention = None
+
+    def __init__(self, directory, logger=None, retention=ParamDefaults.RESULTS_RETENTION.value):
+        """
+        :param directory: directory of the results file
+        :type directory: Path
+
+        :param logger: Logger object
+        :type logger: Logger
+
+        :param retention: days a result is kept after its check stopped running
+        :type retention: int
+        """
+        self.__path = Path(directory).joinpath(ParamDefaults.RESULTS_FILE.value)
+        self.__logger = logger
+        self.__retention = retention
+
+    def put(self, args, msg):
+        """
+        Store the result of a login check
+        :param args: arguments of the check(sp, identity, hostname)
+        :type args: ArgumentParser
+
+        :param msg: the json message returned from construct_probe_msg
+        :type msg: str
+        """
+        check_key = result_key(args.sp, args.identity, args.hostname)
+        with open(str(self.__path.with_name('.' + self.__path.name + '.lock')), 'w') as lock:
+            # Other producers wait, an update takes milliseconds
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            document = self.__load()
+            oldest = datetime.now(timezone.utc).timestamp() - self.__retention * 86400
+            results = {key: result for key, result in document['results'].items()
+                       if (result.get('date') or 0) >= oldest}
+            results[check_key] = json.loads(msg)
+            index = {idp_key: key for idp_key, key in document['index'].items() if key in results}
+            for idp in args.identity.split(','):
+                index[result_key(args.sp, idp, args.hostname)] = check_key
+            write_text_atomic(self.__path, json.dumps({'results': results, 'index': index}))
+        if self.__logger is not None:
+            self.__logger.debug('Stored the result in ' + str(self.__path))
+
+    def __load(self):
+        """
+        :return: the content of the results file. Empty if missing or corrupted
+        :rtype: dict
+        """
+        try:
+            with open(str(self.__path), encoding='utf-8') as f:
+                document = json.load(f)
+        except (OSError, ValueError):
+            document = None
+        if not isinstance(document, dict) or not isinstance(document.get('results'), dict) \
+                or not isinstance(document.get('index'), dict):
+            return {'results': {}, 'index': {}}
+        return document
+
+
+def lookup_results(document, args):
+    """
+    Find the results of every IdP of a check in the content of a results file
+    :param document: the parsed results file
+    :type document: dict
+
+    :param args: arguments of the check(sp, identity, hostname)
+    :type args: ArgumentParser
+
+    :return: the result of every IdP, in the order of --idp. None for the IdPs without a result
+    :rtype: list
+    """
+    results = document.get('results', {}) if isinstance(document, dict) else {}
+    index = document.get('index', {}) if isinstance(document, dict) else {}
+    return [results.get(index.get(result_key(args.sp, idp, args.hostname))) for idp in args.identity.split(',')]
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import fcntl
+import hashlib
+import io
+import json
+import re
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+try:
+    from PIL import Image
+except ImportError:
+    has_pillow = False
+else:
+    has_pillow = True
+
+from rciam_probes.shared.enums import ParamDefaults
+from rciam_probes.shared.utils import prune_files, write_bytes_atomic, write_text_atomic
+
+"""Address, title and visible text of the page. The fingerprint of an error page is computed from them"""
+PAGE_TEXT_JS = """
+return [location.host + location.pathname, document.title,
+        document.body ? document.body.innerText : ''].join('\\n');
+"""
+
+"""Numbers in the page text, e.g. times and request ids, that differ between renders of the same error page"""
+VOLATILE_TEXT = re.compile(r'\d+')
+
+"""Seconds a reserved snapshot may take to show up on disk before its index entry counts as lost"""
+SNAPSHOT_GRACE = 60
+
+"""Whether the missing Pillow was reported. Once per process is enough"""
+pillow_warned = False
+
+
+class SnapshotStore:
+    """
+    Screenshots of the pages the login failed on. An index next to the snapshots keeps the fingerprint of every
+    page captured and the time of the latest snapshot of every service:
+    {"pages": {fingerprint: {"file", "date", "service", "count"}}, "services": {service: date}}
+    A page already captured only increases its count, and a service gets at most one new snapshot per interval.
+    Both are decided before the screenshot is taken, so an outage costs neither capture time nor disk. The
+    screenshots are scaled and compressed when Pillow is available, written in the background, and removed by age
+    and size. A probe that exits right after the check hands the raw screenshot to a writer process it does not
+    wait for. Long running processes, e.g. the browser daemon, write in a thread instead.
+    """
+    __directory = None
+    __interval = None
+    __size = None
+    __retention = None
+    __detach = None
+    __logger = None
+
+    def __init__(self, directory, interval=ParamDefaults.SNAPSHOT_INTERVAL.value,
+                 size=ParamDefaults.SNAPSHOT_SIZE_MB.value * 1024 * 1024,
+                 retention=ParamDefaults.SNAPSHOT_RETENTION.value, detach=False, logger=None):
+        """
+        :param directory: directory of the snapshots
+        :type directory: Path
+
+        :param interval: minutes between two snapshots of a service
+        :type interval: int
+
+        :param size: size bound of all the snapshots in bytes
+        :type size: int
+
+        :param retention: days a snapshot is kept
+        :type retention: int
+
+        :param detach: write in a detached process, for probes that exit right after the check, e.g. checklogin
+        :type detach: bool
+
+        :param logger: Logger object
+        :type logger: Logger
+        """
+        self.__directory = Path(directory)
+        self.__interval = interval
+        self.__size = size
+        self.__retention = retention
+        self.__detach = detach
+        self.__logger = logger
+
+    def put(self, driver, service):
+        """
+        Take a snapshot of the current page, unless it is already captured or the service got one recently
+        :param driver: the web driver
+        :type driver: webdriver.Firefox
+
+        :param service: the service the login failed on, e.g. the hostname of the check
+        :type service: str
+
+        :return: the snapshot file, None if no snapshot was taken
+        :rtype: Path
+        """
+        global pillow_warned
+        if not has_pillow and not pillow_warned and self.__logger is not None:
+            pillow_warned = True
+            self.__logger.warning('Pillow is not installed, the snapshots are kept as full size PNG')
+        fingerprint = page_fingerprint(driver.execute_script(PAGE_TEXT_JS) or '')
+        self.__directory.mkdir(0o755, parents=True, exist_ok=True)
+        path = self.__reserve(fingerprint, service)
+        if path is None:
+            return None
+        self.__write(path, driver.get_screenshot_as_png())
+        if self.__logger is not None:
+            self.__logger.debug("Snapshot saved in path: " + str(path))
+        return path
+
+    def __reserve(self, fingerprint, service):
+        """
+        Record the snapshot of the page in the index
+        :return: the file of the new snapshot, None if the page is known or the service is rate limited
+        :rtype: Path
+        """
+        index_path = self.__directory.joinpath('.snapshots.json')
+        now = time.time()
+        with open(str(self.__directory.joinpath('.snapshots.json.lock')), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = load_index(index_path)
+            oldest = now - self.__retention * 86400
+            pages = {key: page for key, page in index['pages'].items()
+                     if page.get('date', 0) >= oldest
+                     and (self.__directory.joinpath(page.get('file', '')).is_file()
+                          or now - page.get('date', 0) < SNAPSHOT_GRACE)}
+            services = {name: date for name, date in index['services'].items() if date >= oldest}
+            path = None
+            if fingerprint in pages:
+                pages[fingerprint]['count'] = pages[fingerprint].get('count', 1) + 1
+                pages[fingerprint]['last'] = now
+                self.__debug('Page already captured in %s', pages[fingerprint]['file'])
+            elif now - services.get(service, 0) < self.__interval * 60:
+                self.__debug('Snapshot of %s skipped, one was taken in the last %d minutes', service,
+                             self.__interval)
+            else:
+                path = self.__directory.joinpath('snapshot_' + re.sub(r'[^\w.-]', '_', service) + '_'
+                                                 + datetime.fromtimestamp(now).strftime("%Y-%m-%d-%H%M%S") + '_'
+                                                 + fingerprint[:8] + ('.jpg' if has_pillow else '.png'))
+                pages[fingerprint] = {'file': path.name, 'date': now, 'service': service, 'count': 1}
+                services[service] = now
+            write_text_atomic(index_path, json.dumps({'pages': pages, 'services': services}))
+        return path
+
+    def __write(self, path, png):
+        """
+        Encode and write the screenshot, then apply the retention, without blocking the check
+        :param path: the snapshot file
+        :type path: Path
+
+        :param png: the screenshot as taken by the browser
+        :type png: bytes
+        """
+        if not self.__detach:
+            # The process outlives the check, and so does the thread
+            threading.Thread(target=self.__save_logged, args=(path, png), name='snapshot-writer').start()
+            return
+        # A new process rather than a fork. The probe has threads of its own, e.g. the selenium-wire proxy and the
+        # log queue, whose locks a forked child would inherit. The raw screenshot is handed over in a hidden file
+        raw_path = path.with_name('.raw_' + path.name)
+        write_bytes_atomic(raw_path, png)
+        try:
+            subprocess.Popen([sys.executable, '-m', __name__, str(raw_path), str(path), str(self.__size),
+                              str(self.__retention)],
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                             start_new_session=True)
+        except OSError:
+            # No process to hand the write over to
+            self.__save(path, png)
+            raw_path.unlink(missing_ok=True)
+
+    def __save_logged(self, path, png):
+        """Save from the writer thread. The check already finished, so failures are only logged"""
+        try:
+            self.__save(path, png)
+        except Exception as e:
+            if self.__logger is not None:
+                self.__logger.warning('Snapshot failed: ' + str(e))
+
+    def __save(self, path, png):
+        save_snapshot(path, png, self.__size, self.__retention, self.__logger)
+
+    def __debug(self, msg, *args):
+        if self.__logger is not None:
+            self.__logger.debug(msg, *args)
+
+
+def page_fingerprint(page_text):
+    """
+    :param page_text: address, title and text of the page returned from PAGE_TEXT_JS
+    :type page_text: str
+
+    :return: the fingerprint of the page, equal for the renders of the same error page
+    :rtype: str
+    """
+    normalized = ' '.join(VOLATILE_TEXT.sub('#', page_text).split())
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def encode_snapshot(png, width=ParamDefaults.SNAPSHOT_WIDTH.value, quality=ParamDefaults.SNAPSHOT_QUALITY.value):
+    """
+    Scale the screenshot down to width and compress it as JPEG. Without Pillow the PNG is kept as is
+    :param png: the screenshot
+    :type png: bytes
+
+    :param width: maximum width in pixels
+    :type width: int
+
+    :param quality: JPEG quality, 1 to 95
+    :type quality: int
+
+    :return: the encoded snapshot
+    :rtype: bytes
+    """
+    if not has_pillow:
+        return png
+    image = Image.open(io.BytesIO(png)).convert('RGB')
+    if image.width > width:
+        image = image.resize((width, round(image.height * width / image.width)), Image.BILINEAR)
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def save_snapshot(path, png, size, retention, logger=None):
+    """
+    Encode and write the screenshot, then remove the snapshots past the retention or the size bound
+    :param path: the snapshot file
+    :type path: Path
+
+    :param png: the screenshot as taken by the browser
+    :type png: bytes
+
+    :param size: size bound of all the snapshots in bytes
+    :type size: int
+
+    :param retention: days a snapshot is kept
+    :type retention: int
+
+    :param logger: Logger object
+    :type logger: Logger
+    """
+    write_bytes_atomic(path, encode_snapshot(png))
+    prune_files(path.parent, 'snapshot_*', size, retention, logger)
+    # Raw screenshots left behind by writers that never ran
+    prune_files(path.parent, '.raw_snapshot_*', size, retention, logger)
+
+
+def load_index(index_path):
+    """
+    :return: the snapshot index. Empty if missing or corrupted
+    :rtype: dict
+    """
+    try:
+        with open(str(index_path), encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = None
+    if not isinstance(index, dict) or not isinstance(index.get('pages'), dict) \
+            or not isinstance(index.get('services'), dict):
+        return {'pages': {}, 'services': {}}
+    return index
+
+
+# Entry point of the detached writer: raw screenshot, snapshot file, size bound and retention
+if __name__ == "__main__":
+    raw_path = Path(sys.argv[1])
+    save_snapshot(Path(sys.argv[2]), raw_path.read_bytes(), int(sys.argv[3]), int(sys.argv[4]))
+    raw_path.unlink()
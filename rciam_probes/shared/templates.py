@@ -1,13 +1,33 @@
 from string import Template
 
 """Nagios template output for Login health check"""
-login_health_check_nagios_tmpl = Template("SP Login succeeded(${time}${type} time) | 'Login'=${time}${type}")
+login_health_check_nagios_tmpl = Template("SP Login succeeded(${time}${type} time) | 'Login'=${time}${type}${stages}")
 
 defaults_login_health_check = {
+    "time": -1,
+    "type": "s",
+    "stages": ""
+}
+
+"""Nagios perfdata of a Login health check stage"""
+login_health_check_stage_tmpl = Template(" '${stage}'=${time}${type}")
+
+defaults_login_health_check_stage = {
+    "stage": "",
     "time": -1,
     "type": "s"
 }
 
+"""Nagios perfdata of the login time over the latest runs of a check"""
+login_health_check_history_tmpl = Template(" | 'Login p50'=${p50}s 'Login p95'=${p95}s 'Login max'=${max}s 'Runs'=${runs}")
+
+defaults_login_health_check_history = {
+    "p50": -1,
+    "p95": -1,
+    "max": -1,
+    "runs": 0
+}
+
 """Nagios template output for Cert health check"""
 cert_health_check_tmpl = Template("SSL_CERT(${type}) ${status} - x509 certificate '${subject}' from '${issuer}' is valid until "
                                   "${not_after} (expires in ${expiration_days} days) | 'SSL Metadata Cert'=${"
@@ -30,4 +50,97 @@ cert_health_check_all_tmpl = Template("SSL_CERT(${type}) ${status}")
 defaults_cert_health_check_all = {
     "type": "",
     "status": ""
-}
\ No newline at end of file
+}
+
+"""Nagios template output for Cert health check - Batch of targets"""
+cert_health_check_target_tmpl = Template("${target}: ${msg}")
+
+defaults_cert_health_check_target = {
+    "target": "",
+    "msg": ""
+}
+
+"""Nagios template output for Cert health check - Failed target"""
+cert_health_check_error_tmpl = Template("SSL_CERT(${type}) ${status} - ${error}")
+
+defaults_cert_health_check_error = {
+    "type": "",
+    "status": "",
+    "error": ""
+}
+
+"""Nagios template output for Cert health check - Worst state summary of a batch"""
+cert_health_check_summary_tmpl = Template("SSL_CERT ${status} - ${ok} OK, ${warning} WARNING, ${critical} CRITICAL, "
+                                          "${unknown} UNKNOWN | 'OK'=${ok} 'WARNING'=${warning} "
+                                          "'CRITICAL'=${critical} 'UNKNOWN'=${unknown}")
+
+defaults_cert_health_check_summary = {
+    "status": "",
+    "ok": 0,
+    "warning": 0,
+    "critical": 0,
+    "unknown": 0
+}
+
+"""Nagios template output for Cert health check - Federation aggregate"""
+cert_health_check_aggregate_tmpl = Template("SSL_CERT(${type}) ${status} - ${entities} entities, ${certificates} "
+                                            "certificates: ${ok} OK, ${warning} WARNING, ${critical} CRITICAL, "
+                                            "${unknown} UNKNOWN | 'OK'=${ok} 'WARNING'=${warning} "
+                                            "'CRITICAL'=${critical} 'UNKNOWN'=${unknown}")
+
+defaults_cert_health_check_aggregate = {
+    "type": "",
+    "status": "",
+    "entities": 0,
+    "certificates": 0,
+    "ok": 0,
+    "warning": 0,
+    "critical": 0,
+    "unknown": 0
+}
+
+"""Nagios template output for Login health check - One combination of the login matrix"""
+login_health_check_matrix_tmpl = Template("${sp} via ${idp}: ${msg}")
+
+defaults_login_health_check_matrix = {
+    "sp": "",
+    "idp": "",
+    "msg": ""
+}
+
+"""Nagios template output for Login health check - Worst state summary of the login matrix"""
+login_health_check_matrix_summary_tmpl = Template("Login matrix ${status} - ${combinations} combinations: ${ok} OK, "
+                                                  "${warning} WARNING, ${critical} CRITICAL, ${unknown} UNKNOWN | "
+                                                  "'OK'=${ok} 'WARNING'=${warning} 'CRITICAL'=${critical} "
+                                                  "'UNKNOWN'=${unknown}")
+
+defaults_login_health_check_matrix_summary = {
+    "status": "",
+    "combinations": 0,
+    "ok": 0,
+    "warning": 0,
+    "critical": 0,
+    "unknown": 0
+}
+
+"""Nagios template output for the check runner - One check"""
+check_runner_tmpl = Template("${name}: ${msg}")
+
+defaults_check_runner = {
+    "name": "",
+    "msg": ""
+}
+
+"""Nagios template output for the check runner - Worst state summary of all the checks"""
+check_runner_summary_tmpl = Template("Checks ${status} - ${checks} checks: ${ok} OK, ${warning} WARNING, "
+                                     "${critical} CRITICAL, ${unknown} UNKNOWN | 'OK'=${ok} 'WARNING'=${warning} "
+                                     "'CRITICAL'=${critical} 'UNKNOWN'=${unknown}")
+
+defaults_check_runner_summary = {
+    "status": "",
+    "checks": 0,
+    "ok": 0,
+    "warning": 0,
+    "critical": 0,
+    "unknown": 0
+}
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import parse_qsl, urlsplit
+
+from rciam_probes.shared.enums import ParamDefaults
+from rciam_probes.shared.utils import prune_files, result_key, write_text_atomic
+
+"""Trace formats, also the extension of their files"""
+TRACE_FORMATS = ['har', 'ndjson']
+
+
+class TraceStore:
+    """
+    Network traces of the slow or failed logins, one file per run named trace_<check key>_<time>.<format>, next to
+    the results. Every file holds at most the responses of the capture ring. After a write the traces older than
+    the retention are removed and then the oldest ones until the directory fits in the size bound, so the disk use
+    stays bounded however many checks run.
+    """
+    __directory = None
+    __trace_format = None
+    __size = None
+    __retention = None
+    __logger = None
+
+    def __init__(self, directory, trace_format='har', size=ParamDefaults.TRACE_SIZE_MB.value * 1024 * 1024,
+                 retention=ParamDefaults.TRACE_RETENTION.value, logger=None):
+        """
+        :param directory: directory of the trace files
+        :type directory: Path
+
+        :param trace_format: har or ndjson
+        :type trace_format: str
+
+        :param size: size bound of all the trace files in bytes
+        :type size: int
+
+        :param retention: days a trace is kept
+        :type retention: int
+
+        :param logger: Logger object
+        :type logger: Logger
+        """
+        self.__directory = Path(directory)
+        self.__trace_format = trace_format
+        self.__size = size
+        self.__retention = retention
+        self.__logger = logger
+
+    def put(self, args, captured, msg):
+        """
+        Write the trace of a run
+        :param args: arguments of the check(sp, identity, hostname)
+        :type args: ArgumentParser
+
+        :param captured: the responses of the run
+        :type captured: RequestRing
+
+        :param msg: outcome of the run, e.g. the Nagios message
+        :type msg: str
+
+        :return: the trace file
+        :rtype: Path
+        """
+        entries = list(captured)
+        started = datetime.fromtimestamp(captured.started, timezone.utc)
+        if self.__trace_format == 'ndjson':
+            text = ''.join(json.dumps(trace_record(entry)) + '\n' for entry in entries)
+        else:
+            text = json.dumps(har_document(entries, started, msg))
+        path = self.__directory.joinpath('trace_' + result_key(args.sp, args.identity, args.hostname) + '_'
+                                         + started.strftime('%Y%m%dT%H%M%S') + '.' + self.__trace_format)
+        write_text_atomic(path, text)
+        if self.__logger is not None:
+            self.__logger.debug('Wrote the trace of %d requests in %s', len(entries), path)
+        self.prune()
+        return path
+
+    def prune(self):
+        """Remove the expired traces and then the oldest ones until all of them fit in the size bound"""
+        prune_files(self.__directory, 'trace_*', self.__size, self.__retention, self.__logger)
+
+
+def trace_url(url):
+    """
+    :return: the URL without its query and fragment. They may carry SAML messages, authorization codes or state
+    :rtype: str
+    """
+    return urlsplit(url)._replace(query='', fragment='').geturl()
+
+
+def trace_record(entry):
+    """
+    :param entry: a captured response
+    :type entry: CapturedResponse
+
+    :return: the NDJSON record of the response
+    :rtype: dict
+    """
+    return {
+        'stage': entry.stage,
+        'method': entry.method,
+        'url': trace_url(entry.url),
+        'host': entry.host,
+        'status': entry.status_code,
+        'start': entry.start,
+        'ttfb': entry.ttfb,
+        'total': entry.total,
+        'size': entry.size,
+    }
+
+
+def har_document(entries, started, comment=''):
+    """
+    HAR 1.2 log with one page per login stage. Headers, cookies and the query values are never included
+    :param entries: the captured responses
+    :type entries: list
+
+    :param started: time the capture started
+    :type started: datetime
+
+    :param comment: comment of the log, e.g. the Nagios message of the run
+    :type comment: str
+
+    :return: the HAR document
+    :rtype: dict
+    """
+    pages = {}
+    har_entries = []
+    for entry in entries:
+        started_date = datetime.fromtimestamp(started.timestamp() + entry.start, timezone.utc).isoformat()
+        if entry.stage is not None and entry.stage not in pages:
+            pages[entry.stage] = {'startedDateTime': started_date, 'id': entry.stage, 'title': entry.stage,
+                                  'pageTimings': {}}
+        har_entry = {
+            'startedDateTime': started_date,
+            'time': har_time(entry.total),
+            'request': {'method': entry.method, 'url': trace_url(entry.url), 'httpVersion': '', 'cookies': [],
+                        'headers': [],
+                        'queryString': [{'name': name, 'value': ''}
+                                        for name, value in parse_qsl(urlsplit(entry.url).query,
+                                                                     keep_blank_values=True)],
+                        'headersSize': -1, 'bodySize': -1},
+            'response': {'status': entry.status_code, 'statusText': '', 'httpVersion': '', 'cookies': [],
+                         'headers': [], 'content': {'size': entry.size, 'mimeType': ''}, 'redirectURL': '',
+                         'headersSize': -1, 'bodySize': entry.size},
+            'cache': {},
+            'timings': har_timings(entry),
+        }
+        if entry.stage is not None:
+            har_entry['pageref'] = entry.stage
+        har_entries.append(har_entry)
+    return {'log': {'version': '1.2', 'creator': {'name': 'rciam_probes', 'version': ''},
+                    'pages': list(pages.values()), 'entries': har_entries, 'comment': comment}}
+
+
+def har_time(seconds):
+    """
+    :return: the milliseconds of a timing, 0 if it was not measured. HAR has no value for unknown total times
+    :rtype: float
+    """
+    return round(seconds * 1000, 1) if seconds is not None else 0
+
+
+def har_timings(entry):
+    """
+    :param entry: a captured response
+    :type entry: CapturedResponse
+
+    :return: the HAR timings of the response. The parts not measured are noted in the comment
+    :rtype: dict
+    """
+    if entry.total is None:
+        return {'send': 0, 'wait': 0, 'receive': 0, 'comment': 'not measured'}
+    if entry.ttfb is None:
+        # All of the response arrived at once
+        return {'send': 0, 'wait': har_time(entry.total), 'receive': 0, 'comment': 'time to first byte not measured'}
+    return {'send': 0, 'wait': har_time(entry.ttfb), 'receive': har_time(entry.total - entry.ttfb)}
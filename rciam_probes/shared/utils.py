@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import logging
+import logging.handlers
+import os
+import queue
 import sys
+import threading
 from json import JSONDecodeError
 
-import pkg_resources
 import requests
-import xmltodict
 import time as t
 import hashlib
 import json
@@ -14,12 +16,16 @@ import datetime
 
 from shutil import chown
 from pathlib import Path
-from OpenSSL import crypto
 from datetime import datetime, timezone
-from time import mktime, time, gmtime
+from calendar import timegm
+from time import time
 from urllib3.exceptions import NewConnectionError
 
+# pkg_resources, xmltodict, lxml and OpenSSL are slow to import. The functions that need them import them on first
+# use, so that checkcert and checklogin --inlocation start fast
+
 from rciam_probes.shared.enums import ParamDefaults, LoggingLevel, NagiosStatusCode
+from rciam_probes.shared.logqueue import BatchedFileHandler, LogQueueHandler, syslog_handler
 import rciam_probes.shared.templates as tpl
 
 
@@ -41,10 +47,19 @@ def configure_logger(args):
     # Create the Logger
     logger = logging.getLogger(__name__)
     logger.setLevel(args.verbose)
+    # Configuring the logger again, e.g. for another check of the same process, replaces its handler
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
 
+    logger_formatter = logging.Formatter(ParamDefaults.LOG_FORMATTER.value)
     if args.console:
         # Create the Handler for logging data to stdout
         logger_handler = logging.StreamHandler(sys.stdout)
+    elif args.syslog:
+        # Ship the records to syslog or a local collector. No log file is needed
+        logger_handler = syslog_handler(args.syslog)
+        logger_formatter = logging.Formatter(ParamDefaults.LOG_SYSLOG_FORMATTER.value)
     else:
         # Create the log file if not exists
         # First try in the /var/log/rciam_probes path. This is the path used when
@@ -56,24 +71,30 @@ def configure_logger(args):
             log_path.mkdir(0o755, parents=True, exist_ok=True)
 
         log_file = log_path.joinpath('rciam_probes.log')
-        log_file.touch(exist_ok=True)
         args.log = str(log_file)
-        chown(args.log, user=args.logowner, group=args.logowner)
-        # Create the Handler for logging data to a file
-        logger_handler = logging.FileHandler(args.log)
+        if not log_file.exists():
+            log_file.touch(exist_ok=True)
+            chown(args.log, user=args.logowner, group=args.logowner)
+        # Create the Handler for logging data to a file. It reopens the file after a logrotate
+        if args.log_queue:
+            logger_handler = BatchedFileHandler(args.log)
+        else:
+            logger_handler = logging.handlers.WatchedFileHandler(args.log)
     logger_handler.setLevel(args.verbose)
 
-    # Create a Formatter for formatting the log messages
-    logger_formatter = logging.Formatter(ParamDefaults.LOG_FORMATTER.value)
     # Add the Formatter to the Handler
     logger_handler.setFormatter(logger_formatter)
+    if args.log_queue:
+        # Log calls only queue the record, a background thread writes them in batches
+        logger_handler = LogQueueHandler(logger_handler)
+        logger_handler.setLevel(args.verbose)
     # Add the Handler to the Logger
     logger.addHandler(logger_handler)
 
     return logger
 
 
-def get_xml(url, timeout=5, logger=None):
+def get_xml(url, timeout=5, logger=None, session=None):
     """
     Get and parse an xml available through a url
     :param url: URL
@@ -85,11 +106,15 @@ def get_xml(url, timeout=5, logger=None):
     :param value: logger object
     :type object
 
+    :param session: requests session to reuse pooled connections. Defaults to a one-off request
+    :type session: requests.Session
+
     :raises Exception: Exceptions might occurs from the URL format and get request. Or from xml parsing
     """
+    import xmltodict
     try:
         requests.packages.urllib3.disable_warnings()
-        response = requests.get(url, verify=False, timeout=timeout)
+        response = (session or requests).get(url, verify=False, timeout=timeout)
         parsed_response = xmltodict.parse(response.text)
     except NewConnectionError as nce:
         if logger is not None:
@@ -100,7 +125,7 @@ def get_xml(url, timeout=5, logger=None):
     return parsed_response
 
 
-def get_json(url, timeout=5, logger=None):
+def get_json(url, timeout=5, logger=None, session=None, cache=None):
     """
     Get and parse a json file available through a url
     :param url: URL
@@ -112,11 +137,20 @@ def get_json(url, timeout=5, logger=None):
     :param value: logger object
     :type object
 
+    :param session: requests session to reuse pooled connections. Defaults to a one-off request
+    :type session: requests.Session
+
+    :param cache: conditional GET cache. Defaults to no caching
+    :type cache: HttpCache
+
     :raises Exception: Exceptions might occurs from the URL format and get request. Or from xml parsing
     """
     try:
+        if cache is not None:
+            with cache.get(url, timeout, session).open() as body:
+                return json.load(body)
         requests.packages.urllib3.disable_warnings()
-        response = requests.get(url, verify=False, timeout=timeout)
+        response = (session or requests).get(url, verify=False, timeout=timeout)
         parsed_response = json.loads(response.text)
     except NewConnectionError as nce:
         if logger is not None:
@@ -131,6 +165,218 @@ def get_json(url, timeout=5, logger=None):
 
     return parsed_response
 
+
+def get_json_concurrently(urls, timeout=5, deadline=None, logger=None, session=None, cache=None):
+    """
+    Get and parse many json files concurrently and yield them as they arrive. Files that failed or did not
+    arrive before the deadline are yielded with an error instead of data. The fetches run on daemon threads,
+    so a late server never holds the probe back.
+    :param urls: list of URLs
+    :type urls: list
+
+    :param timeout: seconds to wait for each server
+    :type timeout: int
+
+    :param deadline: seconds to wait for all the files. Defaults to no deadline
+    :type deadline: float
+
+    :param logger: logger object
+    :type logger: Logger
+
+    :param session: requests session to reuse pooled connections. Defaults to one-off requests
+    :type session: requests.Session
+
+    :param cache: conditional GET cache. Defaults to no caching
+    :type cache: HttpCache
+
+    :return: yields (url, data, error). data is None if error is set
+    :rtype: Iterator[tuple]
+    """
+    results = queue.Queue()
+
+    def fetch(url):
+        try:
+            results.put((url, get_json(url, timeout, logger, session, cache), None))
+        except requests.exceptions.Timeout as e:
+            if logger is not None:
+                logger.critical(url + ' Timeout: ' + str(e))
+            results.put((url, None, 'Request Timed out'))
+        except Exception as e:
+            if logger is not None:
+                logger.critical(url + ' ' + str(e))
+            results.put((url, None, 'Not available'))
+
+    for url in urls:
+        threading.Thread(target=fetch, args=(url,), daemon=True).start()
+
+    pending = list(urls)
+    end_time = time() + deadline if deadline is not None else None
+    while pending:
+        try:
+            if end_time is None:
+                url, data, error = results.get()
+            else:
+                url, data, error = results.get(timeout=max(end_time - time(), 0))
+        except queue.Empty:
+            break
+        pending.remove(url)
+        yield url, data, error
+
+    for url in pending:
+        if logger is not None:
+            logger.critical(url + ' did not arrive in ' + str(deadline) + 's')
+        yield url, None, 'Deadline exceeded'
+
+
+def stream_key_descriptors(url, timeout=5, logger=None, session=None, entities=None):
+    """
+    Get the metadata available through a url and stream their KeyDescriptors while they are downloaded.
+    The document is never loaded as a whole. The download stops as soon as the caller stops iterating.
+    :param url: URL
+    :type url: string
+
+    :param timeout: seconds to wait for the server
+    :type timeout: int
+
+    :param logger: logger object
+    :type logger: Logger
+
+    :param session: requests session to reuse pooled connections. Defaults to a one-off request
+    :type session: requests.Session
+
+    :param entities: set the entityID of every EntityDescriptor is added to, with or without KeyDescriptors
+    :type entities: set
+
+    :return: yields (entityID, role descriptor, use, x509 certificate body)
+    :rtype: Iterator[tuple]
+
+    :raises Exception: Exceptions might occurs from the URL format and get request. Or from xml parsing
+    """
+    try:
+        requests.packages.urllib3.disable_warnings()
+        response = (session or requests).get(url, verify=False, timeout=timeout, stream=True)
+    except NewConnectionError as nce:
+        if logger is not None:
+            logger.critical(nce.message)
+        error_msg = "Http Connection failed."
+        raise RuntimeError(error_msg)
+
+    try:
+        # Let urllib3 undo any gzip/deflate content encoding while we read
+        response.raw.decode_content = True
+        yield from iter_key_descriptors(response.raw, entities)
+    finally:
+        response.close()
+
+
+def iter_key_descriptors(source, entities=None):
+    """
+    Incrementally parse SAML metadata and extract the X509 certificates of every KeyDescriptor.
+    Namespace prefixes do not matter(ds:, md:, unprefixed). Every KeyDescriptor and EntityDescriptor
+    is discarded as soon as it is parsed, so memory stays flat regardless of the document size.
+    :param source: file like object or path with the xml
+    :type source: object
+
+    :param entities: set the entityID of every EntityDescriptor is added to, with or without KeyDescriptors
+    :type entities: set
+
+    :return: yields (entityID, role descriptor, use, x509 certificate body). use is 'unknown' if not set
+    :rtype: Iterator[tuple]
+    """
+    from lxml import etree
+    context = etree.iterparse(source, events=('end',), tag=('{*}KeyDescriptor', '{*}EntityDescriptor'),
+                              resolve_entities=False, no_network=True, remove_comments=True)
+    for event, elem in context:
+        if etree.QName(elem).localname == 'KeyDescriptor':
+            role_elem = elem.getparent()
+            entity_elem = role_elem.getparent() if role_elem is not None else None
+            entity_id = entity_elem.get('entityID') if entity_elem is not None else None
+            role = etree.QName(role_elem).localname if role_elem is not None else None
+            use = elem.get('use', 'unknown')
+            for x509_cert in elem.iterfind('.//{*}X509Certificate'):
+                if x509_cert.text:
+                    yield entity_id, role, use, x509_cert.text.strip()
+            elem.clear()
+        else:
+            if entities is not None:
+                entities.add(elem.get('entityID'))
+            # Drop the entity and everything parsed before it
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+
+def fetch_cert_from_key_descriptors(key_descriptors, cert_type):
+    """
+    Fetch X509 per type from the first role descriptor of the streamed KeyDescriptors.
+    Supported types [signing, encryption]
+    :param key_descriptors: iterator returned from stream_key_descriptors or iter_key_descriptors
+    :type key_descriptors: Iterator[tuple]
+    :param cert_type: The type of Certificate i am looking for
+    :type cert_type: str
+
+    :return: dictionary of certificates {type<str>: certificate<str>}
+    :rtype: dict
+    """
+    x509_dict = {}
+    first_group = None
+    try:
+        for entity_id, role, use, x509_cert in key_descriptors:
+            if first_group is None:
+                first_group = (entity_id, role)
+            elif first_group != (entity_id, role):
+                # We only need the first group. Stop reading the rest of the document
+                break
+            x509_dict[use] = x509_cert
+    finally:
+        if hasattr(key_descriptors, 'close'):
+            key_descriptors.close()
+
+    if not x509_dict:
+        raise Exception("No X509 certificate found")
+    return select_certs_by_type(x509_dict, cert_type)
+
+
+def select_certs_by_type(x509_dict, cert_type):
+    """
+    Keep the certificates of the requested type
+    :param x509_dict: dictionary of certificates {type<str>: certificate<str>}
+    :type x509_dict: dict
+    :param cert_type: The type of Certificate i am looking for [signing, encryption, all]
+    :type cert_type: str
+
+    :return: dictionary of certificates {type<str>: certificate<str>}
+    :rtype: dict
+
+    :raises Exception: if there is no certificate of the requested type
+    """
+    # If 'all' certificate types are requested then return a list with all the certificates
+    if cert_type == 'all':
+        return x509_dict
+
+    # If a specific certificate type is requested then return the specific certificate or 'unknown'
+    valid_types = {cert_type, 'unknown'}
+    if not valid_types & set(x509_dict.keys()):
+        raise Exception("No X509 certificate of type:%s found" % cert_type)
+    return {t: cert for t, cert in x509_dict.items() if t == 'unknown' or t == cert_type}
+
+
+def create_http_session(pool_size=10):
+    """
+    Create a requests session whose connection pool can serve pool_size concurrent requests per host
+    :param pool_size: number of connections kept alive per host
+    :type pool_size: int
+
+    :return: the session
+    :rtype: requests.Session
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
 def gen_dict_extract(var, key):
     """
     Extract field from nested dictionary with specific key
@@ -201,33 +447,63 @@ def fetch_cert_from_type(metadata_dict, cert_type):
             else:
                  x509_dict['unknown'] = x509_list.get('ds:KeyInfo').get('ds:X509Data').get('ds:X509Certificate')
 
-        # If 'all' certificate types are requested then return a list with all the certificates
-        if cert_type == 'all':
-            return x509_dict
-
-        # If a specific certificate type is requested then return the specific certificate or 'unknown'
-        valid_types = {cert_type, 'unknown'}
-        if not valid_types & set(x509_dict.keys()):
-            raise Exception("No X509 certificate of type:%s found" % cert_type)
-        return {t: cert for t, cert in x509_dict.items() if t == 'unknown' or t == cert_type}
+        return select_certs_by_type(x509_dict, cert_type)
 
     except Exception as e:
         # Log the title of the view
         raise Exception(e.args[0]) from e
 
 
-def evaluate_single_certificate(x509):
+def evaluate_single_certificate(x509, cert_cache=None):
     """
     Translate the certificate to its attributes. Calculate the days to expiration
     :param x509: body of x509
     :type x509: string
 
+    :param cert_cache: attributes of the certificates parsed on previous runs. Defaults to no caching
+    :type cert_cache: CertCache
+
     :return: Days to Expiration
     :rtype: int
 
+    :return: Certificates Attributes, not Before and not After in seconds since the epoch. See cert_date
+    :rtype: dict
+    """
+    certData = cert_cache.get(x509) if cert_cache is not None else None
+    if certData is None:
+        certData = parse_certificate(x509)
+        certData['not Before'] = timegm(certData['not Before'].timetuple())
+        certData['not After'] = timegm(certData['not After'].timetuple())
+        if cert_cache is not None:
+            cert_cache.put(x509, certData)
+
+    # Whole days, rounded down as timedelta.days does
+    expiration_days = (certData['not After'] - int(time())) // 86400
+
+    return expiration_days, certData
+
+
+def cert_date(timestamp):
+    """
+    :param timestamp: not Before or not After of the certificate attributes
+    :type timestamp: int
+
+    :return: the date in UTC, as shown in the messages
+    :rtype: datetime
+    """
+    return datetime.fromtimestamp(timestamp, timezone.utc).replace(tzinfo=None)
+
+
+def parse_certificate(x509):
+    """
+    Translate the certificate to its attributes
+    :param x509: body of x509
+    :type x509: string
+
     :return: Certificates Attributes
     :rtype: dict
     """
+    from OpenSSL import crypto
     try:
         x509_str = "-----BEGIN CERTIFICATE-----\n" + x509 + "\n-----END CERTIFICATE-----\n"
         # Decode the x509 certificate
@@ -247,11 +523,7 @@ def evaluate_single_certificate(x509):
         # Throw the exception back to the main thread to catch
         raise Exception from e
 
-    cert_expire = certData['not After']
-    now = datetime.fromtimestamp(mktime(gmtime(time())))
-    expiration_days = (cert_expire - now).days
-
-    return expiration_days, certData
+    return certData
 
 
 def start_ticking():
@@ -292,16 +564,17 @@ def get_nagios_status_n_code(var_chk, warning_th, critical_th, logger=None):
     if var_chk > warning_th:
         status = NagiosStatusCode.OK.name
         code = NagiosStatusCode.OK.value
-    elif warning_th > var_chk > critical_th:
+    elif warning_th >= var_chk > critical_th:
         status = NagiosStatusCode.WARNING.name
         code = NagiosStatusCode.WARNING.value
-    elif var_chk < critical_th:
+    elif var_chk <= critical_th:
         status = NagiosStatusCode.CRITICAL.name
         code = NagiosStatusCode.CRITICAL.value
     else:
         msg = "State" + NagiosStatusCode.UNKNOWN.name
         if logger is not None:
             logger.info(msg)
+        status = NagiosStatusCode.UNKNOWN.name
         code = NagiosStatusCode.UNKNOWN.value
 
     return status, code
@@ -309,6 +582,7 @@ def get_nagios_status_n_code(var_chk, warning_th, critical_th, logger=None):
 
 def get_package_root():
     """Returns project root folder."""
+    import pkg_resources
     return pkg_resources.get_distribution('rciam_probes').location
 
 
@@ -352,22 +626,31 @@ def construct_out_filename(args, file_extension):
     if isinstance(idp_list, list):
         fname_out_list = []
         for idp in idp_list:
-            filename2hash = args.sp + idp + args.hostname
-            filename_postfix = hashlib.md5(filename2hash.encode()).hexdigest()
+            filename_postfix = result_key(args.sp, idp, args.hostname)
             out_filename_postfix = "out_" + str(filename_postfix) + "." + file_extension
             fname_out_list.append(out_filename_postfix)
         return fname_out_list
     else:
-        filename2hash = args.sp + args.identity + args.hostname
-        filename_postfix = hashlib.md5(filename2hash.encode()).hexdigest()
+        filename_postfix = result_key(args.sp, args.identity, args.hostname)
         return ["out_" + str(filename_postfix) + "." + file_extension]
 
 
-def blk_validate_probe_data(raw_data_list):
+def result_key(sp, idp, hostname):
     """
-    :param raw_data_list: List of probe data
+    :return: the key of the result of a login check, the hash in the name of its out_<key>.json file
+    :rtype: str
+    """
+    return hashlib.md5((sp + idp + hostname).encode()).hexdigest()
+
+
+def blk_validate_probe_data(raw_data_list, vld_time_window=30):
+    """
+    :param raw_data_list: List of probe data. Data that could not be fetched carry an 'error' and no 'date'
     :type raw_data_list: [string]
 
+    :param vld_time_window: minutes after which the data are stale
+    :type vld_time_window: float
+
     :return: code, NagiosStatusCode exit code
     :rtype: NagiosStatusCode, int
 
@@ -378,30 +661,43 @@ def blk_validate_probe_data(raw_data_list):
     :rtype: [string]
     """
 
-    # Always start with a negative code
-    # Logic: If at least one successfull
-    code = -1
+    codes = []
+    fetch_failed = False
     msg = []
     vtype = []
     for raw_data in raw_data_list:
-        validate = timestamp_check(raw_data['date'])
+        validate = timestamp_check(raw_data['date'], vld_time_window)
         if not validate:
             raw_data['xcode'] = NagiosStatusCode.UNKNOWN.value
-        # Initialize the exit code
-        code = raw_data['xcode'] if code < 0 else code
-        # If at least one succeeded or in warning state make it a warning
-        if code != 0 and raw_data['xcode'] <= 1:
-            code = 1
-        # todo: What should i choose between critical(2) and unknown(3)
-
-        msg_value = raw_data['value'] if validate else "State " + NagiosStatusCode.UNKNOWN.name + "(Service became Stale)"
+        codes.append(raw_data['xcode'])
+
+        if raw_data.get('error') is not None:
+            # The data never arrived
+            fetch_failed = True
+            msg_value = "State " + NagiosStatusCode.UNKNOWN.name + "(" + raw_data['error'] + ")"
+        elif validate:
+            msg_value = raw_data['value']
+        else:
+            msg_value = "State " + NagiosStatusCode.UNKNOWN.name + "(Service became Stale)"
         msg.append(raw_data['idp'] + ": " + str(msg_value) + str(raw_data['vtype']))
         vtype.append(str(raw_data['vtype']))
 
+    # The code does not depend on the order of the IdPs
+    if codes and all(xcode == NagiosStatusCode.OK.value for xcode in codes):
+        code = NagiosStatusCode.OK.value
+    elif any(xcode <= NagiosStatusCode.WARNING.value for xcode in codes):
+        # If at least one succeeded or in warning state make it a warning
+        code = NagiosStatusCode.WARNING.value
+    else:
+        code = max(codes, default=NagiosStatusCode.UNKNOWN.value)
+    if fetch_failed:
+        # A partial or late fetch can not tell the state of the service
+        code = max(code, NagiosStatusCode.UNKNOWN.value)
+
     return code, msg, vtype
 
 
-def construct_probe_msg(args, value, vtype="s", xcode=0):
+def construct_probe_msg(args, value, vtype="s", xcode=0, stages=None):
     """
     Get the argument list from command line, the outcome of the test and construct the actual message in the desired format
     :param args: arguments retrieved from command line
@@ -416,6 +712,9 @@ def construct_probe_msg(args, value, vtype="s", xcode=0):
     :param xcode: exit code from the experiment. Nagios like. Defaults to success
     :type xcode: int
 
+    :param stages: duration of every login stage that ran, {LoginStage value: seconds}. Defaults to none
+    :type stages: dict
+
     :return: message
     :rtype string
     """
@@ -428,33 +727,160 @@ def construct_probe_msg(args, value, vtype="s", xcode=0):
         data['sp'] = args.sp
         data['hostname'] = args.hostname
         data['xcode'] = xcode
+        if stages:
+            data['stages'] = stages
         return json.dumps(data)
     else:
         if type(value) == int or type(value) == float:
+            stages_perfdata = ''.join(tpl.login_health_check_stage_tmpl.substitute(tpl.defaults_login_health_check_stage,
+                                                                                  stage=stage, time=stage_time,
+                                                                                  type=vtype)
+                                      for stage, stage_time in (stages or {}).items())
             return tpl.login_health_check_nagios_tmpl.substitute(tpl.defaults_login_health_check, time=value,
-                                                                 type=vtype)
+                                                                 type=vtype, stages=stages_perfdata)
         else:
             return value
 
 
-def take_snapshot(driver, logger=None):
+def options_to_arguments(options):
     """
-    Get Browser/Driver snapsho
-    :param driver: geckodriver parameter
-    :type drriver: geckodriver object
+    Translate a dictionary of options, as found in the config files, to command line arguments.
+    Keys are the option names without the leading dashes, e.g. {"sp": "https://sp.example.org", "b": true,
+    "skip_idp_discovery": true}. Single letter keys become short options and underscores in the names become
+    dashes, as in the dest of the argument. True adds the flag, False and None skip the option and
+    lists are comma separated.
+    :param options: option name to value
+    :type options: dict
+
+    :return: list of arguments
+    :rtype: list
+    """
+    arguments = []
+    for name, value in options.items():
+        if value is None or value is False:
+            continue
+        arguments.append(('-' if len(name) == 1 else '--') + name.replace('_', '-'))
+        if value is True:
+            continue
+        if isinstance(value, list):
+            value = ','.join(str(item) for item in value)
+        arguments.append(str(value))
+    return arguments
+
+
+def prune_files(directory, pattern, size, retention, logger=None):
+    """
+    Remove the files older than the retention and then the oldest ones until the rest fit in the size bound.
+    The latest file is kept even if it alone exceeds the bound. Files removed meanwhile by concurrent probes
+    are skipped
+    :param directory: directory of the files
+    :type directory: Path
 
-    :param value: logger object
-    :type object
+    :param pattern: glob pattern of the files, e.g. trace_*
+    :type pattern: str
+
+    :param size: size bound of all the files in bytes
+    :type size: int
+
+    :param retention: days a file is kept
+    :type retention: int
+
+    :param logger: Logger object
+    :type logger: Logger
+    """
+    oldest = time() - retention * 86400
+    files = []
+    for path in Path(directory).glob(pattern):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        if stat.st_mtime < oldest:
+            path.unlink(missing_ok=True)
+        else:
+            files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(file_size for mtime, file_size, path in files)
+    for mtime, file_size, path in sorted(files)[:-1]:
+        if total <= size:
+            break
+        path.unlink(missing_ok=True)
+        total -= file_size
+        if logger is not None:
+            logger.debug('Removed %s', path)
+
+
+def write_text_atomic(path, text, mode=None):
     """
+    Write the text in a temporary file next to path and rename it over path. Readers never see a partial file.
+    :param path: the file to write
+    :type path: Path
 
-    now = datetime.now()
-    # The filename has to end with .png file extension
-    filename = 'snapshot_' + now.strftime("%Y-%m-%d-%H:%M:%S") + '.png'
-    fnamePath = Path.home().joinpath('html').joinpath('results').joinpath(filename)
-    # Convert to string and use
-    driver.save_screenshot(str(fnamePath))
-    if logger is not None:
-        logger.debug("Snapshot saved in path: " + str(fnamePath))
+    :param text: the content
+    :type text: str
+
+    :param mode: permissions of the file, e.g. 0o600. The file is created with them, so it is never readable by others
+    :type mode: int
+    """
+    write_bytes_atomic(path, text.encode('utf-8'), mode)
+
+
+def write_bytes_atomic(path, data, mode=None):
+    """
+    Write the bytes in a temporary file next to path and rename it over path. Readers never see a partial file.
+    :param path: the file to write
+    :type path: Path
+
+    :param data: the content
+    :type data: bytes
+
+    :param mode: permissions of the file, e.g. 0o600. The file is created with them, so it is never readable by others
+    :type mode: int
+    """
+    path = Path(path)
+    # Unique per thread too, the threaded runners write the same files concurrently. Unlike mkstemp the file
+    # keeps the permissions of the umask when no mode is given
+    tmp_path = path.with_name('.' + path.name + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp')
+    try:
+        if mode is None:
+            tmp_path.write_bytes(data)
+        else:
+            with os.fdopen(os.open(str(tmp_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'wb') as f:
+                f.write(data)
+        os.replace(str(tmp_path), str(path))
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
+def take_snapshot(driver, args, logger=None, detach=False):
+    """
+    Take a snapshot of the page the login failed on. The snapshot store skips pages already captured and services
+    that got a snapshot recently
+    :param driver: geckodriver parameter
+    :type driver: geckodriver object
+
+    :param args: arguments retrieved from command line(hostname, snapshot_dir, snapshot_interval, snapshot_size)
+    :type args: dict
+
+    :param detach: write the snapshot in a detached process, for probes that exit right after the check
+    :type detach: bool
+
+    :param logger: logger object
+    :type logger: Logger
+    """
+    # Imported here, the snapshots module depends on this one
+    from rciam_probes.shared.snapshots import SnapshotStore
+    if args.snapshot_dir:
+        directory = Path(args.snapshot_dir)
+    else:
+        directory = Path.home().joinpath('html').joinpath('results')
+    try:
+        SnapshotStore(directory, args.snapshot_interval, args.snapshot_size * 1024 * 1024, detach=detach,
+                      logger=logger).put(driver, args.hostname)
+    except Exception as e:
+        # The check already failed, the snapshot must not change its outcome
+        if logger is not None:
+            logger.warning("Snapshot failed: " + str(e))
 
 
 def print_output(args, msg, logger=None):
@@ -471,21 +897,16 @@ def print_output(args, msg, logger=None):
     """
     if args.json_path:
         filenames = construct_out_filename(args, "json")
-        fpath_array = args.json_path.split('/')
-        fpath_array = list(filter(None, fpath_array))
-        fpath = Path.home().joinpath(*fpath_array)
+        fpath = results_directory(args)
         if not fpath.is_dir():
             if logger is not None:
                 logger.debug(str(fpath) + " does not exist. Creating it.")
             fpath.mkdir(0o755, parents=True, exist_ok=True)
         logger.debug("Write data in path: " + str(fpath))
-        for fn in filenames:
-            ofile = fpath.joinpath(fn)
-            ofile.touch(exist_ok=True)
-            ofile.write_text(msg)
+        write_results(args, fpath, filenames, msg, logger)
     elif args.json:
         filenames = construct_out_filename(args, "json")
-        fpath = Path('/').joinpath('var').joinpath('www').joinpath('html')
+        fpath = results_directory(args)
         if not fpath.is_dir():
             if logger is not None:
                 logger.debug(ParamDefaults.JSON_PATH.value + " does not exist")
@@ -493,17 +914,75 @@ def print_output(args, msg, logger=None):
             return
         logger.debug("Write data in path: " + str(fpath))
         try:
-            for fn in filenames:
-                ofile = fpath.joinpath(fn)
-                ofile.touch(exist_ok=True)
-                ofile.write_text(msg)
+            write_results(args, fpath, filenames, msg, logger)
         except PermissionError:
-            logger.warning("Insufficient permissions to create " + str(fn))
+            logger.warning("Insufficient permissions to write in " + str(fpath))
 
     else:
         print(msg)
 
 
+def results_directory(args):
+    """
+    :param args: arguments retrieved from command line(json, json_path)
+    :type args: dict
+
+    :return: the directory of the -J or --json output, None if the output is printed
+    :rtype: Path
+    """
+    if args.json_path:
+        return Path.home().joinpath(*filter(None, args.json_path.split('/')))
+    if args.json:
+        return Path('/').joinpath('var').joinpath('www').joinpath('html')
+    return None
+
+
+def write_results(args, fpath, filenames, msg, logger=None):
+    """
+    Write the json message in the consolidated results file or, without --results-store, in the out_<key>.json
+    file of every IdP. Files are replaced atomically, readers never see a partial message
+    :param args: arguments retrieved from command line
+    :type args: dict
+
+    :param fpath: output directory
+    :type fpath: Path
+
+    :param filenames: the out_<key>.json files returned from construct_out_filename
+    :type filenames: list
+
+    :param msg: the json message
+    :type msg: str
+
+    :param logger: Logger object
+    :type logger: Logger
+    """
+    if args.history:
+        # Imported here, the history module depends on this one
+        from rciam_probes.shared.history import LatencyHistory
+        data = json.loads(msg)
+        LatencyHistory(fpath.joinpath(history_filename(args)), args.history, logger).append(data['date'],
+                                                                                             data['value'],
+                                                                                             data['xcode'])
+    if args.results_store:
+        # Imported here, the store module depends on this one
+        from rciam_probes.shared.results import ResultsStore
+        ResultsStore(fpath, logger).put(args, msg)
+        return
+    for fn in filenames:
+        write_text_atomic(fpath.joinpath(fn), msg)
+
+
+def history_filename(args):
+    """
+    :param args: arguments of the check(sp, identity, hostname)
+    :type args: ArgumentParser
+
+    :return: name of the latency history file of the check
+    :rtype: str
+    """
+    return "hist_" + result_key(args.sp, args.identity, args.hostname) + ".bin"
+
+
 def timestamp_check(date, vld_time_window=30):
     """
     :param date: timestamp generated from datetime package
@@ -532,11 +1011,11 @@ def timestamp_check(date, vld_time_window=30):
     else:
         return True
 
-def evaluate_response_status(browser, args, logger=None):
+def evaluate_response_status(captured, args, logger=None):
     """
 
-    :param browser: Webdriver object of Firefox agent
-    :type webdriver object
+    :param captured: responses captured by the selenium-wire response interceptor
+    :type captured: RequestRing
 
     :param args: arguments retrieved from command line
     :type args: dict
@@ -546,9 +1025,9 @@ def evaluate_response_status(browser, args, logger=None):
 
     :raise RuntimeError
     """
-    for request in browser.requests:
-        if request.response and request.host == args.hostname:
-            if request.response.status_code >= 500:
+    for response in captured:
+        if response.host == args.hostname:
+            if response.status_code >= 500:
                 # Log the host, status, request
-                logger.error("Service is down: " + str(request.response.status_code))
-                raise RuntimeError('Service unavailable[' + str(request.response.status_code) + ']')
+                logger.error("Service is down: " + str(response.status_code) + " " + response.url)
+                raise RuntimeError('Service unavailable[' + str(response.status_code) + ']')
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import re
+import time
+from string import Template
+
+# Slim version comes with no Selenium and no firefox
+try:
+    from selenium.common.exceptions import JavascriptException, TimeoutException, WebDriverException
+except ImportError:
+    class WebDriverException(Exception):
+        pass
+
+    class JavascriptException(WebDriverException):
+        pass
+
+    class TimeoutException(WebDriverException):
+        pass
+
+from rciam_probes.shared.enums import ParamDefaults
+
+"""Messages of the JavascriptException the browser raises when the page navigates away during a script"""
+NAVIGATION_ERRORS = re.compile(r'unloaded|navigat', re.IGNORECASE)
+
+"""
+Evaluate the predicate in the page and resolve as soon as it returns a truthy value. The predicate is re-evaluated
+on every DOM mutation and, for changes no mutation reports(e.g. style sheets, layout), every poll milliseconds.
+Resolves with null when the timeout expires.
+"""
+PREDICATE_WAIT_JS = Template("""
+var done = arguments[arguments.length - 1];
+var predicateArgs = arguments[0], timeout = arguments[1], poll = arguments[2];
+var finished = false, observer = null, timer = null, expire = null;
+function ready() {
+    try {
+        return (function() { ${predicate} }).apply(null, predicateArgs);
+    } catch (e) {
+        return null;
+    }
+}
+function finish(value) {
+    if (finished) {
+        return;
+    }
+    finished = true;
+    if (observer) observer.disconnect();
+    clearInterval(timer);
+    clearTimeout(expire);
+    done(value);
+}
+function check() {
+    var result = ready();
+    if (result) finish(result);
+}
+var result = ready();
+if (result) {
+    done(result);
+} else {
+    observer = new MutationObserver(check);
+    observer.observe(document, {childList: true, subtree: true, attributes: true, characterData: true});
+    timer = setInterval(check, poll);
+    expire = setTimeout(function() { finish(null); }, timeout);
+}
+""")
+
+"""The element is attached, displayed and enabled. Predicate helper, takes the element"""
+ELEMENT_INTERACTABLE_JS = """
+function interactable(e) {
+    if (!e || !e.isConnected || e.disabled) return false;
+    var style = window.getComputedStyle(e);
+    return style.visibility !== 'hidden' && style.display !== 'none' && e.getClientRects().length > 0;
+}
+"""
+
+"""The document finished loading and no loader is visible"""
+PAGE_READY_JS = ELEMENT_INTERACTABLE_JS + """
+if (document.readyState !== 'complete' || !document.body) return false;
+var loader = document.querySelector('.loader-container');
+return !interactable(loader);
+"""
+
+"""Returns the element matching the css selector arguments[0] once it can be clicked"""
+CLICKABLE_JS = ELEMENT_INTERACTABLE_JS + """
+var e = document.querySelector(arguments[0]);
+return interactable(e) ? e : null;
+"""
+
+"""
+Returns the element matching the css selector arguments[0] once it can be clicked, or 'passed' once a loaded page
+has nothing to click and its url starts with one of arguments[1], i.e. the flow already moved past the optional page
+"""
+CLICKABLE_UNLESS_PASSED_JS = ELEMENT_INTERACTABLE_JS + """
+var e = document.querySelector(arguments[0]);
+if (interactable(e)) return e;
+if (document.readyState !== 'complete') return null;
+var url = window.location.href;
+for (var i = 0; i < arguments[1].length; i++) {
+    if (url.indexOf(arguments[1][i]) === 0) return 'passed';
+}
+return null;
+"""
+
+"""The url starts with arguments[0](no leading/trailing slashes) and head, title and body are loaded"""
+LANDING_PAGE_JS = """
+var url = window.location.href.replace(/^\\/+|\\/+$/g, '');
+return url.indexOf(arguments[0]) === 0 && !!document.head && !!document.querySelector('title') && !!document.body;
+"""
+
+
+class PageWait:
+    """
+    Event driven waits. A single JavaScript predicate is evaluated inside the page, re-evaluated on DOM mutations,
+    and the wait returns as soon as it holds, instead of stacking fixed sleeps and polling WebDriverWaits.
+    Navigations interrupt the in page wait. It is then re-armed on the new page until the timeout expires.
+    """
+    __browser = None
+    __timeout = None
+    __poll = None
+
+    def __init__(self, browser, timeout, poll=ParamDefaults.WAIT_POLL.value):
+        """
+        :param browser: Webdriver object of Firefox agent
+        :type browser: webdriver.Firefox
+
+        :param timeout: seconds to wait before giving up
+        :type timeout: float
+
+        :param poll: seconds between evaluations of the conditions no DOM mutation reports
+        :type poll: float
+        """
+        self.__browser = browser
+        self.__timeout = timeout
+        self.__poll = poll
+
+    def until_js(self, predicate, *args, timeout=None, message=''):
+        """
+        Wait until the predicate holds
+        :param predicate: body of a JavaScript function. Its arguments are args
+        :type predicate: str
+
+        :param args: json serializable arguments or web elements passed to the predicate
+        :type args: object
+
+        :param timeout: seconds to wait. Defaults to the timeout of the PageWait
+        :type timeout: float
+
+        :param message: message of the TimeoutException
+        :type message: str
+
+        :return: the value the predicate returned, e.g. a web element
+        :rtype: object
+
+        :raises TimeoutException: if the predicate does not hold in time
+        """
+        script = PREDICATE_WAIT_JS.substitute(predicate=predicate)
+        deadline = time.monotonic() + (self.__timeout if timeout is None else timeout)
+        script_timeout = self.__script_timeout()
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutException(message)
+                # Leave room for the in page timeout to resolve before the script timeout fires
+                self.__browser.set_script_timeout(remaining + 1)
+                try:
+                    result = self.__browser.execute_async_script(script, list(args), int(remaining * 1000),
+                                                                 int(self.__poll * 1000))
+                except TimeoutException:
+                    raise TimeoutException(message)
+                except JavascriptException as e:
+                    if not NAVIGATION_ERRORS.search(str(e)):
+                        raise
+                    # The page navigated away while we were waiting. Re-arm the wait on the new page
+                    time.sleep(self.__poll)
+                    continue
+                if result:
+                    return result
+        finally:
+            # The browser may be reused, e.g. from a pool, by scripts that rely on its own timeout
+            self.__browser.set_script_timeout(script_timeout)
+
+    def __script_timeout(self):
+        """
+        :return: the script timeout of the browser in seconds
+        :rtype: float
+        """
+        # Selenium 4 reads the timeouts of the session, older versions can not and the browser keeps its default
+        timeouts = getattr(self.__browser, 'timeouts', None)
+        if timeouts is not None and getattr(timeouts, 'script', None) is not None:
+            return timeouts.script
+        return ParamDefaults.SCRIPT_TIMEOUT.value
+
+    def until(self, condition, timeout=None, message=''):
+        """
+        Wait for a condition that can not be expressed in the page, e.g. an alert
+        :param condition: callable taking the driver, as with WebDriverWait
+        :type condition: callable
+
+        :param timeout: seconds to wait. Defaults to the timeout of the PageWait
+        :type timeout: float
+
+        :param message: message of the TimeoutException
+        :type message: str
+
+        :return: the value the condition returned
+        :rtype: object
+
+        :raises TimeoutException: if the condition does not hold in time
+        """
+        from selenium.webdriver.support.ui import WebDriverWait
+        return WebDriverWait(self.__browser, self.__timeout if timeout is None else timeout,
+                             poll_frequency=self.__poll).until(condition, message)
+
+    def page_ready(self, timeout=None):
+        """Wait for the document to load and the loader to disappear"""
+        return self.until_js(PAGE_READY_JS, timeout=timeout, message='Page not ready')
+
+    def clickable(self, css_selector, timeout=None):
+        """
+        :return: the element matching the css selector once it can be clicked
+        :rtype: WebElement
+        """
+        return self.until_js(CLICKABLE_JS, css_selector, timeout=timeout, message=css_selector + ' not clickable')
+
+    def clickable_unless_passed(self, css_selector, passed_urls, timeout=None):
+        """
+        Wait for the button of an optional page, e.g. a consent page
+        :param css_selector: css selector of the button
+        :type css_selector: str
+
+        :param passed_urls: url prefixes of the pages that come after the optional page
+        :type passed_urls: list
+
+        :return: the button or None if the flow moved past the optional page
+        :rtype: WebElement
+
+        :raises TimeoutException: if neither happened in time
+        """
+        result = self.until_js(CLICKABLE_UNLESS_PASSED_JS, css_selector, passed_urls, timeout=timeout,
+                               message=css_selector + ' not clickable')
+        return None if result == 'passed' else result
+
+    def landing_page(self, url, timeout=None):
+        """Wait until the browser loaded a page whose url starts with url"""
+        return self.until_js(LANDING_PAGE_JS, url.strip('/'), timeout=timeout, message=url + ' not loaded')
@@ -39,7 +39,7 @@ setup(name=__name__,
       url='https://github.com/rciam/rciam_probes',
       packages=find_packages(exclude=['tests', 'docs']),
       include_package_data=True,
-      scripts=["bin/checkcert", "bin/checklogin"],
+      scripts=["bin/checkcert", "bin/checklogin", "bin/checklogind", "bin/checkloginmatrix", "bin/checkrunner"],
       python_requires='~=3.9',
       install_requires=install_requires,
       )